@@ -0,0 +1,175 @@
+"""
+Benchmark of the repository link extractor against the hand checked links of
+paper 1. The teis behind those results are not part of the repository, so every
+row of experiment/paper1/results/*_links_clean.csv is turned into a synthetic
+article: filler text with references and article dois, and a data availability
+statement giving its links as a list or in running text, a third of them broken
+at the places grobid breaks them ("https://osf. io/ ab12c"). EDGE_CASES are
+sentences whose links end right before the next word.
+
+  PYTHONPATH=src python experiment/test/bench_links.py
+"""
+
+import csv
+import glob
+import os
+import random
+import re
+import time
+
+from process.links import extract_links
+
+RESULTS = os.path.join(os.path.dirname(__file__), "..", "paper1", "results")
+
+FILLER = (
+  "Teachers reported higher self-efficacy after the intervention (Smith et al., "
+  "2020, https://doi.org/10.1007/s10648-020-09510-1). The scale was adapted from "
+  "earlier work, see https://www.example.org/methods/scale.html for the items. "
+)
+
+
+# the extractors before process.links, kept for comparison
+def legacy_extract_github_links(text):
+  github_regex = (
+    "(?:https?://)?github\\.com/[A-Za-z0-9_.-]+/[A-Za-z0-9_.-]+(?:/[A-Za-z0-9_.-]+)*"
+  )
+  pattern = re.compile(rf"{github_regex}", re.IGNORECASE)
+  return pattern.findall(text)
+
+
+def legacy_extract_links_regex(text):
+  url_pattern = re.compile(
+    r"((?:https?://)?(?:www\.)?(?:github\.com|osf\.io|example\.com)[^\s]*(?:\s[^\s]+)*)",
+    re.IGNORECASE,
+  )
+  cleaned_links = []
+  for link in url_pattern.findall(text):
+    link = link.replace(" ", "")
+    if not link.startswith("http"):
+      link = "https://" + link
+    cleaned_links.append(link)
+  return cleaned_links
+
+
+def legacy_extract(text):
+  return legacy_extract_links_regex(text) + legacy_extract_github_links(text)
+
+
+def canonical(link):
+  link = re.sub(r"\s+", "", link).lower()
+  link = re.sub(r"^(?:https?://)?(?:www\.)?", "", link)
+  link = link.replace("/?", "?").rstrip("/.?-")
+  return link.removesuffix(".git")
+
+
+def valid(link):
+  # the clean files still hold a few fragments such as https://blob/master
+  host = canonical(link).split("/")[0]
+  return "." in host.strip(".")
+
+
+def break_like_grobid(link, rng):
+  if rng.random() < 2 / 3:
+    return link
+  link = link.replace("osf.io/", "osf. io/ ", 1) if "osf.io/" in link else link
+  return link.replace(".com/", ".com/ ", 1)
+
+
+# (text, links in it), links followed by prose that must not be merged into them
+EDGE_CASES = [
+  (
+    "The code is on github.com/jkr11/ and the data on osf.io/ab12c.",
+    {"github.com/jkr11", "osf.io/ab12c"},
+  ),
+  (
+    (
+      "Scripts are shared at https://github.com/jkr11/ analysis and at "
+      "gitlab.com/lab/ materials."
+    ),
+    {"github.com/jkr11", "gitlab.com/lab"},
+  ),
+  (
+    "See https://github. com/ jkr11/open-science-mentions for the pipeline.",
+    {"github.com/jkr11/open-science-mentions"},
+  ),
+  (
+    "Preregistered at https://osf. io/ ab12c/ before data collection.",
+    {"osf.io/ab12c"},
+  ),
+]
+
+
+def load_truth():
+  rows = []
+  for path in sorted(glob.glob(os.path.join(RESULTS, "*_links_clean.csv"))):
+    with open(path, encoding="utf-8-sig") as f:
+      for row in csv.DictReader(f):
+        links = [l.strip() for l in row["all_links"].split(";") if l.strip()]
+        rows.append((os.path.basename(path), links))
+  return rows
+
+
+def make_article(links, rng, filler_sentences):
+  links = [break_like_grobid(link, rng) for link in links]
+  if rng.random() < 0.5:
+    statement = "The data and analysis code are available at " + ", ".join(links)
+    statement += ". "
+  else:
+    statement = "".join(
+      f"The materials of study {i} can be found at {link} and were checked. "
+      for i, link in enumerate(links, 1)
+    )
+  return FILLER * filler_sentences + statement + FILLER * filler_sentences
+
+
+def score(extract, articles):
+  tp = fp = fn = 0
+  start = time.perf_counter()
+  found = [extract(text) for text, _ in articles]
+  seconds = time.perf_counter() - start
+  for links, (_, truth) in zip(found, articles, strict=True):
+    # the filler's article doi and web page are no repositories
+    got = {canonical(l) for l in links}
+    got = {l for l in got if not l.startswith(("example.org", "doi.org/10.1007"))}
+    tp += len(got & truth)
+    fp += len(got - truth)
+    fn += len(truth - got)
+  precision = tp / (tp + fp) if tp + fp else 1.0
+  recall = tp / (tp + fn) if tp + fn else 1.0
+  return precision, recall, seconds
+
+
+def main(filler_sentences=40):
+  rng = random.Random(0)
+  rows = load_truth()
+  invalid = sum(not valid(l) for _, links in rows for l in links)
+  articles = []
+  for _, links in rows:
+    links = [l for l in links if valid(l)]
+    # the files keep grobid's breaks in a few links, the truth is without them
+    articles.append(
+      (
+        make_article([re.sub(r"\s+", "", l) for l in links], rng, filler_sentences),
+        {canonical(l) for l in links},
+      )
+    )
+  n_links = sum(len(t) for _, t in articles)
+  size = sum(len(text) for text, _ in articles) / len(articles)
+  print(f"{len(articles)} articles, {n_links} links, {invalid} invalid links skipped")
+  print(f"average article {size / 1000:.1f}k characters\n")
+  print(f"{'extractor':<10} {'precision':>9} {'recall':>7} {'ms/article':>11}")
+  for name, extract in (("legacy", legacy_extract), ("links", extract_links)):
+    precision, recall, seconds = score(extract, articles)
+    print(
+      f"{name:<10} {precision:>9.3f} {recall:>7.3f} {1000 * seconds / len(articles):>11.3f}"
+    )
+  print()
+  for text, truth in EDGE_CASES:
+    got = {canonical(link) for link in extract_links(text)}
+    print(f"{'ok' if got == truth else 'FAILED':<6} {text}")
+    if got != truth:
+      print(f"       got {sorted(got)}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,76 @@
+"""
+Calibration of the FRONTIERS template threshold on the hand labelled test set.
+test_set_ground_truth.csv holds the FrontiersMatch label of the statement of
+each work ("N" for none of the templates), the statements are read from the
+teis of its pdfs, which are not part of the repository. Works without a label
+or without a tei are skipped.
+
+  PYTHONPATH=src python experiment/test/calibrate_das.py --teis test_db/teis
+"""
+
+import argparse
+import csv
+import os
+
+from process.das import FRONTIERS, calibrate_threshold, match_templates
+from process.xmlhandler import load_tei
+from store import TEI_DIR, ShardedDir, tei_name
+
+GROUND_TRUTH = os.path.join(os.path.dirname(__file__), "test_set_ground_truth.csv")
+
+
+def _find_tei(teis: ShardedDir, pdf_path: str) -> str | None:
+  name = tei_name(pdf_path)
+  for path in (teis.path(name), os.path.join(teis.root, name)):
+    if os.path.exists(path):
+      return path
+  return None
+
+
+def load_labelled(path: str, teis: ShardedDir) -> tuple[list, int]:
+  """(statement, label or None) of the labelled works and how many had no tei."""
+  labelled, missing = [], 0
+  with open(path, encoding="utf-8") as f:
+    for row in csv.DictReader(f):
+      label = row["ground_statement"]
+      if not label:
+        continue
+      tei = _find_tei(teis, row["pdf_local_path"])
+      if tei is None:
+        missing += 1
+        continue
+      das = load_tei(tei).das
+      if das:
+        labelled.append((das, None if label == "N" else int(label)))
+  return labelled, missing
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+  parser.add_argument("--teis", default=TEI_DIR.root, help="dir of the test teis")
+  parser.add_argument("--ground-truth", default=GROUND_TRUTH)
+  parser.add_argument("--min-precision", type=float, default=0.98)
+  args = parser.parse_args()
+
+  labelled, missing = load_labelled(args.ground_truth, ShardedDir(args.teis))
+  print(f"{len(labelled)} labelled statements, {missing} works without a tei")
+  if not labelled:
+    return
+  threshold = calibrate_threshold(FRONTIERS, labelled, args.min_precision)
+  texts, labels = zip(*labelled, strict=True)
+  matches = match_templates(texts, FRONTIERS)
+  for name, value in (("current", FRONTIERS.threshold), ("calibrated", threshold)):
+    decided = [
+      m.label == label
+      for m, label in zip(matches, labels, strict=True)
+      if m and m.score >= value
+    ]
+    precision = sum(decided) / len(decided) if decided else 1.0
+    print(
+      f"{name:<10} threshold {value:5.1f}: {len(decided)}/{len(labelled)} decided,"
+      f" precision {precision:.3f}"
+    )
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,119 @@
+"""
+Smoke test of the async grobid and llm clients against the stub servers, no
+grobid or ollama needed. Sends a few pdfs through AsyncGrobidClient to two
+grobid stubs, parses the teis it writes and classifies their data availability
+statements with AsyncLLMClient against the ollama stub. Exits non-zero if any
+step goes wrong.
+
+  PYTHONPATH=src python experiment/test/smoke_stubs.py
+"""
+
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+
+from process.das import decide_das
+from process.grobid import AsyncGrobidClient
+from process.grobid_stub import start_stubs
+from process.links import extract_links
+from process.llm import DAS_TASK, AsyncLLMClient
+from process.llm_stub import start_stub
+from process.xmlhandler import load_tei
+from store import ShardedDir
+
+PDFS = 12
+
+
+def _free_port(count: int = 1) -> int:
+  """A port with `count` free ports from it on, for stubs on consecutive ports."""
+  while True:
+    with socket.socket() as s:
+      s.bind(("127.0.0.1", 0))
+      port = s.getsockname()[1]
+    try:
+      for i in range(1, count):
+        with socket.socket() as s:
+          s.bind(("127.0.0.1", port + i))
+      return port
+    except OSError:
+      continue
+
+
+def _write_pdfs(root: str) -> list[str]:
+  pdfs = []
+  for i in range(PDFS):
+    path = os.path.join(root, f"smoke{i:02d}.pdf")
+    with open(path, "wb") as f:
+      f.write(b"%PDF-1.4\n" + os.urandom(64) + b"\n%%EOF\n")
+    pdfs.append(path)
+  # not a pdf, grobid fails on it for good
+  path = os.path.join(root, "broken.pdf")
+  with open(path, "wb") as f:
+    f.write(b"<html>not a pdf</html>")
+  return pdfs + [path]
+
+
+async def smoke_grobid(root: str) -> list[str]:
+  """Runs the pdfs through the grobid stubs, returns the paths of the teis."""
+  port = _free_port(2)
+  stubs = await start_stubs(port, instances=2, latency=0.05, capacity=4)
+  servers = [f"http://127.0.0.1:{port + i}" for i in range(len(stubs))]
+  teis_dir = os.path.join(root, "teis")
+  try:
+    async with AsyncGrobidClient(servers, output_path=teis_dir) as client:
+      results = [r async for r in client.process_all(_write_pdfs(root))]
+      print(f"grobid: {client.summary()}")
+  finally:
+    for runner, _ in stubs:
+      await runner.cleanup()
+  statuses = {os.path.basename(r.pdf): r.status for r in results}
+  assert statuses.pop("broken.pdf") == "FAILED", "broken pdf not failed"
+  assert set(statuses.values()) == {"DONE"}, f"grobid results: {statuses}"
+  assert all(stub.served for _, stub in stubs), "a stub got no work"
+  return [os.path.join(teis_dir, r.tei) for r in results if r.tei]
+
+
+def check_teis(teis: list[str], root: str) -> list[str]:
+  """The data availability statements of the teis, checked for their links."""
+  cache = ShardedDir(os.path.join(root, "cache"))
+  statements = []
+  for tei in teis:
+    doc = load_tei(tei, cache)
+    assert doc.das, f"no data availability statement in {tei}"
+    links = extract_links(doc.das)
+    assert any("osf.io/abcde" in link for link in links), f"links of {tei}: {links}"
+    assert decide_das(doc.das).code == "A", f"decision of {tei}"
+    statements.append(doc.das)
+  return statements
+
+
+async def smoke_llm(statements: list[str]) -> None:
+  port = _free_port()
+  runner, stub = await start_stub(port, latency=0.05, parallel=2, drop_every=3)
+  restricted = "The data are available from the corresponding author upon request."
+  texts = statements + [restricted, "No data were collected for this essay."]
+  try:
+    url = f"http://127.0.0.1:{port}/api/generate"
+    async with AsyncLLMClient(url, concurrency=2, batch_size=4) as llm:
+      codes = await llm.classify(texts, DAS_TASK)
+  finally:
+    await runner.cleanup()
+  print(f"llm: {stub.requests} requests, {stub.statements} statements")
+  assert codes == ["A"] * len(statements) + ["R", "N"], f"llm codes: {codes}"
+
+
+async def main() -> None:
+  with tempfile.TemporaryDirectory() as root:
+    teis = await smoke_grobid(root)
+    statements = check_teis(teis, root)
+    await smoke_llm(statements)
+  print(f"ok: {len(teis)} teis, {len(statements)} statements")
+
+
+if __name__ == "__main__":
+  try:
+    asyncio.run(main())
+  except AssertionError as e:
+    sys.exit(f"smoke test failed: {e}")
@@ -2,6 +2,7 @@ import sqlite3
 import os
 import json
 from database import DB_PATH, DB_DIR
+from store import shard
 from process.download import PDFDownloader
 from process.grobid import process_dir
 from process.analysis import FrontiersHandler, extract_links_regex, OSFHandler, extract_github_links
@@ -48,11 +49,9 @@ def dir_iterator(input_dir, ext):
 
 
 def is_in_dir(name, path="test_db/pdfs"):
-  for file in os.listdir(path):
-    if name in file:
-      print(name)
-      return True
-  return False
+  # a lookup in the flat or the sharded layout instead of listing the directory
+  return any(os.path.exists(os.path.join(path, p)) for p in (name, shard(name)))
+
 
 def extract_text_analysis():
   for file in os.listdir("test_db/test/"):
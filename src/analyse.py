@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+from database import connect, migrate
+from process.analysis import ANALYSER_VERSION, analyse_tei, das_result
+from process.das import (
+  DASDecision,
+  TemplateSet,
+  decide_das_batch,
+  resolve_with_llm,
+  templates_for,
+)
+from process.llm import AsyncLLMClient, LLMCache
+from store import TEI_DIR
+
+ANALYSIS_UPSERT_QUERY = """
+  INSERT INTO analysis_results (
+    openalex_id, analyser_version, tei_local_path, das_score, das_code,
+    das_tier, das_match_score, das_templates, das_links, github_links,
+    osf_links, error
+  ) VALUES (
+    :openalex_id, :analyser_version, :tei_local_path, :das_score, :das_code,
+    :das_tier, :das_match_score, :das_templates, :das_links, :github_links,
+    :osf_links, :error
+  )
+  ON CONFLICT (openalex_id, analyser_version) DO UPDATE SET
+    tei_local_path = excluded.tei_local_path, das_score = excluded.das_score,
+    das_code = excluded.das_code, das_tier = excluded.das_tier,
+    das_match_score = excluded.das_match_score,
+    das_templates = excluded.das_templates,
+    das_links = excluded.das_links, github_links = excluded.github_links,
+    osf_links = excluded.osf_links, error = excluded.error,
+    created_at = CURRENT_TIMESTAMP
+"""
+
+# teis whose works have no result of this analyser version yet, with :llm also
+# those whose DAS the cheap tiers left undecided
+TODO_QUERY = """
+  SELECT tei_local_path, MIN(journal_id) FROM works AS w
+  WHERE tei_process_status = 'DONE' AND tei_local_path > :last
+    AND (:journal_id IS NULL OR journal_id = :journal_id)
+    AND NOT EXISTS (
+      SELECT 1 FROM analysis_results AS a
+      WHERE a.openalex_id = w.openalex_id AND a.analyser_version = :version
+        AND NOT (:llm AND a.das_tier IS 'undecided')
+    )
+  GROUP BY tei_local_path
+  ORDER BY tei_local_path
+  LIMIT :limit
+"""
+
+
+def result_row(openalex_id: str, tei_local_path: str, result: dict) -> dict:
+  """Parameters of ANALYSIS_UPSERT_QUERY for a result of analyse_tei."""
+  return {
+    "openalex_id": openalex_id,
+    "analyser_version": ANALYSER_VERSION,
+    "tei_local_path": tei_local_path,
+    "das_score": result.get("das_score"),
+    "das_code": result.get("das_code"),
+    "das_tier": result.get("das_tier"),
+    "das_match_score": result.get("das_match_score"),
+    "das_templates": result.get("das_templates"),
+    "das_links": json.dumps(result.get("das_links", [])),
+    "github_links": json.dumps(result.get("github_links", [])),
+    "osf_links": json.dumps(result.get("osf_links", [])),
+    "error": result.get("error"),
+  }
+
+
+def _analyse(stored: str) -> dict:
+  try:
+    return analyse_tei(TEI_DIR.resolve(stored), classify=False)
+  except Exception as e:
+    return {"error": f"{type(e).__name__}: {e}"}
+
+
+def _decide(results: list[dict], journals: list[str | None]) -> None:
+  """
+  The cheap DAS tiers for a chunk of analyse_tei results, in place. The
+  statements of all journals sharing templates are scored in one batch.
+  """
+  groups: dict[str, tuple[list[TemplateSet], list[dict]]] = {}
+  for result, journal_id in zip(results, journals, strict=True):
+    if "error" not in result:
+      templates = templates_for(journal_id)
+      key = ",".join(t.name for t in templates)
+      groups.setdefault(key, (templates, []))[1].append(result)
+  for templates, group in groups.values():
+    decisions = decide_das_batch([r["das"] for r in group], templates)
+    for result, decision in zip(group, decisions, strict=True):
+      result.update(das_result(decision))
+
+
+async def _resolve_undecided(results: list[dict], llm_model: str) -> None:
+  """Classifies the DAS the cheap tiers left undecided with the llm, in place."""
+  undecided = [r for r in results if r.get("das_tier") == "undecided"]
+  if not undecided:
+    return
+  decisions = [DASDecision(None, "undecided")] * len(undecided)
+  async with AsyncLLMClient(model=llm_model, cache=LLMCache()) as llm:
+    decisions = await resolve_with_llm(decisions, [r["das"] for r in undecided], llm)
+  for result, decision in zip(undecided, decisions, strict=True):
+    result["das_code"] = decision.code
+    result["das_tier"] = decision.tier
+
+
+def analyse_corpus(
+  journal_id: str | None = None,
+  workers: int | None = None,
+  chunk_size: int = 500,
+  db_path: str | None = None,
+  llm_model: str | None = None,
+) -> dict[str, int]:
+  """
+  Runs analyse_tei over every tei without a result of the current
+  ANALYSER_VERSION in a process pool and stores the results in
+  analysis_results. Each chunk is committed on its own, an interrupted run
+  continues with the teis that are still missing. Works sharing a tei share
+  its result, a tei that cannot be parsed is stored with the error.
+
+  With `llm_model` the statements the template and phrase tiers of process.das
+  leave undecided are classified by the llm, including those of earlier runs.
+  das_tier tells which tier decided each work.
+  """
+  migrate(db_path)
+  counts = {"teis": 0, "works": 0, "errors": 0, "llm": 0}
+  last = ""
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    while True:
+      params = {
+        "last": last,
+        "journal_id": journal_id.upper() if journal_id else None,
+        "version": ANALYSER_VERSION,
+        "limit": chunk_size,
+        "llm": llm_model is not None,
+      }
+      with connect(db_path) as conn:
+        todo = conn.execute(TODO_QUERY, params).fetchall()
+      if not todo:
+        return counts
+      paths, journals = (list(c) for c in zip(*todo, strict=True))
+      last = paths[-1]
+      results = dict(zip(paths, pool.map(_analyse, paths, chunksize=16), strict=True))
+      _decide(list(results.values()), journals)
+      if llm_model:
+        asyncio.run(_resolve_undecided(list(results.values()), llm_model))
+      with connect(db_path) as conn:
+        works = conn.execute(
+          f"""
+            SELECT openalex_id, tei_local_path FROM works
+            WHERE tei_process_status = 'DONE'
+              AND tei_local_path IN ({",".join("?" * len(paths))})
+          """,
+          paths,
+        ).fetchall()
+        conn.executemany(
+          ANALYSIS_UPSERT_QUERY,
+          [result_row(i, path, results[path]) for i, path in works],
+        )
+      counts["teis"] += len(paths)
+      counts["works"] += len(works)
+      counts["errors"] += sum("error" in r for r in results.values())
+      counts["llm"] += sum(r.get("das_tier") == "llm" for r in results.values())
+      print(f"Analysed {counts['teis']} teis: {counts}")
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(
+    description="Score the DAS and extract repository links of all processed teis."
+  )
+  parser.add_argument("--journal", help="only works of this openalex source id")
+  parser.add_argument("--workers", type=int, help="processes, default all cores")
+  parser.add_argument("--chunk-size", type=int, default=500)
+  parser.add_argument(
+    "--llm", metavar="MODEL", help="classify undecided DAS with this ollama model"
+  )
+  args = parser.parse_args()
+  counts = analyse_corpus(
+    args.journal, args.workers, args.chunk_size, llm_model=args.llm
+  )
+  print(f"Done: {counts}")
+
+
+if __name__ == "__main__":
+  main()
@@ -1,5 +1,13 @@
 import sqlite3
 import os
+import queue
+import asyncio
+import threading
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
 
 
 TEST = False
@@ -14,14 +22,180 @@ DB_PATH = os.path.join(DB_DIR, "index.db")
 
 DOWNLOAD_DIR_PDFS = os.path.join(DB_DIR, "pdfs")
 DOWNLOAD_DIR_TEIS = os.path.join(DB_DIR, "teis")
+# parsed teis, see process.xmlhandler.load_tei
+TEI_CACHE_DIR = os.path.join(DB_DIR, "tei_cache")
 
 
 os.makedirs(DB_DIR, exist_ok=True)
 
+POOL_SIZE = 8
+CACHE_SIZE_KIB = 64 * 1024
+BUSY_TIMEOUT_MS = 30_000
+# seconds to wait for a free pooled connection before giving up
+ACQUIRE_TIMEOUT = 60
+
+
+def _configure(conn: sqlite3.Connection) -> None:
+  # WAL lets readers run next to the single writer, NORMAL is durable in WAL mode
+  conn.execute("PRAGMA journal_mode=WAL")
+  conn.execute("PRAGMA synchronous=NORMAL")
+  conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+  conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+  conn.execute("PRAGMA temp_store=MEMORY")
+
+
+class ConnectionPool:
+  """
+  A fixed number of configured connections to one database file. A thread that
+  already holds one gets the same connection back, inside the outer transaction.
+  """
+
+  def __init__(self, path: str, size: int = POOL_SIZE):
+    self.path = path
+    self.size = size
+    self.created = 0
+    self.idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+    self.lock = threading.Lock()
+    self.held = threading.local()
+
+  def acquire(self) -> sqlite3.Connection:
+    try:
+      return self.idle.get_nowait()
+    except queue.Empty:
+      pass
+    with self.lock:
+      if self.created < self.size:
+        self.created += 1
+        conn = sqlite3.connect(
+          self.path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False
+        )
+        _configure(conn)
+        return conn
+    try:
+      return self.idle.get(timeout=ACQUIRE_TIMEOUT)
+    except queue.Empty:
+      raise TimeoutError(
+        f"no free connection to {self.path} after {ACQUIRE_TIMEOUT}s, all"
+        f" {self.size} are in use. Is connect() held across an await?"
+      ) from None
+
+  def release(self, conn: sqlite3.Connection) -> None:
+    if conn.in_transaction:
+      conn.rollback()
+    self.idle.put(conn)
+
+  @contextmanager
+  def connection(self) -> Iterator[sqlite3.Connection]:
+    held = getattr(self.held, "conn", None)
+    if held is not None:
+      # nested on the same thread, the outer block commits
+      yield held
+      return
+    conn = self.acquire()
+    self.held.conn = conn
+    try:
+      with conn:
+        yield conn
+    finally:
+      self.held.conn = None
+      self.release(conn)
+
+  def close(self) -> None:
+    while True:
+      try:
+        self.idle.get_nowait().close()
+      except queue.Empty:
+        break
+    with self.lock:
+      self.created = 0
+
+
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path: str | None = None) -> ConnectionPool:
+  path = path or DB_PATH
+  with _pools_lock:
+    if path not in _pools:
+      _pools[path] = ConnectionPool(path)
+    return _pools[path]
+
+
+@contextmanager
+def connect(path: str | None = None) -> Iterator[sqlite3.Connection]:
+  """
+  Borrows a pooled connection to `path` (default DB_PATH). Like sqlite3's own
+  context manager the transaction is committed on success and rolled back on error.
+  """
+  with get_pool(path).connection() as conn:
+    yield conn
+
+
+class AsyncDBWriter:
+  """
+  Single writer for coroutines. Statements posted to the queue are applied in
+  batches, one transaction per batch, on a worker thread so the event loop and
+  readers are never blocked by per-row commits.
+
+    async with AsyncDBWriter() as writer:
+      writer.post("UPDATE works SET ... WHERE openalex_id = ?", (...))
+  """
+
+  def __init__(self, path: str | None = None, max_batch: int = 256):
+    self.path = path
+    self.max_batch = max_batch
+    self.queue: asyncio.Queue = asyncio.Queue()
+    self.task: asyncio.Task | None = None
+    self.n_written = 0
+
+  async def __aenter__(self):
+    self.task = asyncio.create_task(self._run())
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, _):
+    await self.close()
+
+  def post(self, query: str, params: tuple = ()) -> None:
+    self.queue.put_nowait((query, params))
+
+  async def flush(self) -> None:
+    await self.queue.join()
+
+  async def close(self) -> None:
+    if self.task is None:
+      return
+    await self.queue.join()
+    self.task.cancel()
+    try:
+      await self.task
+    except asyncio.CancelledError:
+      pass
+    self.task = None
+
+  def _apply(self, batch: list[tuple[str, tuple]]) -> None:
+    with connect(self.path) as conn:
+      for query, params in batch:
+        conn.execute(query, params)
+
+  async def _run(self) -> None:
+    while True:
+      batch = [await self.queue.get()]
+      while len(batch) < self.max_batch and not self.queue.empty():
+        batch.append(self.queue.get_nowait())
+      try:
+        await asyncio.to_thread(self._apply, batch)
+        self.n_written += len(batch)
+      except sqlite3.Error as e:
+        print(f"Database error in writer, dropped {len(batch)} statements: {e}")
+      finally:
+        for _ in batch:
+          self.queue.task_done()
+
 
 def empty_table():
   try:
-    with sqlite3.connect(DB_PATH) as conn:
+    with connect() as conn:
       cursor = conn.cursor()
       cursor.execute("""
           DELETE FROM works    
@@ -32,30 +206,476 @@ def empty_table():
     print(f"An error occured when emptying the table: {e}")
 
 
+def _create_base_tables(conn: sqlite3.Connection) -> None:
+  conn.execute("""
+    CREATE TABLE IF NOT EXISTS works (
+    openalex_id TEXT PRIMARY KEY,
+    journal_id TEXT,
+    journal_name TEXT,
+    doi TEXT,
+    publication_year INTEGER,
+    oa_urls TEXT,
+    pdf_download_status TEXT DEFAULT 'PENDING', -- PENDING, SUCCESS, FAILED
+    pdf_local_path TEXT,
+    tei_process_status TEXT DEFAULT 'PENDING',
+    tei_local_path TEXT
+    );
+  """)
+  conn.execute("""
+    CREATE TABLE IF NOT EXISTS harvest_state (
+    journal_id TEXT NOT NULL, -- '|'-joined openalex source ids of the query
+    min_year INTEGER NOT NULL,
+    pdf INTEGER NOT NULL,
+    year INTEGER NOT NULL DEFAULT 0, -- publication year shard, 0 if unsharded
+    filter_hash TEXT,
+    cursor TEXT,
+    pages INTEGER DEFAULT 0,
+    done INTEGER DEFAULT 0,
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (journal_id, min_year, pdf, year)
+    );
+  """)
+
+
+_WORK_URLS_FROM_JSON = """
+  INSERT OR IGNORE INTO work_urls (openalex_id, position, url)
+  SELECT {id}, j.key, j.value FROM json_each({urls}, '$.pdf_links') AS j
+  WHERE j.value IS NOT NULL
+"""
+
+
+def _add_indexes_and_work_urls(conn: sqlite3.Connection) -> None:
+  conn.execute(
+    "CREATE INDEX IF NOT EXISTS idx_works_journal_pdf_status "
+    "ON works (journal_id, pdf_download_status)"
+  )
+  conn.execute(
+    "CREATE INDEX IF NOT EXISTS idx_works_journal_tei_status "
+    "ON works (journal_id, tei_process_status)"
+  )
+  conn.execute(
+    "CREATE INDEX IF NOT EXISTS idx_works_pdf_local_path ON works (pdf_local_path)"
+  )
+  # oa_urls stays the written column (the R analysis reads it), work_urls is kept
+  # in sync by triggers so that url selection is a plain indexed join
+  conn.execute("""
+    CREATE TABLE IF NOT EXISTS work_urls (
+    openalex_id TEXT NOT NULL REFERENCES works (openalex_id),
+    position INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    PRIMARY KEY (openalex_id, url)
+    ) WITHOUT ROWID;
+  """)
+  conn.execute("CREATE INDEX IF NOT EXISTS idx_work_urls_url ON work_urls (url)")
+  conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS works_urls_insert AFTER INSERT ON works
+    WHEN json_valid(NEW.oa_urls)
+    BEGIN
+      {_WORK_URLS_FROM_JSON.format(id="NEW.openalex_id", urls="NEW.oa_urls")};
+    END;
+  """)
+  conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS works_urls_update AFTER UPDATE OF oa_urls ON works
+    WHEN OLD.oa_urls IS NOT NEW.oa_urls
+    BEGIN
+      DELETE FROM work_urls WHERE openalex_id = NEW.openalex_id;
+      {_WORK_URLS_FROM_JSON.format(id="NEW.openalex_id", urls="NEW.oa_urls")}
+      AND json_valid(NEW.oa_urls);
+    END;
+  """)
+  conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS works_urls_delete AFTER DELETE ON works
+    BEGIN
+      DELETE FROM work_urls WHERE openalex_id = OLD.openalex_id;
+    END;
+  """)
+  conn.execute(
+    _WORK_URLS_FROM_JSON.replace("FROM json_each", "FROM works, json_each").format(
+      id="works.openalex_id", urls="works.oa_urls"
+    )
+    + " AND json_valid(works.oa_urls)"
+  )
+
+
+def _add_work_leases(conn: sqlite3.Connection) -> None:
+  conn.execute("ALTER TABLE works ADD COLUMN lease_owner TEXT")
+  conn.execute("ALTER TABLE works ADD COLUMN lease_expires REAL")  # unix time
+  conn.execute(
+    "CREATE INDEX IF NOT EXISTS idx_works_lease_owner ON works (lease_owner)"
+  )
+
+
+def _add_host_strategies(conn: sqlite3.Connection) -> None:
+  conn.execute("""
+    CREATE TABLE IF NOT EXISTS host_strategies (
+    host TEXT NOT NULL,
+    tier TEXT NOT NULL, -- http, browser
+    rewrite TEXT NOT NULL DEFAULT '', -- name of the url rewrite, '' for none
+    exit_node TEXT NOT NULL DEFAULT '', -- vpn location, '' if unknown
+    successes INTEGER DEFAULT 0,
+    failures INTEGER DEFAULT 0,
+    latencies TEXT, -- comma separated seconds of recent successes
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (host, tier, rewrite, exit_node)
+    );
+  """)
+
+
+def _add_url_contents(conn: sqlite3.Connection) -> None:
+  # downloaded pdfs are stored by the sha256 of their bytes, this maps every url
+  # that served a pdf to its content
+  conn.execute("""
+    CREATE TABLE IF NOT EXISTS url_contents (
+    url TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    size INTEGER,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+  """)
+  conn.execute(
+    "CREATE INDEX IF NOT EXISTS idx_url_contents_sha256 ON url_contents (sha256)"
+  )
+
+
+def _add_pdf_checks(conn: sqlite3.Connection) -> None:
+  # 1 sniffed, 2 fully parsed, see validate.py
+  conn.execute("ALTER TABLE works ADD COLUMN pdf_check INTEGER")
+  # HTML, TRUNCATED, ... for works marked INVALID
+  conn.execute("ALTER TABLE works ADD COLUMN pdf_invalid_reason TEXT")
+
+
+def _add_tei_results(conn: sqlite3.Connection) -> None:
+  # outcome of the last grobid request of a work
+  conn.execute("ALTER TABLE works ADD COLUMN tei_error TEXT")
+  conn.execute("ALTER TABLE works ADD COLUMN tei_seconds REAL")
+  conn.execute("ALTER TABLE works ADD COLUMN tei_attempts INTEGER DEFAULT 0")
+
+
+def _add_analysis_results(conn: sqlite3.Connection) -> None:
+  # one row per work and version of process.analysis.analyse_tei, link lists are
+  # json arrays
+  conn.execute("""
+    CREATE TABLE IF NOT EXISTS analysis_results (
+    openalex_id TEXT NOT NULL REFERENCES works (openalex_id),
+    analyser_version INTEGER NOT NULL,
+    tei_local_path TEXT,
+    das_score INTEGER,
+    das_links TEXT,
+    github_links TEXT,
+    osf_links TEXT,
+    error TEXT,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (openalex_id, analyser_version)
+    ) WITHOUT ROWID;
+  """)
+  conn.execute(
+    "CREATE INDEX IF NOT EXISTS idx_works_tei_status_path "
+    "ON works (tei_process_status, tei_local_path)"
+  )
+
+
+def _add_llm_cache(conn: sqlite3.Connection) -> None:
+  # answers of process.llm, keyed by model, a hash of the task (system prompt and
+  # codes) and a hash of the normalized statement
+  conn.execute("""
+    CREATE TABLE IF NOT EXISTS llm_cache (
+    model TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    code TEXT NOT NULL,
+    used_at REAL NOT NULL, -- unix time of the last hit, for LRU eviction
+    PRIMARY KEY (model, prompt_hash, input_hash)
+    ) WITHOUT ROWID;
+  """)
+  conn.execute(
+    "CREATE INDEX IF NOT EXISTS idx_llm_cache_used_at ON llm_cache (used_at)"
+  )
+
+
+def _add_das_tiers(conn: sqlite3.Connection) -> None:
+  # DAS code of process.das and the tier that decided it: template, phrase, llm,
+  # none or undecided
+  conn.execute("ALTER TABLE analysis_results ADD COLUMN das_code TEXT")
+  conn.execute("ALTER TABLE analysis_results ADD COLUMN das_tier TEXT")
+  conn.execute("ALTER TABLE analysis_results ADD COLUMN das_match_score REAL")
+
+
+def _add_das_templates(conn: sqlite3.Connection) -> None:
+  # name of the process.das TemplateSet the DAS matched best
+  conn.execute("ALTER TABLE analysis_results ADD COLUMN das_templates TEXT")
+
+
+# append only, the position in this list is the schema version (PRAGMA user_version)
+MIGRATIONS = [
+  _create_base_tables,
+  _add_indexes_and_work_urls,
+  _add_work_leases,
+  _add_host_strategies,
+  _add_url_contents,
+  _add_pdf_checks,
+  _add_tei_results,
+  _add_analysis_results,
+  _add_llm_cache,
+  _add_das_tiers,
+  _add_das_templates,
+]
+
+
+def migrate(path: str | None = None) -> int:
+  """Applies all pending MIGRATIONS, each in its own transaction."""
+  with connect(path) as conn:
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for v, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+      conn.execute("BEGIN IMMEDIATE")
+      # another process may have applied it while this one waited for the lock
+      if conn.execute("PRAGMA user_version").fetchone()[0] >= v:
+        conn.rollback()
+        continue
+      try:
+        migration(conn)
+        conn.execute(f"PRAGMA user_version = {v}")
+        conn.commit()
+      except sqlite3.Error:
+        conn.rollback()
+        raise
+      print(f"Database migrated to schema version {v}: {migration.__name__}")
+  return max(version, len(MIGRATIONS))
+
+
 def setup_pipeline_table():
   try:
-    with sqlite3.connect(DB_PATH) as conn:
-      cursor = conn.cursor()
-      cursor.execute("""
-        CREATE TABLE IF NOT EXISTS works (
-        openalex_id TEXT PRIMARY KEY,
-        journal_id TEXT,
-        journal_name TEXT,
-        doi TEXT,
-        publication_year INTEGER,
-        oa_urls TEXT,
-        pdf_download_status TEXT DEFAULT 'PENDING', -- PENDING, SUCCESS, FAILED
-        pdf_local_path TEXT,
-        tei_process_status TEXT DEFAULT 'PENDING',
-        tei_local_path TEXT
-        );
-      """)
-      conn.commit()
-      print(f"Database '{DB_PATH}' initialized successfully.")
+    migrate()
+    print(f"Database '{DB_PATH}' initialized successfully.")
   except sqlite3.Error as e:
     print(f"An error occured during database setup: {e}")
 
 
+def get_work_urls(
+  conn: sqlite3.Connection, openalex_ids: list[str]
+) -> dict[str, list[str]]:
+  """Returns the pdf urls of the given works in harvest order."""
+  works: dict[str, list[str]] = {openalex_id: [] for openalex_id in openalex_ids}
+  for start in range(0, len(openalex_ids), 500):
+    chunk = openalex_ids[start : start + 500]
+    rows = conn.execute(
+      f"""
+        SELECT openalex_id, url FROM work_urls
+        WHERE openalex_id IN ({",".join("?" * len(chunk))})
+        ORDER BY openalex_id, position
+      """,
+      chunk,
+    ).fetchall()
+    for openalex_id, url in rows:
+      works[openalex_id].append(url)
+  return works
+
+
+# works whose pdf has the same content as a work that already has a tei, since
+# pdfs are content addressed they share pdf_local_path
+SHARE_TEIS_QUERY = """
+  UPDATE works
+  SET tei_local_path = done.tei_local_path, tei_process_status = 'DONE',
+      lease_owner = NULL, lease_expires = NULL
+  FROM (
+    SELECT pdf_local_path, MAX(tei_local_path) AS tei_local_path
+    FROM works
+    WHERE tei_process_status = 'DONE' AND pdf_local_path IS NOT NULL
+    GROUP BY pdf_local_path
+  ) AS done
+  WHERE works.pdf_local_path = done.pdf_local_path
+    AND works.pdf_download_status = 'DONE'
+    AND works.tei_process_status != 'DONE'
+"""
+
+
+def share_duplicate_teis(conn: sqlite3.Connection) -> int:
+  """Marks duplicate pdfs as processed before they are sent to grobid."""
+  return conn.execute(SHARE_TEIS_QUERY).rowcount
+
+
+def tei_for_pdf(conn: sqlite3.Connection, pdf_local_path: str) -> str | None:
+  row = conn.execute(
+    """
+      SELECT tei_local_path FROM works
+      WHERE pdf_local_path = ? AND tei_process_status = 'DONE'
+      LIMIT 1
+    """,
+    (pdf_local_path,),
+  ).fetchone()
+  return row[0] if row else None
+
+
+LEASE_SECONDS = 15 * 60
+
+# which rows a stage may claim, the status value is bound as :status
+CLAIM_STAGES = {
+  "download": "pdf_download_status = :status",
+  "grobid": "pdf_download_status = 'DONE' AND tei_process_status = :status",
+}
+
+
+def new_worker_id() -> str:
+  """Lease owner id, unique across hosts and processes sharing index.db."""
+  return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def claim_works(
+  conn: sqlite3.Connection,
+  stage: str,
+  owner: str,
+  limit: int,
+  journal_id: str | None = None,
+  status: str = "PENDING",
+  lease_seconds: float = LEASE_SECONDS,
+) -> list[tuple[str, str | None]]:
+  """
+  Atomically leases up to `limit` works of a stage to `owner` and returns their
+  (openalex_id, pdf_local_path). Works leased to another live worker are skipped,
+  expired leases of crashed workers are taken over. Writing the stage's result
+  status should clear the lease, see release_works.
+  """
+  journal_filter = "AND journal_id = :journal_id" if journal_id else ""
+  now = time.time()
+  with conn:
+    return conn.execute(
+      f"""
+        UPDATE works SET lease_owner = :owner, lease_expires = :expires
+        WHERE openalex_id IN (
+          SELECT openalex_id FROM works
+          WHERE {CLAIM_STAGES[stage]} {journal_filter}
+            AND (lease_expires IS NULL OR lease_expires < :now)
+          LIMIT :limit
+        )
+        RETURNING openalex_id, pdf_local_path
+      """,
+      {
+        "owner": owner,
+        "expires": now + lease_seconds,
+        "now": now,
+        "status": status,
+        "journal_id": journal_id,
+        "limit": limit,
+      },
+    ).fetchall()
+
+
+def heartbeat(
+  conn: sqlite3.Connection, owner: str, lease_seconds: float = LEASE_SECONDS
+) -> int:
+  """Extends all live leases of `owner`, returns how many are still held."""
+  now = time.time()
+  with conn:
+    return conn.execute(
+      """
+        UPDATE works SET lease_expires = ?
+        WHERE lease_owner = ? AND lease_expires >= ?
+      """,
+      (now + lease_seconds, owner, now),
+    ).rowcount
+
+
+def release_works(
+  conn: sqlite3.Connection, owner: str, openalex_ids: list[str] | None = None
+) -> None:
+  """Drops the leases of `owner`, all of them if no ids are given."""
+  with conn:
+    if openalex_ids is None:
+      conn.execute(
+        "UPDATE works SET lease_owner = NULL, lease_expires = NULL "
+        "WHERE lease_owner = ?",
+        (owner,),
+      )
+    else:
+      conn.executemany(
+        "UPDATE works SET lease_owner = NULL, lease_expires = NULL "
+        "WHERE lease_owner = ? AND openalex_id = ?",
+        [(owner, openalex_id) for openalex_id in openalex_ids],
+      )
+
+
+class LeaseHeartbeat:
+  """Keeps the leases of `owner` alive while a batch is being processed."""
+
+  def __init__(self, owner: str, lease_seconds: float = LEASE_SECONDS):
+    self.owner = owner
+    self.lease_seconds = lease_seconds
+    self.task: asyncio.Task | None = None
+
+  async def __aenter__(self):
+    self.task = asyncio.create_task(self._run())
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, _):
+    if self.task:
+      self.task.cancel()
+      try:
+        await self.task
+      except asyncio.CancelledError:
+        pass
+
+  def _beat(self) -> int:
+    with connect() as conn:
+      return heartbeat(conn, self.owner, self.lease_seconds)
+
+  async def _run(self) -> None:
+    while True:
+      await asyncio.sleep(self.lease_seconds / 3)
+      try:
+        await asyncio.to_thread(self._beat)
+      except sqlite3.Error as e:
+        print(f"Lease heartbeat for {self.owner} failed: {e}")
+
+
+def load_harvest_state(
+  journal_id: str, min_year: int, pdf: bool, year: int = 0
+) -> dict | None:
+  with connect() as conn:
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    row = cursor.execute(
+      """
+        SELECT filter_hash, cursor, pages, done FROM harvest_state
+        WHERE journal_id = ? AND min_year = ? AND pdf = ? AND year = ?
+      """,
+      (journal_id, min_year, int(pdf), year),
+    ).fetchone()
+  return dict(row) if row else None
+
+
+def save_harvest_state(
+  journal_id: str,
+  min_year: int,
+  pdf: bool,
+  filter_hash: str,
+  cursor: str | None,
+  pages: int,
+  done: bool = False,
+  year: int = 0,
+  conn: sqlite3.Connection | None = None,
+) -> None:
+  """Upserts a cursor checkpoint, on `conn` without committing if one is given."""
+  if conn is None:
+    with connect() as conn:
+      save_harvest_state(
+        journal_id, min_year, pdf, filter_hash, cursor, pages, done, year, conn
+      )
+    return
+  conn.execute(
+    """
+      INSERT INTO harvest_state (
+        journal_id, min_year, pdf, year, filter_hash, cursor, pages, done
+      ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+      ON CONFLICT(journal_id, min_year, pdf, year) DO UPDATE SET
+        filter_hash = excluded.filter_hash,
+        cursor = excluded.cursor,
+        pages = excluded.pages,
+        done = excluded.done,
+        updated_at = CURRENT_TIMESTAMP;
+    """,
+    (journal_id, min_year, int(pdf), year, filter_hash, cursor, pages, int(done)),
+  )
+
+
 TO_TEI_QUERY = """ UPDATE works 
 SET tei_process_status = ?, tei_local_path = ? 
 WHERE openalex_id = ?; """
@@ -1,7 +1,19 @@
 import requests
-from database import DB_DIR
+import aiohttp
+import asyncio
+import random
+import time
+import datetime
+import email.utils
+import hashlib
+from database import (
+  DB_DIR,
+  load_harvest_state,
+  migrate,
+  save_harvest_state,
+)
 from dotenv import load_dotenv
-from typing import List, Generator, Any
+from typing import List, Generator, AsyncGenerator, Any
 import os
 
 env = load_dotenv()
@@ -12,9 +24,58 @@ OPEN_ALEX_API_URL = "https://api.openalex.org/works"
 
 INDEX_DB = os.path.join(DB_DIR, "openalex_jsonl")
 
+# openalex allows 10 requests per second in the polite pool (mailto set)
+POLITE_POOL_RPS = 10
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# longest Retry-After that is waited for, longer ones fall back to the backoff
+MAX_RETRY_AFTER = 600
+
+
+def _build_filter(
+  journal_ids: List[str],
+  min_year: int,
+  pdf: bool,
+  year: int | None = None,
+  open_ended: bool = False,
+) -> str:
+  if year and open_ended:
+    # early view articles are dated to next year or later
+    year_filter = f"publication_year:>{year - 1}"
+  elif year:
+    year_filter = f"publication_year:{year}"
+  else:
+    year_filter = f"publication_year:>{min_year}"
+  return (
+    "primary_location.source.id:"
+    f"{'|'.join(journal_ids)}"
+    ",open_access.is_oa:true"
+    f",has_content.pdf:{pdf}"
+    f",{year_filter}"
+    ",type:article"
+  )
+
+
+def _filter_hash(filter: str) -> str:
+  return hashlib.sha256(filter.encode()).hexdigest()[:16]
+
+
+def _checkpoint(checkpoints: list | None, **state) -> None:
+  # with a checkpoint list the consumer commits the state together with the works
+  if checkpoints is None:
+    save_harvest_state(**state)
+  else:
+    checkpoints.append(state)
+
 
 def get_journal_by_id(
-  journal_ids: List[str], per_page: int, min_year: int, pdf:bool=True, _cursor=None
+  journal_ids: List[str],
+  per_page: int,
+  min_year: int,
+  pdf: bool = True,
+  _cursor=None,
+  resume: bool = True,
+  checkpoints: list | None = None,
 ) -> Generator[Any, None, None]:
   """
   Docstring for get_journal_by_id
@@ -27,28 +88,43 @@ def get_journal_by_id(
   :type min_year: int
   :param pdf: if this is True, only openalex works endowed with an open access pdf link are fetched, note that openalex does not necessarily find all pdfs, for example PeDocs is not accessible.
   :type pdf: bool
+  :param _cursor: start from this cursor instead of the stored harvest state.
+  :type _cursor: str | None
+  :param resume: continue from the last committed cursor in the harvest_state table. The cursor of a page is only committed once all of its works have been consumed, so a restart fetches no page twice. A finished query yields nothing until resume=False is passed.
+  :type resume: bool
+  :param checkpoints: if given, harvest states are appended to this list instead of being written, so that the consumer can commit them in the same transaction as the works (see insert_works_bulk).
+  :type checkpoints: list | None
   :return: 
   :rtype: Generator[Any, None, None]
   """
-  cursor = "*" if not _cursor else _cursor
   if isinstance(journal_ids, str):
     journal_ids = [journal_ids]
+  query_filter = _build_filter(journal_ids, min_year, pdf)
+  filter_hash = _filter_hash(query_filter)
+  state_key = "|".join(journal_ids)
+
+  migrate()
+  cursor = "*"
+  pages = 0
+  state = load_harvest_state(state_key, min_year, pdf) if resume else None
+  if _cursor:
+    cursor = _cursor
+  elif state and state["filter_hash"] == filter_hash:
+    if state["done"]:
+      print(f"Harvest for {state_key} already complete ({state['pages']} pages).")
+      return
+    cursor = state["cursor"] or "*"
+    pages = state["pages"]
+    print(f"Resuming {state_key} after {pages} pages.")
+
   while True:
     params = {
       "cursor": cursor,
       "per_page": per_page,
-      "filter": (
-        "primary_location.source.id:"
-        f"{'|'.join(journal_ids)}"
-        ",open_access.is_oa:true"
-        f",has_content.pdf:{pdf}"
-        f",publication_year:>{min_year}"
-        ",type:article"
-      ),
+      "filter": query_filter,
       "sort": "publication_year:desc",
       "mailto": f"{EMAIL_ADRESS}",
     }
-    print(f"Query: {params}")
     try:
       r = requests.get(OPEN_ALEX_API_URL, params=params, timeout=100)
       r.raise_for_status()
@@ -61,17 +137,287 @@ def get_journal_by_id(
     results = payload.get("results", [])
     if not results:
       print("INFO: No more results found on this page. Stopping.")
+      _checkpoint(
+        checkpoints,
+        journal_id=state_key,
+        min_year=min_year,
+        pdf=pdf,
+        filter_hash=filter_hash,
+        cursor=None,
+        pages=pages,
+        done=True,
+      )
       break
 
     for w in results:
       yield w
 
+    pages += 1
     cursor = payload.get("meta", {}).get("next_cursor")
+    _checkpoint(
+      checkpoints,
+      journal_id=state_key,
+      min_year=min_year,
+      pdf=pdf,
+      filter_hash=filter_hash,
+      cursor=cursor,
+      pages=pages,
+      done=not cursor,
+    )
     if not cursor:
       print("No more works to fetch, stopping fetch.")
       break
 
 
+class RateLimiter:
+  """Spaces out requests so that all shards together stay below `rate` per second."""
+
+  def __init__(self, rate: float):
+    self.interval = 1.0 / rate
+    self.next_slot = 0.0
+    self.lock = asyncio.Lock()
+
+  async def acquire(self) -> None:
+    async with self.lock:
+      now = time.monotonic()
+      wait = self.next_slot - now
+      self.next_slot = max(now, self.next_slot) + self.interval
+    if wait > 0:
+      await asyncio.sleep(wait)
+
+  async def pause(self, seconds: float) -> None:
+    """Holds back the requests of all shards for `seconds`, e.g. for Retry-After."""
+    async with self.lock:
+      self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+
+def _retry_after(value: str | None) -> float | None:
+  """Seconds of a Retry-After header, given as seconds or as an http date."""
+  if not value:
+    return None
+  try:
+    seconds = float(value)
+  except ValueError:
+    try:
+      when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+      return None
+    seconds = (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+  seconds = max(0.0, seconds)
+  return seconds if seconds <= MAX_RETRY_AFTER else None
+
+
+async def _fetch_page(
+  session: aiohttp.ClientSession,
+  limiter: RateLimiter,
+  params: dict,
+  retries: int,
+  backoff: float,
+) -> dict | None:
+  for attempt in range(retries + 1):
+    await limiter.acquire()
+    retry_after = None
+    try:
+      async with session.get(OPEN_ALEX_API_URL, params=params) as r:
+        if r.status in RETRY_STATUS:
+          retry_after = _retry_after(r.headers.get("Retry-After"))
+          raise aiohttp.ClientResponseError(
+            r.request_info,
+            r.history,
+            status=r.status,
+            message=f"retryable status (Retry-After: {retry_after})",
+          )
+        r.raise_for_status()
+        return await r.json()
+    except aiohttp.ClientResponseError as e:
+      if e.status not in RETRY_STATUS:
+        print(f"An API request error occured: {e}")
+        return None
+      error = e
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      error = e
+    if attempt < retries:
+      if retry_after is not None:
+        # the server said when, the other shards wait as well
+        delay = retry_after
+        await limiter.pause(delay)
+      else:
+        delay = backoff * 2**attempt + random.uniform(0, backoff)
+      print(f"Retrying in {delay:.1f}s after error: {error}")
+      await asyncio.sleep(delay)
+  print(f"Giving up on page after {retries} retries: {params.get('filter')}")
+  return None
+
+
+async def _harvest_shard(
+  session: aiohttp.ClientSession,
+  limiter: RateLimiter,
+  journal_id: str,
+  year: int,
+  min_year: int,
+  per_page: int,
+  pdf: bool,
+  out: asyncio.Queue,
+  retries: int,
+  backoff: float,
+  resume: bool,
+  open_ended: bool = False,
+) -> None:
+  query_filter = _build_filter([journal_id], min_year, pdf, year, open_ended)
+  filter_hash = _filter_hash(query_filter)
+  cursor = "*"
+  pages = 0
+  state = None
+  if resume:
+    state = await asyncio.to_thread(load_harvest_state, journal_id, min_year, pdf, year)
+  if state and state["filter_hash"] == filter_hash:
+    if state["done"]:
+      return
+    cursor = state["cursor"] or "*"
+    pages = state["pages"]
+
+  n_works = 0
+  while cursor:
+    params = {
+      "cursor": cursor,
+      "per_page": per_page,
+      "filter": query_filter,
+      "mailto": f"{EMAIL_ADRESS}",
+    }
+    payload = await _fetch_page(session, limiter, params, retries, backoff)
+    if payload is None:
+      print(f"Shard {journal_id}/{year} stopped with cursor: {cursor}")
+      return
+    results = payload.get("results", [])
+    cursor = payload.get("meta", {}).get("next_cursor") if results else None
+    pages += 1 if results else 0
+    # the checkpoint is written by the consumer once the page has been consumed
+    await out.put((journal_id, year, filter_hash, cursor, pages, results))
+    n_works += len(results)
+  if n_works:
+    print(f"Shard {journal_id}/{year}: fetched {n_works} works")
+
+
+async def harvest_journals_async(
+  journal_ids: List[str],
+  per_page: int,
+  min_year: int,
+  pdf: bool = True,
+  max_year: int | None = None,
+  concurrency: int = 8,
+  rate: float = POLITE_POOL_RPS,
+  retries: int = 5,
+  backoff: float = 1.0,
+  resume: bool = True,
+  checkpoints: list | None = None,
+) -> AsyncGenerator[Any, None]:
+  """
+  Concurrent counterpart of get_journal_by_id.
+
+  The query is split into one shard per (journal, publication_year) and one
+  shard per journal for everything dated after `max_year`, each shard is
+  paged with its own cursor and up to `concurrency` shards run at the same time on
+  a shared session. Failed pages are retried with exponential backoff, a shard that
+  keeps failing is dropped without stopping the others. Every shard is checkpointed
+  in the harvest_state table after its page has been consumed, finished shards are
+  skipped on the next run.
+
+  :param journal_ids: Journal ids given in the openalex-format.
+  :type journal_ids: List[str]
+  :param per_page: the amount of works fetched per page, at most 200.
+  :type per_page: int
+  :param min_year: only works with publication_year > min_year are fetched
+  :type min_year: int
+  :param pdf: only fetch works endowed with an open access pdf link
+  :type pdf: bool
+  :param max_year: last publication year with a shard of its own, later years
+    share one shard; defaults to the current year
+  :type max_year: int | None
+  :param concurrency: number of cursors paged in parallel
+  :type concurrency: int
+  :param rate: maximum requests per second over all shards
+  :type rate: float
+  :param resume: continue every shard from its last committed cursor
+  :type resume: bool
+  :param checkpoints: collect shard states here instead of writing them
+  :type checkpoints: list | None
+  :return: the same openalex work objects as get_journal_by_id
+  :rtype: AsyncGenerator[Any, None]
+  """
+  if isinstance(journal_ids, str):
+    journal_ids = [journal_ids]
+  if max_year is None:
+    max_year = datetime.date.today().year
+
+  await asyncio.to_thread(migrate)
+  shards: asyncio.Queue = asyncio.Queue()
+  for journal_id in journal_ids:
+    # works dated after max_year, checkpointed as year max_year + 1
+    shards.put_nowait((journal_id, max_year + 1, True))
+    for year in range(max_year, min_year, -1):
+      shards.put_nowait((journal_id, year, False))
+
+  out: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+  limiter = RateLimiter(rate)
+  done = object()
+
+  async def worker(session: aiohttp.ClientSession) -> None:
+    while True:
+      try:
+        journal_id, year, open_ended = shards.get_nowait()
+      except asyncio.QueueEmpty:
+        break
+      try:
+        await _harvest_shard(
+          session,
+          limiter,
+          journal_id,
+          year,
+          min_year,
+          per_page,
+          pdf,
+          out,
+          retries,
+          backoff,
+          resume,
+          open_ended,
+        )
+      except Exception as e:
+        print(f"Shard {journal_id}/{year} failed: {e}")
+    await out.put(done)
+
+  timeout = aiohttp.ClientTimeout(total=100)
+  connector = aiohttp.TCPConnector(limit=concurrency)
+  async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+    n_workers = min(concurrency, shards.qsize())
+    tasks = [asyncio.create_task(worker(session)) for _ in range(n_workers)]
+    try:
+      finished = 0
+      while finished < n_workers:
+        page = await out.get()
+        if page is done:
+          finished += 1
+          continue
+        journal_id, year, filter_hash, cursor, pages, results = page
+        for w in results:
+          yield w
+        _checkpoint(
+          checkpoints,
+          journal_id=journal_id,
+          min_year=min_year,
+          pdf=pdf,
+          filter_hash=filter_hash,
+          cursor=cursor,
+          pages=pages,
+          done=not cursor,
+          year=year,
+        )
+    finally:
+      for t in tasks:
+        t.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+
+
 def extract_pdf_locations(work: dict) -> dict[str, list[Any]]:
   """
   Concatenates all possible pdf locations if available.
@@ -86,7 +432,8 @@ def extract_pdf_locations(work: dict) -> dict[str, list[Any]]:
   others = work.get("locations", [])
   other_urls = [loc.get("pdf_url") for loc in others if loc.get("pdf_url")]
   pdf_links = [best] + [primary] + other_urls
-  return {"pdf_links": list(set(pdf_links))}
+  # keep the order stable so that re-harvested works compare equal in the upsert
+  return {"pdf_links": list(dict.fromkeys(pdf_links))}
 
 def get_github_files(owner, repo, path=""):
     url = f"https://api.github.com/repos/{owner}/{repo}/contents/{path}"
@@ -0,0 +1,351 @@
+import argparse
+import asyncio
+import json
+import time
+from dataclasses import dataclass, field
+
+import pipeline
+from analyse import ANALYSIS_UPSERT_QUERY, result_row
+from database import (
+  AsyncDBWriter,
+  DOWNLOAD_DIR_PDFS,
+  LEASE_SECONDS,
+  LeaseHeartbeat,
+  claim_works,
+  connect,
+  migrate,
+  new_worker_id,
+  share_duplicate_teis,
+  tei_for_pdf,
+)
+from pipeline import DOWNLOAD_STATUS_QUERY, claim_downloads, release_claims
+from process.analysis import analyse_tei
+from process.download import PDFDownloader
+from process.grobid import AsyncGrobidClient
+from store import TEI_DIR
+
+# a finished download keeps the lease, it is handed on to the grobid stage
+DOWNLOAD_HANDOFF_QUERY = """
+  UPDATE works
+  SET pdf_local_path = ?, pdf_download_status = 'DONE', lease_expires = ?
+  WHERE openalex_id = ?
+"""
+
+TEI_STATUS_QUERY = """
+  UPDATE works
+  SET tei_local_path = ?, tei_process_status = 'DONE',
+      lease_owner = NULL, lease_expires = NULL
+  WHERE openalex_id = ?
+"""
+
+
+@dataclass
+class StageConfig:
+  """Concurrency and batch sizes of the streaming pipeline."""
+
+  downloaders: int = 1  # browsers in the pool
+  browser_tabs: int = 4  # concurrent downloads per browser
+  grobid_workers: int = 16  # upper bound per server, the client adapts below it
+  grobid_servers: list[str] | None = None  # default from grobid_config.json
+  analysis_workers: int = 4
+  claim_batch: int = 20
+  poll_interval: float = 5.0
+  switch_time: int = 600
+  allow_rotate: bool = False
+  headless: bool = False
+
+
+@dataclass
+class StageStats:
+  fetched: int = 0
+  downloaded: int = 0
+  download_failed: int = 0
+  processed: int = 0
+  grobid_failed: int = 0
+  analysed: int = 0
+  started: float = field(default_factory=time.perf_counter)
+
+  def __str__(self) -> str:
+    elapsed = time.perf_counter() - self.started
+    return (
+      f"fetched={self.fetched} downloaded={self.downloaded} "
+      f"(failed {self.download_failed}) tei={self.processed} "
+      f"(failed {self.grobid_failed}) analysed={self.analysed} in {elapsed:.0f}s"
+    )
+
+
+class StreamingPipeline:
+  """
+  Runs fetch -> download -> grobid -> analysis as concurrent stages connected by
+  bounded queues. Every stage starts on an item as soon as the previous stage has
+  produced it, a full queue blocks its producer. Works are claimed with leases
+  from index.db, so several pipelines can run against the same database and a
+  restarted pipeline picks up where the last one stopped.
+  """
+
+  def __init__(
+    self,
+    journal_ids: list[str],
+    min_year: int | None = None,
+    config: StageConfig | None = None,
+    out_path: str | None = None,
+  ):
+    self.journal_ids = [j.upper() for j in journal_ids]
+    self.min_year = min_year
+    self.config = config or StageConfig()
+    self.out_path = out_path
+    self.owner = new_worker_id()
+    self.stats = StageStats()
+    c = self.config
+    self.download_q: asyncio.Queue = asyncio.Queue(
+      maxsize=2 * c.downloaders * c.browser_tabs
+    )
+    self.grobid_q: asyncio.Queue = asyncio.Queue(maxsize=2 * c.grobid_workers)
+    self.analysis_q: asyncio.Queue = asyncio.Queue(maxsize=2 * c.analysis_workers)
+    self.writer: AsyncDBWriter | None = None
+    # one line of out_path at a time, long lines take several writes
+    self.out_lock = asyncio.Lock()
+
+  async def _fetch(self) -> None:
+    if self.min_year is None:
+      return
+    self.stats.fetched = await pipeline.harvest_journals(
+      self.journal_ids, self.min_year
+    )
+
+  async def _feed(self, claim, queue: asyncio.Queue, upstream: list[asyncio.Task]):
+    """Claims work from the database until upstream is finished and nothing is left."""
+    while True:
+      upstream_done = all(t.done() for t in upstream)
+      claimed = 0
+      for journal_id in self.journal_ids:
+        rows = await asyncio.to_thread(claim, journal_id)
+        for row in rows:
+          await queue.put(row)
+        claimed += len(rows)
+      if not claimed:
+        if upstream_done:
+          return
+        await asyncio.sleep(self.config.poll_interval)
+
+  def _claim_downloads(self, journal_id: str):
+    return claim_downloads(self.owner, journal_id, self.config.claim_batch)
+
+  def _claim_grobid(self, journal_id: str):
+    with connect() as conn:
+      share_duplicate_teis(conn)
+      return claim_works(
+        conn, "grobid", self.owner, self.config.claim_batch, journal_id
+      )
+
+  def _known_tei(self, pdf_path: str) -> str | None:
+    with connect() as conn:
+      return tei_for_pdf(conn, pdf_path)
+
+  async def _download_worker(self, downloader: PDFDownloader) -> None:
+    while True:
+      openalex_id, urls = await self.download_q.get()
+      try:
+        path = None
+        for url in urls:
+          try:
+            path = await downloader.download_tiered(url)
+          except Exception as e:
+            print(f"[x] Download error for {openalex_id}: {e}")
+          if path:
+            break
+        if path:
+          self.stats.downloaded += 1
+          self.writer.post(
+            DOWNLOAD_HANDOFF_QUERY, (path, time.time() + LEASE_SECONDS, openalex_id)
+          )
+          tei = await asyncio.to_thread(self._known_tei, path)
+          if tei:
+            # same content as a work that was processed before
+            self.writer.post(TEI_STATUS_QUERY, (tei, openalex_id))
+            await self.analysis_q.put((openalex_id, tei))
+          else:
+            await self.grobid_q.put((openalex_id, path))
+        else:
+          self.stats.download_failed += 1
+          self.writer.post(DOWNLOAD_STATUS_QUERY, (None, "FAILED", openalex_id))
+      finally:
+        self.download_q.task_done()
+
+  async def _grobid_worker(self, client: AsyncGrobidClient) -> None:
+    while True:
+      openalex_id, pdf = await self.grobid_q.get()
+      try:
+        result = await client.process(pdf)
+        result.record(self.writer, [openalex_id])
+        if result.tei:
+          self.stats.processed += 1
+          await self.analysis_q.put((openalex_id, result.tei))
+        else:
+          self.stats.grobid_failed += 1
+          print(f"[x] Grobid {result.status} for {openalex_id}: {result.error}")
+      except Exception as e:
+        self.stats.grobid_failed += 1
+        print(f"[x] Grobid error for {openalex_id}: {e}")
+      finally:
+        self.grobid_q.task_done()
+
+  def _analyse(self, openalex_id: str, tei_path: str) -> dict:
+    result = analyse_tei(TEI_DIR.resolve(tei_path))
+    return {"openalex_id": openalex_id, "tei_local_path": tei_path, **result}
+
+  def _append_result(self, result: dict) -> None:
+    with open(self.out_path, "a") as f:
+      f.write(json.dumps(result) + "\n")
+
+  async def _analysis_worker(self) -> None:
+    while True:
+      openalex_id, tei_path = await self.analysis_q.get()
+      try:
+        result = await asyncio.to_thread(self._analyse, openalex_id, tei_path)
+        self.writer.post(
+          ANALYSIS_UPSERT_QUERY, result_row(openalex_id, tei_path, result)
+        )
+        self.stats.analysed += 1
+        if self.out_path:
+          async with self.out_lock:
+            await asyncio.to_thread(self._append_result, result)
+      except Exception as e:
+        print(f"[x] Analysis error for {openalex_id}: {e}")
+      finally:
+        self.analysis_q.task_done()
+
+  async def _wait(self, aw, workers: list[asyncio.Task]):
+    """Awaits `aw`, unless all workers of the stage have died in the meantime."""
+    task = asyncio.ensure_future(aw)
+    while True:
+      alive = [w for w in workers if not w.done()]
+      if not alive:
+        task.cancel()
+        raise RuntimeError("All workers of a pipeline stage stopped.")
+      done, _ = await asyncio.wait([task, *alive], return_when=asyncio.FIRST_COMPLETED)
+      if task in done:
+        return task.result()
+
+  async def _stage(
+    self, upstream: asyncio.Task, queue: asyncio.Queue, workers: list[asyncio.Task]
+  ) -> None:
+    """Finishes a stage once its upstream is done and its queue is drained."""
+    try:
+      await self._wait(upstream, workers)
+      await self._wait(queue.join(), workers)
+    finally:
+      for w in workers:
+        w.cancel()
+      await asyncio.gather(*workers, return_exceptions=True)
+
+  async def run(self) -> StageStats:
+    c = self.config
+    await asyncio.to_thread(migrate)
+    downloader = PDFDownloader(
+      DOWNLOAD_DIR_PDFS,
+      switch_time=c.switch_time,
+      allow_rotate=c.allow_rotate,
+      headless=c.headless,
+      lazy_browser=True,
+      browsers=c.downloaders,
+      tabs=c.browser_tabs,
+    )
+    tasks: list[asyncio.Task] = []
+    try:
+      async with (
+        downloader,
+        AsyncGrobidClient(
+          c.grobid_servers, max_concurrency=c.grobid_workers
+        ) as grobid_client,
+        AsyncDBWriter() as writer,
+        LeaseHeartbeat(self.owner),
+      ):
+        self.writer = writer
+        spawn = asyncio.create_task
+        analysis = [spawn(self._analysis_worker()) for _ in range(c.analysis_workers)]
+        grobid = [
+          spawn(self._grobid_worker(grobid_client))
+          for _ in range(c.grobid_workers * len(grobid_client.endpoints))
+        ]
+        downloads = [
+          spawn(self._download_worker(downloader))
+          for _ in range(c.downloaders * c.browser_tabs)
+        ]
+
+        fetch = spawn(self._fetch())
+        download_feed = spawn(
+          self._feed(self._claim_downloads, self.download_q, [fetch])
+        )
+        download_stage = spawn(self._stage(download_feed, self.download_q, downloads))
+        grobid_feed = spawn(
+          self._feed(self._claim_grobid, self.grobid_q, [download_stage])
+        )
+        grobid_stage = spawn(self._stage(grobid_feed, self.grobid_q, grobid))
+        analysis_stage = spawn(self._stage(grobid_stage, self.analysis_q, analysis))
+        tasks = [fetch, download_feed, download_stage, grobid_feed, grobid_stage]
+        tasks += [analysis_stage, *downloads, *grobid, *analysis]
+
+        await asyncio.gather(fetch, download_stage, grobid_stage, analysis_stage)
+    finally:
+      for t in tasks:
+        t.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+      await asyncio.to_thread(release_claims, self.owner)
+    print(f"Pipeline finished: {self.stats}")
+    return self.stats
+
+
+def resolve_journals(names: list[str]) -> list[str]:
+  """Accepts openalex source ids and the journal lists in pipeline, e.g. ED_JOURNALS."""
+  journal_ids: list[str] = []
+  for name in names:
+    journals = getattr(pipeline, name, None)
+    if isinstance(journals, list):
+      journal_ids.extend(journals)
+    else:
+      journal_ids.append(name)
+  return list(dict.fromkeys(j.upper() for j in journal_ids))
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(
+    description="Stream journals through fetch, download, grobid and analysis."
+  )
+  parser.add_argument(
+    "journals", nargs="+", help="openalex source ids or lists such as ED_JOURNALS"
+  )
+  parser.add_argument(
+    "--min-year", type=int, help="harvest works newer than this year first"
+  )
+  parser.add_argument("--downloaders", type=int, default=1, help="browsers")
+  parser.add_argument("--browser-tabs", type=int, default=4)
+  parser.add_argument("--grobid-workers", type=int, default=16)
+  parser.add_argument(
+    "--grobid-servers", nargs="+", help="grobid urls, default from grobid_config.json"
+  )
+  parser.add_argument("--analysis-workers", type=int, default=4)
+  parser.add_argument("--claim-batch", type=int, default=20)
+  parser.add_argument("--allow-rotate", action="store_true")
+  parser.add_argument("--headless", action="store_true")
+  parser.add_argument("--out", help="append analysis results to this jsonl file")
+  args = parser.parse_args()
+
+  config = StageConfig(
+    downloaders=args.downloaders,
+    browser_tabs=args.browser_tabs,
+    grobid_workers=args.grobid_workers,
+    grobid_servers=args.grobid_servers,
+    analysis_workers=args.analysis_workers,
+    claim_batch=args.claim_batch,
+    allow_rotate=args.allow_rotate,
+    headless=args.headless,
+  )
+  runner = StreamingPipeline(
+    resolve_journals(args.journals), args.min_year, config, args.out
+  )
+  asyncio.run(runner.run())
+
+
+if __name__ == "__main__":
+  main()
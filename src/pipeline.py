@@ -1,65 +1,200 @@
-from database import DB_PATH, DOWNLOAD_DIR_PDFS, DOWNLOAD_DIR_TEIS
-from fetch import extract_pdf_locations, get_journal_by_id
+from database import (
+  AsyncDBWriter,
+  connect,
+  DOWNLOAD_DIR_PDFS,
+  DOWNLOAD_DIR_TEIS,
+  LeaseHeartbeat,
+  claim_works,
+  get_work_urls,
+  new_worker_id,
+  release_works,
+  save_harvest_state,
+  share_duplicate_teis,
+)
+from fetch import extract_pdf_locations, get_journal_by_id, harvest_journals_async
+from process.browser_pool import DEFAULT_BROWSERS, TABS_PER_BROWSER
 from process.download import PDFDownloader
-from process.grobid import GrobidHandler
+from process.grobid import AsyncGrobidClient
+from process.hosts import rewrite_tandfonline, rewrite_waxmann
+from validate import validate_store
 import vpn
-from typing import Any
+from typing import Any, Iterable
 import sqlite3
+import time
 import json
 import asyncio
-from pypdf import PdfReader
-from pypdf.errors import PdfReadError
 from websockets.exceptions import ConnectionClosedError
 
 
-def insert_work_metadata_sql(work: dict[str, Any]) -> None:
-  """Inserts a single OpenAlex work's core metadata into the database."""
+WORK_UPSERT_QUERY = """
+  INSERT INTO works (
+    openalex_id, journal_id, journal_name, doi, publication_year, oa_urls
+  ) VALUES (?, ?, ?, ?, ?, ?)
+  ON CONFLICT(openalex_id) DO UPDATE SET
+    journal_id = excluded.journal_id,
+    journal_name = excluded.journal_name,
+    doi = excluded.doi,
+    publication_year = excluded.publication_year,
+    oa_urls = excluded.oa_urls
+  WHERE works.journal_id IS NOT excluded.journal_id
+    OR works.journal_name IS NOT excluded.journal_name
+    OR works.doi IS NOT excluded.doi
+    OR works.publication_year IS NOT excluded.publication_year
+    OR works.oa_urls IS NOT excluded.oa_urls;
+"""
+
+
+def _work_row(work: dict[str, Any]) -> tuple:
   pdf_locations = extract_pdf_locations(work)
 
   primary_loc = work.get("primary_location", {})
   source_info = primary_loc.get("source", {})
   journal_id = source_info.get("id")
   journal_name = source_info.get("display_name")
-  print(f"Inserting: {work['doi']} with {journal_id.split('/')[-1]}")
+  return (
+    work.get("id", "N/A").split("/")[-1],
+    journal_id.split("/")[-1],
+    journal_name,
+    work.get("doi", "N/A"),
+    work.get("publication_year"),
+    json.dumps(pdf_locations),
+  )
+
+
+def insert_work_metadata_sql(work: dict[str, Any]) -> None:
+  """Inserts a single OpenAlex work's core metadata into the database."""
+  row = _work_row(work)
+  print(f"Inserting: {row[3]} with {row[1]}")
   try:
-    with sqlite3.connect(DB_PATH) as conn:
+    with connect() as conn:
       cursor = conn.cursor()
-
-      cursor.execute(
-        """
-        INSERT INTO works (
-          openalex_id, journal_id, journal_name, doi, publication_year, oa_urls
-        ) VALUES (?, ?, ?, ?, ?, ?)
-        ON CONFLICT(openalex_id) DO UPDATE SET
-          journal_id = excluded.journal_id,
-          journal_name = excluded.journal_name,
-          doi = excluded.doi,
-          publication_year = excluded.publication_year,
-          oa_urls = excluded.oa_urls;
-        """,
-        (
-          work.get("id", "N/A").split("/")[-1],
-          journal_id.split("/")[-1],
-          journal_name,
-          work.get("doi", "N/A"),
-          work.get("publication_year"),
-          json.dumps(pdf_locations),
-        ),
-      )
+      cursor.execute(WORK_UPSERT_QUERY, row)
 
   except sqlite3.Error as e:
     print(f"Database error during insert: {e}")
 
 
+def _flush_works(
+  conn: sqlite3.Connection, rows: list[tuple], checkpoints: list | None
+) -> None:
+  with conn:
+    conn.executemany(WORK_UPSERT_QUERY, rows)
+    for state in checkpoints or []:
+      save_harvest_state(**state, conn=conn)
+  rows.clear()
+  if checkpoints is not None:
+    checkpoints.clear()
+
+
+def _flush_chunk(rows: list[tuple], checkpoints: list | None) -> None:
+  """_flush_works on a pooled connection, for calls from a worker thread."""
+  with connect() as conn:
+    _flush_works(conn, rows, checkpoints)
+
+
+def _report_ingest(n_rows: int, start: float) -> None:
+  elapsed = time.perf_counter() - start
+  rate = n_rows / elapsed if elapsed > 0 else float("inf")
+  print(f"Ingested {n_rows} works in {elapsed:.1f}s ({rate:.0f} rows/s)")
+
+
+def insert_works_bulk(
+  works: Iterable[dict[str, Any]],
+  chunk_size: int = 500,
+  checkpoints: list | None = None,
+) -> int:
+  """
+  Upserts works in chunks of `chunk_size` on a single connection, one transaction
+  per chunk. Pass the same `checkpoints` list to get_journal_by_id to commit the
+  harvest cursors together with the works they belong to:
+
+    checkpoints = []
+    works = get_journal_by_id(ids, 200, 2016, checkpoints=checkpoints)
+    insert_works_bulk(works, checkpoints=checkpoints)
+  """
+  start = time.perf_counter()
+  n_rows = 0
+  rows: list[tuple] = []
+  try:
+    with connect() as conn:
+      for work in works:
+        rows.append(_work_row(work))
+        if len(rows) >= chunk_size:
+          n_rows += len(rows)
+          _flush_works(conn, rows, checkpoints)
+      n_rows += len(rows)
+      _flush_works(conn, rows, checkpoints)
+  except sqlite3.Error as e:
+    print(f"Database error during bulk insert: {e}")
+  _report_ingest(n_rows, start)
+  return n_rows
+
+
+async def harvest_journals(
+  journal_ids: list[str],
+  min_year: int,
+  per_page: int = 200,
+  chunk_size: int = 500,
+  **kwargs,
+) -> int:
+  """
+  Harvests the journals concurrently and bulk inserts the works into the
+  database. The chunks are written on a worker thread, the harvest waits for
+  each one so its cursors are never saved ahead of the works.
+  """
+  start = time.perf_counter()
+  n_rows = 0
+  rows: list[tuple] = []
+  checkpoints: list = []
+  async for work in harvest_journals_async(
+    journal_ids, per_page, min_year, checkpoints=checkpoints, **kwargs
+  ):
+    rows.append(_work_row(work))
+    if len(rows) >= chunk_size:
+      n_rows += len(rows)
+      await asyncio.to_thread(_flush_chunk, rows, checkpoints)
+  n_rows += len(rows)
+  await asyncio.to_thread(_flush_chunk, rows, checkpoints)
+  _report_ingest(n_rows, start)
+  return n_rows
+
+
 def handle_url(url: str):
-  if "www.tandfonline.com" in url:
-    url = url.replace("/epdf/", "/pdf/")
-  return url
+  return rewrite_tandfonline(url) or url
 
 
 from tqdm import tqdm
 
 
+# writing a result also ends the lease taken in claim_downloads
+DOWNLOAD_STATUS_QUERY = """
+  UPDATE works
+  SET pdf_local_path = ?, pdf_download_status = ?,
+      lease_owner = NULL, lease_expires = NULL
+  WHERE openalex_id = ?
+"""
+
+
+def claim_downloads(
+  owner: str, journal_id: str | None, batch_size: int, which: str = "PENDING"
+) -> list[tuple[str, list[str]]]:
+  """Leases a batch of works with status `which` to `owner`, with their pdf urls."""
+  with connect() as conn:
+    claimed = claim_works(conn, "download", owner, batch_size, journal_id, status=which)
+    return list(
+      get_work_urls(conn, [openalex_id for openalex_id, _ in claimed]).items()
+    )
+
+
+def release_claims(owner: str) -> None:
+  """Returns works that were claimed but not finished to the queue right away."""
+  try:
+    with connect() as conn:
+      release_works(conn, owner)
+  except sqlite3.Error as e:
+    print(f"Failed to release leases of {owner}: {e}")
+
+
 async def download_batch_by_journal_async_(
   journal_id: str, batch_size=20, switch_time=30, allow_rotate=False
 ) -> bool:
@@ -70,51 +205,32 @@ async def download_batch_by_journal_async_(
     headless=False,
   )
 
+  owner = new_worker_id()
   try:
-    with sqlite3.connect(DB_PATH) as conn:
-      cursor = conn.cursor()
-      cursor.execute(
-        f"""
-          SELECT openalex_id, oa_urls 
-          FROM works 
-          WHERE pdf_download_status = "PENDING" 
-            AND journal_id = "{journal_id.upper()}" 
-          LIMIT {batch_size}
-        """
-      )
-      rows = cursor.fetchall()
-      if not rows:
-        return False
-      pbar = tqdm(total=len(rows), desc=f"Journal: {journal_id}", unit="pdf")
-      async with downloader:
-        for openalex_id, url_json in rows:
-          urls = json.loads(url_json)["pdf_links"]
-          urls = [u for u in urls if u is not None]
-          for url in urls:
-            path = None
-            if url is not None:
-              url = handle_url(url)
-              path = await downloader.download_browser(url)
-            if path:
-              with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                  """
-                    UPDATE works
-                    SET pdf_local_path = ?, pdf_download_status = 'DONE'
-                    WHERE openalex_id = ?
-                  """,
-                  (path, openalex_id),
-                )
-              break
-          pbar.update(1)
-      pbar.close()
-      return True
+    rows = await asyncio.to_thread(
+      claim_downloads, owner, journal_id.upper(), batch_size
+    )
+    if not rows:
+      return False
+    pbar = tqdm(total=len(rows), desc=f"Journal: {journal_id}", unit="pdf")
+    async with downloader, AsyncDBWriter() as writer, LeaseHeartbeat(owner):
+      for openalex_id, urls in rows:
+        for url in urls:
+          path = await downloader.download_browser(handle_url(url))
+          if path:
+            writer.post(DOWNLOAD_STATUS_QUERY, (path, "DONE", openalex_id))
+            break
+        pbar.update(1)
+    pbar.close()
+    return True
 
   except Exception as e:
     print(f"Exception when downloading batch: {e}")
-    pbar.close()
+    if "pbar" in locals():
+      pbar.close()
     return False
+  finally:
+    await asyncio.to_thread(release_claims, owner)
 
 
 async def download_batch_by_journal_async(
@@ -125,21 +241,14 @@ async def download_batch_by_journal_async(
     allow_rotate=allow_rotate,
     switch_time=switch_time,
     headless=False,
+    lazy_browser=True,
   )
 
+  owner = new_worker_id()
   try:
-    with sqlite3.connect(DB_PATH) as conn:
-      cursor = conn.cursor()
-      cursor.execute(
-        f"""
-          SELECT openalex_id, oa_urls 
-          FROM works 
-          WHERE pdf_download_status = "{which}" 
-            AND journal_id = "{journal_id.upper()}" 
-          LIMIT {batch_size}
-        """
-      )
-      rows = cursor.fetchall()
+    rows = await asyncio.to_thread(
+      claim_downloads, owner, journal_id.upper(), batch_size, which
+    )
 
     if not rows:
       print("no rows")
@@ -147,18 +256,15 @@ async def download_batch_by_journal_async(
 
     pbar = tqdm(total=len(rows), desc=f"Journal: {journal_id}", unit="pdf")
 
-    async with downloader:
-      for openalex_id, url_json in rows:
-        urls = json.loads(url_json).get("pdf_links", [])
-        urls = [u for u in urls if u is not None]
-
+    async with downloader, AsyncDBWriter() as writer, LeaseHeartbeat(owner):
+      for openalex_id, urls in rows:
         final_path = None
         status_to_write = "FAILED"
 
         for url in urls:
           try:
             # url = handle_url(url) TODO switch back
-            final_path = await downloader.download_browser(url)
+            final_path = await downloader.download_tiered(url)
             if final_path:
               status_to_write = "DONE"
               break
@@ -176,17 +282,7 @@ async def download_batch_by_journal_async(
             else:
               print(f"\n[x] Error: {e}")
 
-        with sqlite3.connect(DB_PATH) as conn:
-          print(f"Writing to database: {status_to_write}")
-          cursor = conn.cursor()
-          cursor.execute(
-            """
-              UPDATE works
-              SET pdf_local_path = ?, pdf_download_status = ?
-              WHERE openalex_id = ?
-            """,
-            (final_path, status_to_write, openalex_id),
-          )
+        writer.post(DOWNLOAD_STATUS_QUERY, (final_path, status_to_write, openalex_id))
 
         pbar.update(1)
 
@@ -198,22 +294,20 @@ async def download_batch_by_journal_async(
     if "pbar" in locals():
       pbar.close()
     return False
+  finally:
+    await asyncio.to_thread(release_claims, owner)
 
 
 async def download_task(downloader : PDFDownloader, semaphore, row, pbar):
   """A worker task that respects the concurrency limit."""
-  openalex_id, url_json = row
+  openalex_id, urls = row
   async with semaphore:
-    urls = json.loads(url_json).get("pdf_links", [])
-    urls = [u for u in urls if u is not None]
-
     final_path = None
     status_to_write = "FAILED"
 
     for url in urls:
       try:
-        # Use the existing browser instance in the downloader
-        final_path = await downloader.download_browser(url)
+        final_path = await downloader.download_tiered(url)
         if final_path:
           status_to_write = "DONE"
           break
@@ -224,7 +318,8 @@ async def download_task(downloader : PDFDownloader, semaphore, row, pbar):
     return (final_path, status_to_write, openalex_id)
 
 
-CONCURRENCY_LIMIT = 5
+# one download per browser tab
+CONCURRENCY_LIMIT = DEFAULT_BROWSERS * TABS_PER_BROWSER
 
 
 async def download_batch_by_journal_async_par(
@@ -235,16 +330,16 @@ async def download_batch_by_journal_async_par(
     allow_rotate=allow_rotate,
     switch_time=switch_time,
     headless=False,
+    lazy_browser=True,
+    browsers=DEFAULT_BROWSERS,
+    tabs=TABS_PER_BROWSER,
   )
 
-  # 1. Fetch data
-  with sqlite3.connect(DB_PATH) as conn:
-    cursor = conn.cursor()
-    cursor.execute(
-      "SELECT openalex_id, oa_urls FROM works WHERE pdf_download_status = ? AND journal_id = ? LIMIT ?",
-      (which, journal_id.upper(), batch_size),
-    )
-    rows = cursor.fetchall()
+  # 1. Claim data
+  owner = new_worker_id()
+  rows = await asyncio.to_thread(
+    claim_downloads, owner, journal_id.upper(), batch_size, which
+  )
 
   if not rows:
     return False
@@ -252,22 +347,17 @@ async def download_batch_by_journal_async_par(
   pbar = tqdm(total=len(rows), desc=f"Journal: {journal_id}", unit="pdf")
   semaphore = asyncio.Semaphore(CONCURRENCY_LIMIT)
 
-  # 2. Execute concurrently
-  async with downloader:
-    tasks = [download_task(downloader, semaphore, row, pbar) for row in rows]
-    results = await asyncio.gather(*tasks)
-
-  # 3. Batch Update Database
-  with sqlite3.connect(DB_PATH) as conn:
-    cursor = conn.cursor()
-    cursor.executemany(
-      """
-            UPDATE works
-            SET pdf_local_path = ?, pdf_download_status = ?
-            WHERE openalex_id = ?
-            """,
-      results,
-    )
+  try:
+    # 2. Execute concurrently
+    async with downloader, AsyncDBWriter() as writer, LeaseHeartbeat(owner):
+      tasks = [download_task(downloader, semaphore, row, pbar) for row in rows]
+      results = await asyncio.gather(*tasks)
+
+      # 3. Batch Update Database, on the writer's thread
+      for result in results:
+        writer.post(DOWNLOAD_STATUS_QUERY, result)
+  finally:
+    await asyncio.to_thread(release_claims, owner)
 
   pbar.close()
   return True
@@ -277,33 +367,47 @@ def download_batch(batch_size=20, switch_time=30, allow_rotate=True) -> bool:
   downloader = PDFDownloader(
     DOWNLOAD_DIR_PDFS, allow_rotate=allow_rotate, switch_time=switch_time
   )
+  owner = new_worker_id()
   try:
-    with sqlite3.connect(DB_PATH) as conn:
-      cursor = conn.cursor()
-      cursor.execute(
-        f"""
-          SELECT openalex_id, oa_urls FROM works WHERE pdf_download_status = "PENDING" LIMIT {batch_size}
-        """
-      )
-      rows = cursor.fetchall()
-      if len(rows) == 0:
-        return False
-      for id, url_json in rows:
-        url = json.loads(url_json)["pdf_links"][0]
-        path = asyncio.run(downloader.download(url))
-        if path is not None:
-          cursor.execute(
-            """
-              UPDATE works
-              SET pdf_local_path = ?, pdf_download_status = 'DONE'
-              WHERE openalex_id = ?
-            """,
-            (path, id),
-          )
-      return True
+    rows = claim_downloads(owner, None, batch_size)
+    if len(rows) == 0:
+      return False
+    for id, urls in rows:
+      if not urls:
+        continue
+      url = urls[0]
+      path = asyncio.run(downloader.download(url))
+      if path is not None:
+        with connect() as conn:
+          conn.execute(DOWNLOAD_STATUS_QUERY, (path, "DONE", id))
+    return True
   except Exception as e:
     print(f"Exception when downloading batch: {e}")
     return False
+  finally:
+    release_claims(owner)
+
+
+async def grobid_works(
+  rows: list[tuple[str, str]], client: AsyncGrobidClient
+) -> dict[str, int]:
+  """
+  Sends the pdfs of claimed (openalex_id, pdf_local_path) rows to grobid and
+  records every result as soon as it arrives. Works with the same content share
+  the pdf, it is processed once, pdfs with an up to date tei are not sent.
+  """
+  ids_by_pdf: dict[str, list[str]] = {}
+  for openalex_id, pdf in rows:
+    ids_by_pdf.setdefault(pdf, []).append(openalex_id)
+  counts: dict[str, int] = {}
+  async with AsyncDBWriter() as writer:
+    async for result in client.process_all(list(ids_by_pdf)):
+      result.record(writer, ids_by_pdf[result.pdf])
+      status = "CACHED" if result.cached else result.status
+      counts[status] = counts.get(status, 0) + 1
+      if result.error:
+        print(f"[x] Grobid {result.status} for {result.pdf}: {result.error}")
+  return counts
 
 
 def grobid_batch(
@@ -311,57 +415,41 @@ def grobid_batch(
   batch_size: int = 20,
   DDIRPDF: str = DOWNLOAD_DIR_PDFS,
   DDIRTEI: str = DOWNLOAD_DIR_TEIS,
+  force: bool = False,
 ) -> bool:
-  grobid_handler = GrobidHandler()
+  owner = new_worker_id()
   try:
-    with sqlite3.connect(DB_PATH) as conn:
-      cursor = conn.cursor()
-      cursor.execute(
-        f"""
-          SELECT openalex_id, pdf_local_path FROM works 
-          WHERE pdf_download_status = 'DONE' 
-            AND tei_process_status = "PENDING"
-            AND journal_id = "{journal_id.upper()}"
-          LIMIT {batch_size}
-        """
-      )
-      rows = cursor.fetchall()
-      if len(rows) == 0:
-        print("No rows")
-        return False
-      else:
-        # print(rows)
-        print(f"Handling {len(rows)} rows")
-      ids, filenames = zip(*rows)
-      try:
-        output = grobid_handler.process_files(
-          filenames, input_path=DDIRPDF, output_path=DDIRTEI
-        )
-      except Exception as e:
-        print(f"Error when processing files with grobid:  {e}")
-
-      for pdf, tei in output.items():
-        cursor.execute(
-          """
-            UPDATE works
-            SET tei_local_path = ?,
-                tei_process_status = 'DONE'
-            WHERE pdf_local_path = ?
-          """,
-          (tei, pdf),
-        )
+    with connect() as conn:
+      shared = share_duplicate_teis(conn)
+      if shared:
+        print(f"{shared} duplicate pdfs already have a tei")
+      rows = claim_works(conn, "grobid", owner, batch_size, journal_id.upper())
+    if len(rows) == 0:
+      print("No rows")
+      return False
+    else:
+      print(f"Handling {len(rows)} rows")
+
+    async def run():
+      async with (
+        AsyncGrobidClient(output_path=DDIRTEI, force=force) as client,
+        LeaseHeartbeat(owner),
+      ):
+        return await grobid_works(rows, client)
+
+    print(f"Grobid results: {asyncio.run(run())}")
     return True
 
   except Exception as e:
     print(f"Exception when batch processing with grobid: {e}")
     return False
+  finally:
+    release_claims(owner)
 
 
 def transform_url_by_journal(journal_id: str):
-  import re
-
   try:
-    with sqlite3.connect(DB_PATH) as conn:
+    with connect() as conn:
       cursor = conn.cursor()
       cursor.execute(
         "SELECT openalex_id, oa_urls FROM works WHERE journal_id = ?",
@@ -387,18 +475,9 @@ def transform_url_by_journal(journal_id: str):
         changed = False
 
         for url in links:
-          pattern = r"index\.php\?eID=download&id_artikel=(ART\d+)&uid=(\w+)"
-          match = re.search(pattern, url)
-
-          if match:
-            art_id, uid = match.groups()
-            new_url = (
-              f"https://www.waxmann.com/shop/download?"
-              f"tx_p2waxmann_download[action]=download&"
-              f"tx_p2waxmann_download[controller]=Zeitschrift&"
-              f"tx_p2waxmann_download[id_artikel]={art_id}&"
-              f"tx_p2waxmann_download[uid]={uid}"
-            )
+          new_url = rewrite_waxmann(url) if url else None
+
+          if new_url:
             transformed_links.append(new_url)
             changed = True
           else:
@@ -421,36 +500,9 @@ def transform_url_by_journal(journal_id: str):
     return False
 
 
-def prune_invalid_pdfs(batch_size: int = 200):
-  try:
-    with sqlite3.connect(DB_PATH) as conn:
-      cursor = conn.cursor()
-      cursor.execute(
-        "SELECT openalex_id, pdf_local_path FROM works WHERE pdf_download_status = 'DONE' LIMIT ?",
-        (batch_size,),
-      )
-      rows = cursor.fetchall()
-
-      if not rows:
-        return
-
-      for work_id, path in rows:
-        try:
-          if os.path.exists(path):
-            with open(path, "r") as f:
-              PdfReader.read(f)
-        except Exception as e:
-          print(f"Pruning invalid PDF at {path}: {e}")
-
-          cursor.execute(
-            "UPDATE works SET pdf_download_status = 'INVALID' WHERE openalex_id = ?",
-            (work_id,),
-          )
-
-      conn.commit()
-
-  except sqlite3.Error as e:
-    print(f"Database error: {e}")
+def prune_invalid_pdfs(batch_size: int = 500, full: bool = False) -> dict[str, int]:
+  """Marks DONE downloads that are no pdfs INVALID, see validate.validate_store."""
+  return validate_store(full=full, chunk_size=batch_size)
 
 
 SPED_JOURNALS = [
@@ -516,6 +568,12 @@ if __name__ == "__main__":
   # vpn.rotate_vpn_server()
   # for work in get_journal_by_id([journal], 100, 2016):
   #    insert_work_metadata_sql(work)
+  # checkpoints = []
+  # insert_works_bulk(
+  #   get_journal_by_id([journal], 200, 2016, checkpoints=checkpoints),
+  #   checkpoints=checkpoints,
+  # )
+  # asyncio.run(harvest_journals(ED_JOURNALS, 2016))
   # transform_url_by_journal(DE_JOURNALS[N])  
   asyncio.run(main(journal))
 
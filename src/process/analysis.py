@@ -1,17 +1,9 @@
-from lxml import etree
-from rapidfuzz import fuzz, process
-import re
 import requests
 
-FrontiersMatch = {
-  "Original datasets are available in a publically accessible repository": 6,
-  "Publicly available datasets were analyzed in this study": 5,
-  "The datasets presented in this study can be found in online repositories": 4,
-  "The original contributions presented in the study are included in the article/supplementary material": 3,
-  "The datasets presented in this article are not readily available because": 2,
-  "The data analyzed in this study was obtained from": 1,
-  "The raw data supporting the conclusions of this article will be made available by the authors, without undue reservation": 0,
-}
+from process.das import DASDecision, decide_das, match_template, templates_for
+from process.links import extract_links
+from process.xmlhandler import load_tei
+
 
 class OSFHandler:
   @classmethod
@@ -23,31 +15,17 @@ class OSFHandler:
     for file_enty in data["data"]:
       print(file_enty["attributes"]["name"])
 
-def extract_github_links(text) -> str:
-  github_regex = "(?:https?://)?github\\.com/[A-Za-z0-9_.-]+/[A-Za-z0-9_.-]+(?:/[A-Za-z0-9_.-]+)*"
-  pattern = re.compile(
-    fr"{github_regex}",
-    re.IGNORECASE,
-  )
-  raw_links = pattern.findall(text)
-  return raw_links
+def extract_github_links(text) -> list[str]:
+  return extract_links(text, ("github",))
 
-def extract_links_regex(text) -> str:
-  url_pattern = re.compile(
-    r"((?:https?://)?(?:www\.)?(?:github\.com|osf\.io|example\.com)[^\s]*(?:\s[^\s]+)*)",
-    re.IGNORECASE,
-  )
 
-  raw_links = url_pattern.findall(text)
+def extract_osf_links(text) -> list[str]:
+  return extract_links(text, ("osf",))
 
-  cleaned_links = []
-  for link in raw_links:
-    link = link.replace(" ", "")
-    if not link.startswith("http"):
-      link = "https://" + link
-    cleaned_links.append(link)
 
-  return cleaned_links
+def extract_links_regex(text) -> list[str]:
+  """Links to all known data and code repositories, see process.links."""
+  return extract_links(text)
 
 
 class FrontiersHandler:
@@ -67,34 +45,58 @@ class FrontiersHandler:
     if xmlpath is None:
       xmlpath = self.input_path
     try:
-      tree = etree.parse(xmlpath)
-      root = tree.getroot()
-      ns = {"tei": "http://www.tei-c.org/ns/1.0"}
-
-      availability_div = root.find(".//tei:div[@type='availability']", namespaces=ns)
-
-      if availability_div is not None:
-        return " ".join(availability_div.itertext()).strip()
-      else:
-        return None
+      return load_tei(xmlpath).das
     except Exception as e:
       print(f"Error extracting data: {e}")
       return None
 
   def analyze_das(self, text):
-    print("Analyzing: ", text)
-    if not text:
-      return None
-
-    choices = list(FrontiersMatch.keys())
-    match = process.extractOne(text, choices, scorer=fuzz.partial_ratio)
-
-    if match:
-      matched_choice, score, _ = match
-      # print(f"Score: {score}")
-      # print(f"Label: {FrontiersMatch[matched_choice]}")
-      return FrontiersMatch[matched_choice]
-    return None
+    return score_das(text)
+
+
+def score_das(text) -> int | None:
+  """Label of the best matching FrontiersMatch template, however poor the match."""
+  match = match_template(text)
+  return match.label if match else None
+
+
+# stored with every row of analysis_results, bump it when analyse_tei changes
+ANALYSER_VERSION = 7
+
+
+def das_result(decision: DASDecision) -> dict:
+  """The DAS fields of an analyse_tei result."""
+  return {
+    "das_score": decision.template,
+    "das_code": decision.code,
+    "das_tier": decision.tier,
+    "das_match_score": decision.score,
+    "das_templates": decision.templates,
+  }
+
+
+def analyse_tei(
+  tei_path: str, journal_id: str | None = None, classify: bool = True
+) -> dict:
+  """
+  The DAS and repository links of a tei, from the parsed document cache, and
+  the DAS code if the cheap tiers of process.das decide it with the templates
+  of the journal. Without `classify` the caller decides the DAS, e.g. for many
+  teis at once with decide_das_batch. `frontiers_score` is score_das, the
+  FrontiersMatch label whatever the journal.
+  """
+  doc = load_tei(tei_path)
+  das = doc.das
+  result = {
+    "das": das,
+    "frontiers_score": score_das(das) if das else None,
+    "das_links": extract_links_regex(das) if das else [],
+    "github_links": extract_github_links(doc.fulltext),
+    "osf_links": extract_osf_links(doc.fulltext),
+  }
+  if classify:
+    result.update(das_result(decide_das(das, templates_for(journal_id))))
+  return result
 
 if __name__ == "__main__":
   import os
@@ -0,0 +1,353 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterable
+
+from fake_useragent import UserAgent
+from selenium_driverless import webdriver
+from selenium_driverless.types.options import Options
+
+# seconds until a navigation has to start a download, and until it has to finish
+DOWNLOAD_BEGIN_TIMEOUT = 15
+DOWNLOAD_FINISH_TIMEOUT = 120
+# a completed download is moved out of the tmp dir right away, older files there
+# were left behind, e.g. by downloads that began after their tab gave up
+STALE_DOWNLOAD_AGE = DOWNLOAD_FINISH_TIMEOUT
+
+# chrome is mostly bound by its renderer processes, half the cores keeps the
+# machine responsive
+DEFAULT_BROWSERS = max(1, (os.cpu_count() or 2) // 2)
+TABS_PER_BROWSER = 4
+# a browser is restarted after this many downloads, long running chrome
+# instances get slower and leak memory
+RECYCLE_AFTER = 200
+HEALTH_CHECK_INTERVAL = 30
+HEALTH_CHECK_TIMEOUT = 5
+
+
+class DownloadTimeout(Exception):
+  """No download began in a tab, or it did not finish in time."""
+
+
+class DownloadTracker:
+  """
+  Follows the Browser.downloadWillBegin and Browser.downloadProgress events of a
+  browser. Chrome stores every download under its guid, a download is matched to
+  the tab that started it by the frame id, so concurrent tabs never pick up each
+  others files and the tmp dir is never listed. What chrome wrote of a download
+  that is given up on is removed at once, its guid is kept in `abandoned` in
+  case chrome writes it again before it is closed.
+  """
+
+  def __init__(self, tmpdir: str):
+    self.tmpdir = tmpdir
+    self.started: dict[str, asyncio.Future] = {}  # frame id -> guid
+    self.finished: dict[str, asyncio.Future] = {}  # guid -> final state
+    self.abandoned: set[str] = set()
+
+  def expect(self, frame_ids: Iterable[str]) -> asyncio.Future:
+    """Registers the frames of a tab before it navigates."""
+    fut = asyncio.get_running_loop().create_future()
+    for frame_id in frame_ids:
+      self.started[frame_id] = fut
+    return fut
+
+  def forget(self, frame_ids: Iterable[str]) -> None:
+    for frame_id in frame_ids:
+      self.started.pop(frame_id, None)
+
+  def on_will_begin(self, data: dict) -> None:
+    fut = self.started.get(data.get("frameId"))
+    if fut is None or fut.done():
+      return
+    # progress events may arrive before the waiter gets to them
+    self.finished[data["guid"]] = asyncio.get_running_loop().create_future()
+    fut.set_result(data["guid"])
+
+  def on_progress(self, data: dict) -> None:
+    if data.get("state") not in ("completed", "canceled"):
+      return
+    fut = self.finished.get(data.get("guid"))
+    if fut is not None and not fut.done():
+      fut.set_result(data["state"])
+
+  async def wait(
+    self,
+    started: asyncio.Future,
+    begin_timeout: float = DOWNLOAD_BEGIN_TIMEOUT,
+    finish_timeout: float = DOWNLOAD_FINISH_TIMEOUT,
+  ) -> str | None:
+    """
+    Guid of the completed download, None if it was canceled. Raises
+    asyncio.TimeoutError if no download started or it did not finish in time.
+    """
+    guid = await asyncio.wait_for(started, begin_timeout)
+    state = None
+    try:
+      state = await asyncio.wait_for(self.finished[guid], finish_timeout)
+    finally:
+      self.finished.pop(guid, None)
+      # timed out, cancelled by the caller or canceled by chrome
+      if state != "completed":
+        self.abandoned.add(guid)
+        remove_download(self.tmpdir, guid)
+    return guid if state == "completed" else None
+
+
+def remove_download(tmpdir: str, guid: str) -> None:
+  for name in (guid, f"{guid}.crdownload"):
+    try:
+      os.unlink(os.path.join(tmpdir, name))
+    except FileNotFoundError:
+      pass
+
+
+def sweep_downloads(tmpdir: str, abandoned: set[str]) -> int:
+  """
+  Removes the files of `abandoned` downloads and those older than
+  STALE_DOWNLOAD_AGE from a browser's tmp dir, returns how many.
+  """
+  removed = 0
+  stale_before = time.time() - STALE_DOWNLOAD_AGE
+  for entry in os.scandir(tmpdir):
+    try:
+      if not entry.is_file():
+        continue
+      guid = entry.name.removesuffix(".crdownload")
+      if guid in abandoned or entry.stat().st_mtime < stale_before:
+        os.unlink(entry.path)
+        removed += 1
+    except FileNotFoundError:
+      pass
+  return removed
+
+
+class BrowserSlot:
+  """
+  One chrome instance with its own download dir that runs up to `tabs` downloads
+  at the same time, each in its own tab. The browser is started on first use,
+  restarted when a health check fails and recycled after `recycle_after`
+  downloads once its running tabs have finished.
+  """
+
+  def __init__(
+    self,
+    tmpdir: str,
+    tabs: int = TABS_PER_BROWSER,
+    recycle_after: int = RECYCLE_AFTER,
+    headless: bool = False,
+  ):
+    self.tmpdir = tmpdir
+    Path(self.tmpdir).mkdir(parents=True, exist_ok=True)
+    self.tabs = tabs
+    self.recycle_after = recycle_after
+    self.headless = headless
+    self.geodata: Dict | None = None
+    self.browser = None
+    self.downloads: DownloadTracker | None = None
+    self.lock = asyncio.Lock()
+    self.idle = asyncio.Event()
+    self.idle.set()
+    self.active = 0
+    self.waiting = 0
+    self.served = 0
+    self.last_check = 0.0
+
+  async def start(self) -> None:
+    options = Options()
+    user_agent = UserAgent().random
+    print(f"Initializing browser in {self.tmpdir} with User-Agent: {user_agent}")
+
+    options.add_argument(f"--user-agent={user_agent}")
+    options.add_argument("--window-size=1920,1080")
+    if self.headless:
+      options.add_argument("--headless=new")
+
+    options.add_experimental_option(
+      "prefs",
+      {
+        "download.default_directory": self.tmpdir,
+        "plugins.always_open_pdf_externally": True,
+        "download.prompt_for_download": False,
+      },
+    )
+    self.browser = await webdriver.Chrome(options=options, timeout=20)
+
+    # allowAndName stores each download as tmpdir/<guid>, the events tell which
+    # tab it belongs to and when it is complete
+    self.downloads = DownloadTracker(self.tmpdir)
+    base = self.browser.base_target
+    await base.add_cdp_listener(
+      "Browser.downloadWillBegin", self.downloads.on_will_begin
+    )
+    await base.add_cdp_listener("Browser.downloadProgress", self.downloads.on_progress)
+    await base.execute_cdp_cmd(
+      "Browser.setDownloadBehavior",
+      {"behavior": "allowAndName", "downloadPath": self.tmpdir, "eventsEnabled": True},
+    )
+
+    if self.geodata:
+      if "lat" in self.geodata and "lon" in self.geodata:
+        await self.browser.execute_cdp_cmd(
+          "Emulation.setGeolocationOverride",
+          {
+            "latitude": self.geodata["lat"],
+            "longitude": self.geodata["lon"],
+            "accuracy": 100,
+          },
+        )
+      if "timezone" in self.geodata:
+        await self.browser.execute_cdp_cmd(
+          "Emulation.setTimezoneOverride", {"timezoneId": self.geodata["timezone"]}
+        )
+    self.served = 0
+    self.last_check = time.monotonic()
+
+  async def close(self) -> None:
+    if self.browser:
+      try:
+        await self.browser.quit()
+      except Exception as e:
+        print(f"Exception when quitting browser: {e}")
+    abandoned = self.downloads.abandoned if self.downloads else set()
+    self.browser = None
+    self.downloads = None
+    removed = await asyncio.to_thread(sweep_downloads, self.tmpdir, abandoned)
+    if removed:
+      print(f"Removed {removed} stale downloads from {self.tmpdir}")
+
+  async def healthy(self) -> bool:
+    if self.browser is None:
+      return False
+    try:
+      await self.browser.base_target.execute_cdp_cmd(
+        "Browser.getVersion", timeout=HEALTH_CHECK_TIMEOUT
+      )
+      return True
+    except Exception:
+      return False
+
+  @property
+  def load(self) -> int:
+    return self.active + self.waiting
+
+  async def _enter(self) -> None:
+    self.waiting += 1
+    try:
+      async with self.lock:
+        reason = None
+        if self.browser and self.served >= self.recycle_after:
+          reason = f"recycling after {self.served} downloads"
+        elif (
+          self.browser and time.monotonic() - self.last_check > HEALTH_CHECK_INTERVAL
+        ):
+          self.last_check = time.monotonic()
+          if not await self.healthy():
+            reason = "not responding"
+        if reason:
+          # holding the lock keeps new tabs out until the running ones are done
+          await self.idle.wait()
+          print(f"Restarting browser in {self.tmpdir}, {reason}")
+          await self.close()
+        if self.browser is None:
+          try:
+            await self.start()
+          except Exception:
+            await self.close()
+            raise
+        self.active += 1
+        self.idle.clear()
+    finally:
+      self.waiting -= 1
+
+  def _leave(self) -> None:
+    self.active -= 1
+    self.served += 1
+    if self.active == 0:
+      self.idle.set()
+
+  async def download(self, url: str) -> str | None:
+    """Path of the finished download in the tmp dir, None if it was canceled."""
+    await self._enter()
+    try:
+      downloads = self.downloads
+      tab = await self.browser.new_window(type_hint="tab", activate=False)
+      # the main frame of a tab has the id of its target
+      frame_ids = {tab.id}
+      try:
+        started = downloads.expect(frame_ids)
+        await tab.get(url, wait_load=False)
+        try:
+          guid = await downloads.wait(started)
+        except asyncio.TimeoutError:
+          raise DownloadTimeout("[x] Failure: Timeout.")
+        return os.path.join(self.tmpdir, guid) if guid else None
+      finally:
+        downloads.forget(frame_ids)
+        try:
+          await tab.close()
+        except Exception:
+          pass
+    finally:
+      self._leave()
+
+
+class BrowserPool:
+  """
+  `browsers` chrome instances with `tabs` tabs each. A download goes to the
+  instance with the fewest running tabs, at most browsers * tabs downloads run
+  at the same time.
+  """
+
+  def __init__(
+    self,
+    tmpdir: str,
+    browsers: int = 1,
+    tabs: int = TABS_PER_BROWSER,
+    recycle_after: int = RECYCLE_AFTER,
+    headless: bool = False,
+  ):
+    self.slots = [
+      BrowserSlot(os.path.join(tmpdir, str(i)), tabs, recycle_after, headless)
+      for i in range(browsers)
+    ]
+    self.size = browsers * tabs
+    self.capacity = asyncio.Semaphore(self.size)
+    self.drain_lock = asyncio.Lock()
+
+  async def start(self, geodata: Dict | None = None) -> None:
+    for slot in self.slots:
+      slot.geodata = geodata
+    await asyncio.gather(*(s.start() for s in self.slots if s.browser is None))
+
+  async def close(self) -> None:
+    await asyncio.gather(*(s.close() for s in self.slots))
+
+  @asynccontextmanager
+  async def drained(self) -> AsyncIterator[None]:
+    """
+    Waits until the running downloads are done and keeps new ones waiting for
+    the duration, e.g. to close the browsers while other workers use the pool.
+    """
+    async with self.drain_lock:
+      taken = 0
+      try:
+        for _ in range(self.size):
+          await self.capacity.acquire()
+          taken += 1
+        yield
+      finally:
+        for _ in range(taken):
+          self.capacity.release()
+
+  async def restart(self, geodata: Dict | None = None) -> None:
+    async with self.drained():
+      await self.close()
+      await self.start(geodata)
+
+  async def download(self, url: str) -> str | None:
+    async with self.capacity:
+      slot = min(self.slots, key=lambda s: s.load)
+      return await slot.download(url)
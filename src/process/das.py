@@ -0,0 +1,366 @@
+import asyncio
+import re
+from dataclasses import dataclass
+from typing import Sequence
+
+import numpy as np
+from rapidfuzz import fuzz, process
+
+from process.links import extract_links
+from process.llm import DAS_TASK, AsyncLLMClient
+
+FrontiersMatch = {
+  "Original datasets are available in a publically accessible repository": 6,
+  "Publicly available datasets were analyzed in this study": 5,
+  "The datasets presented in this study can be found in online repositories": 4,
+  "The original contributions presented in the study are included in the article/supplementary material": 3,
+  "The datasets presented in this article are not readily available because": 2,
+  "The data analyzed in this study was obtained from": 1,
+  "The raw data supporting the conclusions of this article will be made available by the authors, without undue reservation": 0,
+}
+
+
+@dataclass(frozen=True)
+class TemplateSet:
+  """
+  The standard sentences a publisher starts its data availability statements
+  with. `labels` maps each template to its label, `codes` maps a label to the
+  DAS_TASK code it stands for, None where the template alone does not tell.
+  A match scoring below `threshold` (rapidfuzz partial_ratio, 0-100) is left to
+  the next tier. Blanks of the publishers' templates ("[repository name]") are
+  cut, a template ends where the first one starts.
+
+  The thresholds are set by hand and uncalibrated, calibrate_threshold replaces
+  them once there are hand labelled statements of the publisher, see
+  experiment/test/calibrate_das.py.
+  """
+
+  name: str
+  labels: dict[str, int]
+  codes: dict[int, str | None]
+  threshold: float
+
+
+FRONTIERS = TemplateSet(
+  "frontiers",
+  FrontiersMatch,
+  # "obtained from" is followed by anything from a public archive to a
+  # commercial panel
+  {6: "A", 5: "A", 4: "A", 3: "A", 2: "R", 1: None, 0: "R"},
+  # placeholder: statements of frontiers articles contain the template verbatim
+  # or with a broken word from grobid (>= 95), those of other publishers stay
+  # below 80. calibrate_das.py derives it from test_set_ground_truth.csv
+  threshold=90,
+)
+
+MDPI = TemplateSet(
+  "mdpi",
+  {
+    "The data presented in this study are openly available in": 6,
+    "Publicly available datasets were analyzed in this study. This data can be found here": 5,
+    "Data is contained within the article": 4,
+    "The data presented in this study are available in the article": 3,
+    "Restrictions apply to the availability of these data. Data was obtained from": 2,
+    "The data presented in this study are available on request from the corresponding author": 1,
+    "No new data were created or analyzed in this study. Data sharing is not applicable to this article": 0,
+  },
+  {6: "A", 5: "A", 4: "A", 3: "A", 2: "R", 1: "R", 0: "N"},
+  # placeholder: no hand labelled mdpi statements yet, that of frontiers
+  threshold=90,
+)
+
+SPRINGER = TemplateSet(
+  "springer",
+  {
+    "The datasets generated during and/or analysed during the current study are available in the": 5,
+    "All data generated or analysed during this study are included in this published article": 4,
+    "The datasets generated during and/or analysed during the current study are not publicly available due to": 3,
+    "The datasets generated during and/or analysed during the current study are available from the corresponding author on reasonable request": 2,
+    "The data that support the findings of this study are available from": 1,
+    "Data sharing not applicable to this article as no datasets were generated or analysed during the current study": 0,
+  },
+  # "available from" a third party, restricted or not
+  {5: "A", 4: "A", 3: "R", 2: "R", 1: None, 0: "N"},
+  # placeholder: the available and the on request template share their first 90
+  # characters, no hand labelled springer statements yet
+  threshold=95,
+)
+
+TAYLOR_FRANCIS = TemplateSet(
+  "taylor_francis",
+  {
+    "The data that support the findings of this study are openly available in": 5,
+    "The data that support the findings of this study are available within the article": 4,
+    "The data that support the findings of this study are available from the corresponding author": 3,
+    "Restrictions apply to the availability of these data": 2,
+    "Due to the nature of the research, due to": 1,
+    "Data sharing is not applicable to this article as no new data were created or analyzed in this study": 0,
+  },
+  # "available from the corresponding author" mostly continues "upon
+  # reasonable request", at times "in the repository"
+  {5: "A", 4: "A", 3: None, 2: "R", 1: "R", 0: "N"},
+  # placeholder: the templates share up to their first 63 characters, a
+  # statement needs more than the opening to reach 92. No labelled statements yet
+  threshold=92,
+)
+
+SAGE = TemplateSet(
+  "sage",
+  {
+    "The data that support the findings of this study are openly available in": 4,
+    "The data that support the findings of this study are available in the supplementary material of this article": 3,
+    "The data that support the findings of this study are available on request from the corresponding author": 2,
+    "The data that support the findings of this study are available from": 1,
+    "Data sharing not applicable to this article as no datasets were generated or analysed during the current study": 0,
+  },
+  {4: "A", 3: "A", 2: "R", 1: None, 0: "N"},
+  # placeholder: the same openings as taylor_francis, the same threshold
+  threshold=92,
+)
+
+TEMPLATE_SETS = {t.name: t for t in (FRONTIERS, MDPI, SPRINGER, TAYLOR_FRANCIS, SAGE)}
+
+# publisher of the journals in pipeline's lists, by openalex source id. Works of
+# other journals are matched against all TEMPLATE_SETS
+JOURNAL_TEMPLATES = {
+  "S2596526815": "frontiers",  # Frontiers in Education
+  "S9692511": "frontiers",  # Frontiers in Psychology
+  "S2738008561": "mdpi",  # Education Sciences
+  "S166722454": "springer",  # Education and Information Technologies
+  "S4210201537": "springer",  # Int. J. of Educational Technology in Higher Education
+  "S187318745": "springer",  # Educational Psychology Review
+  "S114840262": "springer",  # Educational Technology Research and Development
+  "S94908168": "springer",  # Higher Education
+  "S40639335": "springer",  # Zeitschrift für Erziehungswissenschaft
+  "S162196882": "taylor_francis",  # Studies in Higher Education
+  "S133489141": "taylor_francis",  # Int. J. of Inclusive Education
+  "S136622136": "taylor_francis",  # European J. of Special Needs Education
+  "S38537713": "taylor_francis",  # Int. J. of Disability, Development and Education
+  "S26220619": "sage",  # Journal of Special Education
+  "S27228949": "sage",  # Perspectives on Psychological Science
+}
+
+
+def templates_for(journal_id: str | None) -> list[TemplateSet]:
+  """The template sets a statement of the journal is matched against."""
+  name = JOURNAL_TEMPLATES.get(journal_id.upper()) if journal_id else None
+  return [TEMPLATE_SETS[name]] if name else list(TEMPLATE_SETS.values())
+
+
+def _as_list(templates: TemplateSet | Sequence[TemplateSet]) -> list[TemplateSet]:
+  return [templates] if isinstance(templates, TemplateSet) else list(templates)
+
+
+@dataclass(frozen=True)
+class TemplateMatch:
+  templates: TemplateSet
+  label: int
+  score: float
+
+
+def template_scores(
+  texts: Sequence[str],
+  templates: Sequence[str],
+  workers: int = -1,
+  score_cutoff: float = 0,
+) -> np.ndarray:
+  """
+  Score matrix of statements (rows) against templates (columns), partial_ratio
+  computed by one rapidfuzz cdist call on `workers` threads, -1 for all cores.
+  A statement shorter than a template is scored with ratio against it, else
+  partial_ratio finds the statement inside the template, "Data are available"
+  would score 100. Scores below `score_cutoff` are 0, which saves most of the
+  time of partial_ratio.
+  """
+  scores = process.cdist(
+    texts,
+    templates,
+    scorer=fuzz.partial_ratio,
+    dtype=np.float32,
+    workers=workers,
+    score_cutoff=score_cutoff,
+  )
+  short = (
+    np.array([len(t) for t in texts])[:, None]
+    < np.array([len(t) for t in templates])[None, :]
+  )
+  rows = np.flatnonzero(short.any(axis=1))
+  if rows.size:
+    ratios = process.cdist(
+      [texts[i] for i in rows],
+      templates,
+      scorer=fuzz.ratio,
+      dtype=np.float32,
+      workers=workers,
+      score_cutoff=score_cutoff,
+    )
+    scores[rows] = np.where(short[rows], ratios, scores[rows])
+  return scores
+
+
+def match_templates(
+  texts: Sequence[str | None],
+  templates: TemplateSet | Sequence[TemplateSet] = FRONTIERS,
+  workers: int = -1,
+  score_cutoff: float = 0,
+) -> list[TemplateMatch | None]:
+  """
+  The best matching template of `templates` for each statement, in one batch.
+  None for statements without a template scoring `score_cutoff`.
+  """
+  owners = [(t, label) for t in _as_list(templates) for label in t.labels.values()]
+  choices = [text for t in _as_list(templates) for text in t.labels]
+  rows = [i for i, text in enumerate(texts) if text]
+  matches: list[TemplateMatch | None] = [None] * len(texts)
+  if not rows or not choices:
+    return matches
+  scores = template_scores([texts[i] for i in rows], choices, workers, score_cutoff)
+  for i, row, best in zip(rows, scores, scores.argmax(axis=1), strict=True):
+    if score_cutoff and row[best] < score_cutoff:
+      continue
+    matches[i] = TemplateMatch(*owners[best], round(float(row[best]), 2))
+  return matches
+
+
+def match_template(
+  text: str | None, templates: TemplateSet | Sequence[TemplateSet] = FRONTIERS
+) -> TemplateMatch | None:
+  """The best matching template of `templates` for a statement and its score."""
+  return match_templates([text], templates, workers=1)[0]
+
+
+def calibrate_threshold(
+  templates: TemplateSet,
+  labelled: list[tuple[str, int | None]],
+  min_precision: float = 0.98,
+) -> float:
+  """
+  The lowest threshold at which matches of `templates` on hand labelled
+  statements, (text, label or None for no template), have at least
+  `min_precision`. The lower the threshold the fewer statements reach the llm.
+  See experiment/test/calibrate_das.py.
+  """
+  texts, labels = zip(*labelled, strict=True) if labelled else ((), ())
+  matches = match_templates(texts, templates)
+  scored = sorted(
+    (
+      (m.score, m.label == label) for m, label in zip(matches, labels, strict=True) if m
+    ),
+    reverse=True,
+  )
+  threshold, correct = 100.0, 0
+  for n, (score, right) in enumerate(scored, 1):
+    correct += right
+    # ties are all above a threshold or none is
+    if n < len(scored) and scored[n][0] == score:
+      continue
+    if correct / n >= min_precision:
+      threshold = score
+  return threshold
+
+
+# phrases deciding a statement on their own, a statement hitting more than one
+# code is left to the llm
+DAS_PHRASES = {
+  "R": re.compile(
+    r"\b(?:(?:up)?on (?:reasonable |justified |written )?request|"
+    r"from the (?:corresponding|first|senior|last) author|"
+    r"not (?:be )?(?:publicly |readily |openly )?(?:available|shared))\b",
+    re.IGNORECASE,
+  ),
+  "N": re.compile(
+    r"\b(?:no (?:new )?(?:data|datasets?) (?:were|was|have been) (?:generated|created|collected|analy[sz]ed)|"
+    r"data sharing (?:is )?not applicable)\b",
+    re.IGNORECASE,
+  ),
+}
+
+
+def match_phrases(text: str) -> str | None:
+  """The DAS_TASK code of a statement from repository links and DAS_PHRASES."""
+  codes = {code for code, regex in DAS_PHRASES.items() if regex.search(text)}
+  if extract_links(text):
+    codes.add("A")
+  return codes.pop() if len(codes) == 1 else None
+
+
+@dataclass(frozen=True)
+class DASDecision:
+  code: str | None  # of DAS_TASK, None without a statement or a deciding tier
+  tier: str  # template, phrase, llm, none (no statement) or undecided
+  template: int | None = None  # label of the best template, however poor
+  score: float | None = None  # its partial_ratio
+  templates: str | None = None  # name of its TemplateSet, the label's meaning
+
+
+def decide_das_batch(
+  texts: Sequence[str | None],
+  templates: TemplateSet | Sequence[TemplateSet] = FRONTIERS,
+  workers: int = -1,
+) -> list[DASDecision]:
+  """
+  The cheap tiers of the DAS classifier, a confident template match and then
+  DAS_PHRASES. A statement neither decides is "undecided" and for the llm. The
+  templates are scored for all statements at once, see template_scores, first
+  only the scores reaching the lowest threshold of `templates`, then in full
+  for the statements below it, so every statement keeps its best template.
+  """
+  templates = _as_list(templates)
+  cutoff = min((t.threshold for t in templates), default=0)
+  matches = match_templates(texts, templates, workers, cutoff)
+  weak = [i for i, m in enumerate(matches) if m is None and texts[i]]
+  rescored = match_templates([texts[i] for i in weak], templates, workers)
+  for i, match in zip(weak, rescored, strict=True):
+    matches[i] = match
+  decisions = []
+  for text, match in zip(texts, matches, strict=True):
+    if not text or not text.strip():
+      decisions.append(DASDecision(None, "none"))
+      continue
+    details = (match.label, match.score, match.templates.name) if match else ()
+    if match and match.score >= match.templates.threshold:
+      code = match.templates.codes.get(match.label)
+      if code is not None:
+        decisions.append(DASDecision(code, "template", *details))
+        continue
+    code = match_phrases(text)
+    tier = "undecided" if code is None else "phrase"
+    decisions.append(DASDecision(code, tier, *details))
+  return decisions
+
+
+def decide_das(
+  text: str | None, templates: TemplateSet | Sequence[TemplateSet] = FRONTIERS
+) -> DASDecision:
+  """decide_das_batch of a single statement."""
+  return decide_das_batch([text], templates, workers=1)[0]
+
+
+async def classify_das(
+  texts: list[str | None],
+  llm: AsyncLLMClient | None = None,
+  templates: TemplateSet | Sequence[TemplateSet] = FRONTIERS,
+) -> list[DASDecision]:
+  """
+  DAS_TASK codes of statements, decided by the cheapest tier that is sure:
+  decide_das_batch first and the llm only for what is still undecided. Without
+  `llm` those stay undecided.
+  """
+  decisions = await asyncio.to_thread(decide_das_batch, texts, templates)
+  return await resolve_with_llm(decisions, texts, llm)
+
+
+async def resolve_with_llm(
+  decisions: list[DASDecision], texts: list[str | None], llm: AsyncLLMClient | None
+) -> list[DASDecision]:
+  """Asks `llm` for the undecided of `decisions`, the statements are `texts`."""
+  todo = [i for i, d in enumerate(decisions) if d.tier == "undecided"]
+  if llm is None or not todo:
+    return decisions
+  codes = await llm.classify([texts[i] for i in todo], DAS_TASK)
+  decisions = list(decisions)
+  for i, code in zip(todo, codes, strict=True):
+    if code in DAS_TASK.codes:
+      d = decisions[i]
+      decisions[i] = DASDecision(code, "llm", d.template, d.score, d.templates)
+  return decisions
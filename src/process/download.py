@@ -4,22 +4,39 @@ import os
 import aiohttp
 import aiofiles
 from pathlib import Path
-from typing import Dict, List, Set, Optional
+from typing import Dict, List, Optional
 import hashlib
-from selenium_driverless import webdriver
-from selenium_driverless.types.options import Options
 from fake_useragent import UserAgent
 from database import DOWNLOAD_DIR_PDFS
 import uuid
-from pypdf import PdfReader
-from pypdf.errors import PdfReadError
 from vpn import rotate_vpn_server
+from process.browser_pool import BrowserPool, DownloadTimeout, RECYCLE_AFTER
+from process import hosts
+from process.hosts import HostProfileStore, host_of
+from store import PDFStore
+from validate import (
+  HTML,
+  MISSING,
+  NOT_PDF,
+  PDF_SNIFF_BYTES,
+  looks_like_pdf,
+  parse,
+  sniff,
+)
 
 G = "\033[92m"
 RESET = "\033[0m"
 R = "\033[91m"
 Y = "\033[93m"
 
+CHUNK_SIZE = 64 * 1024
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=120, sock_connect=15, sock_read=30)
+# statuses of a host turning the client away, not of a dead link
+BLOCKED_STATUSES = (401, 403, 429, 451)
+# downloads that are no pdf at all are dropped. Small pdfs or ones without a
+# trailer are often fine, the full parse of validate_store decides about them
+REJECT_AT_DOWNLOAD = (MISSING, HTML, NOT_PDF)
+
 
 class PDFDownloader:
   def __init__(
@@ -28,99 +45,63 @@ class PDFDownloader:
     switch_time: int = 600,
     allow_rotate: bool = True,
     headless: bool = False,
+    lazy_browser: bool = False,
+    profiles: HostProfileStore | None = None,
+    browsers: int = 1,
+    tabs: int = 1,
+    recycle_after: int = RECYCLE_AFTER,
+    store: PDFStore | None = None,
+    validate_full: bool = False,
   ):
     self.download_dir = download_dir
     path = Path(self.download_dir)
     path.mkdir(parents=True, exist_ok=True)
+    self.store = store or PDFStore(self.download_dir)
+    self.validate_full = validate_full  # parse every download that is a pdf
     self.tmpdir = os.path.join(self.download_dir, ".tmp")
     Path(self.tmpdir).mkdir(parents=True, exist_ok=True)
     self.headless = headless
     self.time_since_last_init = time.time()
     self.switch_time = switch_time
-    self.browser = None
+    # every browser of the pool downloads into its own dir below tmpdir
+    self.pool = BrowserPool(self.tmpdir, browsers, tabs, recycle_after, headless)
     self.allow_rotate = allow_rotate
+    self.lazy_browser = lazy_browser
+    self.session: aiohttp.ClientSession | None = None
+    self.profiles = profiles
+    self.exit_node = ""  # vpn location as "country-city", "" until rotated
+    self.rotating = asyncio.Lock()
 
   async def __aenter__(self):
-    await self._init_browser()
+    if self.profiles is None:
+      self.profiles = await asyncio.to_thread(HostProfileStore)
+    if not self.lazy_browser:
+      await self.pool.start()
+      self.time_since_last_init = time.time()
     return self
 
   async def __aexit__(self, exc_type, exc_value, _):
-    if self.browser:
-      try:
-        await self.browser.quit()
-        self.log("Browser closed successfully.")
-      except Exception as e:
-        self.log(f"Failed to close browser: {e}")
+    if self.session:
+      await self.session.close()
+      self.session = None
+    if self.profiles:
+      await self._flush_profiles()
+    await self.pool.close()
 
     if exc_type is not None:
       self.log(f"Exception encountered: {exc_value}")
 
     return
 
+  async def _flush_profiles(self) -> None:
+    try:
+      await asyncio.to_thread(self.profiles.flush)
+    except Exception as e:
+      self.log(f"Failed to store host profiles: {e}")
+
   def log(self, msg: str, COL=RESET) -> None:
     print(f"[{os.getpid()}] {COL}{msg}{RESET}")
 
-  async def _quit_browser(self):
-    if self.browser:
-      try:
-        await self.browser.quit()
-      except Exception as e:
-        self.log(f"Exception when quitting browser: {e}")
-
-  async def _restart_browser(self):
-    if self.browser:
-      await self._quit_browser()
-    await self._init_browser()
-
-  async def _init_browser(self, geodata: Dict | None = None):
-    options = Options()
-    ua = UserAgent()
-    random_user_agent = ua.random
-    self.log(f"Initializing the browser with User-Agent: {random_user_agent}")
-
-    options.add_argument(f"--user-agent={random_user_agent}")
-    options.add_argument("--window-size=1920,1080")
-
-    if self.headless:
-      options.add_argument("--headless=new")
-
-    print(f"INIT download_dir temporary is: {self.tmpdir}")
-    # fix autodownload: chrome://settings/content/pdfDocuments
-    profile = {
-      "download.default_directory": self.tmpdir,
-      "plugins.always_open_pdf_externally": True,
-      "download.prompt_for_download": False,
-    }
-
-    options.add_experimental_option("prefs", profile)
-    self.browser = await webdriver.Chrome(options=options, timeout=20)
-
-    await self.browser.execute_cdp_cmd(
-      "Page.setDownloadBehavior",
-      {"behavior": "allow", "downloadPath": self.tmpdir},
-    )
-
-    await self.browser.switch_to.new_window(
-      "tab",
-      url="chrome://settings/content/pdfDocuments",
-      activate=True,
-      background=True,
-    )
-    await asyncio.sleep(10)
-
-    if geodata:
-      if "lat" in geodata and "lon" in geodata:
-        await self.browser.execute_cdp_cmd(
-          "Emulation.setGeolocationOverride",
-          {"latitude": geodata["lat"], "longitude": geodata["lon"], "accuracy": 100},
-        )
-      if "timezone" in geodata:
-        await self.browser.execute_cdp_cmd(
-          "Emulation.setTimezoneOverride", {"timezoneId": geodata["timezone"]}
-        )
-    # self.rotate(reinit=False)
-    self.time_since_last_init = time.time()
-
   async def _get_current_ip_geo(self) -> Dict:
     try:
       async with aiohttp.ClientSession() as session:
@@ -132,11 +113,16 @@ class PDFDownloader:
       self.log(f"Failed to fetch IP geo: {e}")
       return {}
 
-  async def rotate(self, reinit=True):
+  def _set_exit(self, location: tuple[str, str] | None) -> None:
+    self.exit_node = "-".join(location) if location else ""
+
+  async def rotate(self, reinit=True, location: tuple[str, str] | None = None):
     if not reinit:
       self.log("Rotating without reinit")
-      rotate_vpn_server()
-      await asyncio.sleep(1)
+      # the tunnel is only dropped once the downloads of all workers are done
+      async with self.pool.drained():
+        self._set_exit(await asyncio.to_thread(rotate_vpn_server, location))
+        await asyncio.sleep(1)
       self.time_since_last_init = time.time()
       return
     if not self.allow_rotate:
@@ -144,152 +130,197 @@ class PDFDownloader:
       return
     else:
       self.log("Triggering vpn rotation")
-      if self.browser:
-        try:
-          await self.browser.quit()
-        except Exception as e:
-          self.log(f"Quitting browser failed: {e}")
-        self.browser = None
-
-      rotate_vpn_server()
-      await asyncio.sleep(1)  # TODO
+      # the browsers are only closed once the downloads of all workers are done
+      async with self.pool.drained():
+        await self.pool.close()
 
-      geodata = await self._get_current_ip_geo()
-      await self._init_browser(geodata)
+        self._set_exit(await asyncio.to_thread(rotate_vpn_server, location))
+        await asyncio.sleep(1)  # TODO
 
-  async def _wait_for_download(
-    self, before_files: Set[str], timeout: int = 5
-  ) -> Optional[str]:
-    start_time = time.time()
-
-    while time.time() - start_time < timeout:
-      try:
-        current_files = set(
-          f
-          for f in os.listdir(self.tmpdir)
-          if f.lower().endswith(".pdf") and not f.endswith(".crdownload")
-        )
-
-        new_files = current_files - before_files
-        # print(new_files)
-        if new_files:
-          return list(new_files)[0]
-
-        await asyncio.sleep(0.5)
-      except Exception as e:
-        self.log(f"Exception when waiting for file: {e}")
-        return list()
-    return None
+        geodata = await self._get_current_ip_geo()
+        await self.pool.start(geodata)
+      self.time_since_last_init = time.time()
 
-  def _finalize_download(self, tmppath: str, url: str) -> str | None:
-    final_name = self._hash(url)
-    final_path = os.path.join(self.download_dir, final_name)
-    # try:
-    #  PdfReader(tmppath)
-    # except PdfReadError:
-    #  print("Invalid pdf, deleting")
-    #  os.remove(tmppath)
-    #  return None
-    os.replace(tmppath, final_path)
-    self.log(f"Finalized download -> {final_name}")
+  def _finalize_download(
+    self, tmppath: str, url: str, sha256: str | None = None
+  ) -> str | None:
+    # what is no pdf never enters the store, so it never reaches grobid
+    reason = sniff(tmppath)
+    if reason not in REJECT_AT_DOWNLOAD:
+      reason = parse(tmppath) if self.validate_full else None
+    if reason:
+      self.log(f"[x] Invalid pdf ({reason}) from {url}", Y)
+      os.remove(tmppath)
+      return None
+    final_path = self.store.put(tmppath, [url], sha256)
+    self.log(f"Finalized download -> {os.path.relpath(final_path, self.download_dir)}")
     return final_path
 
-  def _hash(self, url: str) -> str:
-    hashed_url = hashlib.sha256(url.encode()).hexdigest()
-    return f"{hashed_url}.pdf"
-
-  async def download_requests(self, url, filename=None) -> str | None:
+  def _get_session(self) -> aiohttp.ClientSession:
+    if self.session is None or self.session.closed:
+      self.session = aiohttp.ClientSession(
+        timeout=HTTP_TIMEOUT,
+        connector=aiohttp.TCPConnector(limit=32, limit_per_host=4),
+        headers={"User-Agent": UserAgent().random, "Accept": "application/pdf,*/*"},
+      )
+    return self.session
+
+  async def download_http(self, url: str) -> str | None:
+    """
+    Streams the url into the tmp dir on the pooled session. Responses that are
+    declared as html or do not start with a pdf header are dropped before the
+    body is read.
+    """
+    path, _ = await self._download_http(url)
+    return path
+
+  async def _download_http(self, url: str) -> tuple[str | None, str | None]:
+    """download_http and why it failed, one of the failures of hosts."""
     tmp_path = os.path.join(self.tmpdir, f"{uuid.uuid4().hex}.pdf")
     try:
-      async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-          response.raise_for_status()
-          async with aiofiles.open(tmp_path, "wb") as f:
-            await f.write(await response.read())
-          self.log(f"[*] SUCCESS: downloaded {url} using request.")
-          return self._finalize_download(tmppath=tmp_path, url=url)
+      async with self._get_session().get(url, allow_redirects=True) as response:
+        if response.status in (404, 410):
+          self.log(f"[x] HTTP: {url} is gone ({response.status})", Y)
+          return None, hosts.MISSING
+        if response.status in BLOCKED_STATUSES:
+          self.log(f"[x] HTTP: {url} refused ({response.status})", Y)
+          return None, hosts.BLOCKED
+        response.raise_for_status()
+        content_type = response.headers.get("Content-Type", "").lower()
+        if "html" in content_type:
+          self.log(f"[x] HTTP: {url} served {content_type}", Y)
+          return None, hosts.BLOCKED
+        head = b""
+        # the store is content addressed, hashing while streaming saves a reread
+        digest = hashlib.sha256()
+        async with aiofiles.open(tmp_path, "wb") as f:
+          async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            if len(head) < PDF_SNIFF_BYTES:
+              head += chunk[: PDF_SNIFF_BYTES - len(head)]
+              if len(head) >= PDF_SNIFF_BYTES and not looks_like_pdf(head):
+                break
+            digest.update(chunk)
+            await f.write(chunk)
+      if not looks_like_pdf(head):
+        self.log(f"[x] HTTP: {url} is not a pdf ({content_type})", Y)
+        os.remove(tmp_path)
+        return None, hosts.BLOCKED
+      self.log(f"[*] SUCCESS: downloaded {url} using http.", G)
+      path = await asyncio.to_thread(
+        self._finalize_download, tmp_path, url, digest.hexdigest()
+      )
+      return path, None if path else hosts.BLOCKED
 
     except Exception as e:
-      print(f"[x] Error downloading PDF: {e} using requests")
+      print(f"[x] Error downloading PDF: {e} using http")
       if os.path.exists(tmp_path):
         os.remove(tmp_path)
-      return None
+      return None, hosts.ERROR
 
-  async def _wait_for_page_load(self, timeout=10):
-    start = time.time()
-    while (time.time() - start) < timeout:
-      ready_state = await self.browser.execute_script("return document.readyState")
-      if ready_state == "complete":
-        return True
-      await asyncio.sleep(0.2)
-    return False
-
-  async def is_institution_login_available(self) -> bool:
-    # Springer only for now
+  async def _download_browser(self, url: str) -> tuple[str | None, str | None]:
+    """download_browser and why it failed, see _download_http."""
     try:
-        await self.browser.find_element("css selector", "[data-test='access-via-institution']")
-        return True
-    except Exception as _:
-        return False
+      path = await self.download_browser(url)
+    except DownloadTimeout:
+      # no download began, the tab shows a page instead of the pdf
+      return None, hosts.BLOCKED
+    # canceled by chrome or not a pdf
+    return path, None if path else hosts.BLOCKED
 
+  async def download_requests(self, url, filename=None) -> str | None:
+    return await self.download_http(url)
+
+  async def download_tiered(self, url: str) -> str | None:
+    """
+    Tries the strategies (http or browser, with or without a publisher url
+    rewrite) that the host profile ranks cheapest first and records the outcome.
+    Strategies that never worked on the host are skipped. If the current vpn exit
+    never worked for the host but another one did, the vpn is moved there first.
+    Once the url turned out to be dead, failures are no longer held against the
+    strategies.
+    """
+    known = await asyncio.to_thread(self.store.lookup, url)
+    if known:
+      self.log(f"[*] Already stored: {url}", G)
+      return known
+    if self.profiles is None:
+      self.profiles = await asyncio.to_thread(HostProfileStore)
+    host = host_of(url)
+    await self._maybe_switch_exit(host)
+    error = None
+    dead = False
+    for strategy in self.profiles.plan(url):
+      fetch = self._download_http if strategy.tier == "http" else self._download_browser
+      start = time.perf_counter()
+      try:
+        path, failure = await fetch(strategy.url)
+      except Exception as e:
+        path, failure, error = None, hosts.ERROR, e
+      dead = dead or (failure == hosts.MISSING and strategy.url == url)
+      self.profiles.record(
+        host,
+        strategy.tier,
+        strategy.rewrite,
+        self.exit_node,
+        path is not None,
+        time.perf_counter() - start,
+        hosts.MISSING if dead else failure,
+      )
+      if self.profiles.flush_due:
+        await self._flush_profiles()
+      if path:
+        if strategy.url != url:
+          await asyncio.to_thread(self.store.link, [url], path)
+        return path
+    if error:
+      raise error
+    return None
+
+  async def _maybe_switch_exit(self, host: str) -> None:
+    if not self.allow_rotate or not self.exit_node:
+      return
+    async with self.rotating:
+      # another worker may have moved the exit while this one waited
+      working = self.profiles.working_exits(host)
+      if working and self.exit_node not in working:
+        if self.profiles.exit_is_hopeless(host, self.exit_node):
+          country, city = working[0].split("-", 1)
+          self.log(f"Moving to exit {working[0]} for {host}")
+          await self.rotate(location=(country, city))
+
+  async def _rotate_if_due(self) -> None:
+    """Rotates the vpn once switch_time has passed, once for all workers."""
+    if time.time() - self.time_since_last_init <= self.switch_time:
+      return
+    async with self.rotating:
+      # another worker may have rotated while this one waited
+      if time.time() - self.time_since_last_init > self.switch_time:
+        await self.rotate(reinit=False)
 
   async def download_browser(self, url: str) -> str | None:
     ctime = time.time() - self.time_since_last_init
     print(f"Time: {ctime}/{self.switch_time}")
-    if ctime > self.switch_time:
-      await self.rotate(reinit=False)
+    await self._rotate_if_due()
     print(f"Handling URL: {url}")
-    if not self.browser:
-      self.log("Reiniting browser")
-      await self._init_browser()
-    assert self.browser is not None
-    tab = await self.browser.new_window(type_hint="tab", activate=False)
-
     try:
-      before_files = set()
-      if self.tmpdir:
-        before_files = set(
-          f for f in os.listdir(self.tmpdir) if f.lower().endswith(".pdf")
-        )
-      # await tab.get(url, wait_load=True)
-      await self.browser.get(url)
-
-
-      # if await self.browser.current_url != url:
-      #   # Redirect
-      #   print(f"Redirect to: {await self.browser.current_url}")
-      #   if await self.is_institution_login_available():
-      #     raise Exception("Institutional login")
-      if not await self._wait_for_page_load(timeout=5):
-        self.log(f"[x] Page load timeout for {url}", R)
-        return None
-        raise Exception("Timeoout when loading page")
-        
-      downloaded_file = await self._wait_for_download(before_files, timeout=10)
-
-      if downloaded_file:
-        self.log(f"[*] Success: {downloaded_file}", G)
-        tmppath = os.path.join(self.tmpdir, downloaded_file)
-        return self._finalize_download(tmppath, url)
-      else:
-        self.log("[x] Failure: Timeout.", Y)
-        raise Exception("[x] Failure: Timeout.")
+      tmppath = await self.pool.download(url)
     except Exception as e:
       self.log(f"Exception in download_browser: {e}", R)
-      raise Exception(e)
-    finally:
-      try:
-        await tab.close()
-      except:
-        pass
+      raise
+    if not tmppath:
+      self.log(f"[x] Download canceled for {url}", Y)
+      return None
+    self.log(f"[*] Success: {os.path.basename(tmppath)}", G)
+    return await asyncio.to_thread(self._finalize_download, tmppath, url)
 
   async def download(self, url: str) -> Optional[str]:
     print(f"CTIME: {time.time() - self.time_since_last_init}\n{self.switch_time}")
-    if time.time() - self.time_since_last_init > self.switch_time:
-      await self.rotate(reinit=False)
+    await self._rotate_if_due()
 
-    filename = self._hash(url)
-    result = await self.download_requests(url, filename)
+    known = await asyncio.to_thread(self.store.lookup, url)
+    if known:
+      return known
+    result = await self.download_http(url)
     if result:
       return result
     self.log(f"Requests failed for {url}, trying browser fallback")
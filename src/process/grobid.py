@@ -1,15 +1,389 @@
-from grobid_client.grobid_client import GrobidClient
+import asyncio
+import json
+import os
+import time
+from dataclasses import dataclass
 from pathlib import Path
+from typing import AsyncIterator, Iterable
+
+import aiohttp
+from grobid_client.grobid_client import GrobidClient
+
+from database import LEASE_SECONDS, AsyncDBWriter
+from store import TEI_DIR, ShardedDir, tei_is_fresh, tei_name
 
 config_path = Path.cwd() / "configs" / "grobid_config.json"
 
+# form fields of processFulltextDocument, the same options process_files uses
+GROBID_PARAMS = {
+  "consolidateHeader": "1",
+  "consolidateCitations": "0",
+  "includeRawAffiliations": "0",
+  "includeRawCitations": "0",
+  "segmentSentences": "0",
+}
+
+# a work is given up after this many transient failures (timeouts, 503)
+MAX_TEI_ATTEMPTS = 3
+
+TEI_DONE_QUERY = """
+  UPDATE works
+  SET tei_local_path = ?, tei_process_status = 'DONE', tei_error = NULL,
+      tei_seconds = ?, tei_attempts = coalesce(tei_attempts, 0) + 1,
+      lease_owner = NULL, lease_expires = NULL
+  WHERE openalex_id = ?
+"""
+
+# permanent failures are FAILED at once, transient ones stay PENDING until they
+# ran out of attempts. Those keep their lease until :retry_at without an owner,
+# so no worker claims them again straight away and release_works leaves them be
+TEI_FAILED_QUERY = f"""
+  UPDATE works
+  SET tei_process_status = CASE
+        WHEN :permanent OR coalesce(tei_attempts, 0) + 1 >= {MAX_TEI_ATTEMPTS}
+        THEN 'FAILED' ELSE tei_process_status END,
+      tei_error = :error, tei_seconds = :seconds,
+      tei_attempts = coalesce(tei_attempts, 0) + 1,
+      lease_owner = NULL,
+      lease_expires = CASE WHEN :permanent THEN NULL ELSE :retry_at END
+  WHERE openalex_id = :id
+"""
+
+
+# no grobid server was reachable, that says nothing about the pdf: the lease is
+# dropped so the work is claimed again, without using up an attempt
+TEI_UNAVAILABLE_QUERY = """
+  UPDATE works SET tei_error = ?, lease_owner = NULL, lease_expires = NULL
+  WHERE openalex_id = ?
+"""
+
+
+def load_grobid_config(path: Path = config_path) -> dict:
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except OSError:
+    return {}
+
+
+@dataclass
+class GrobidResult:
+  pdf: str
+  tei: str | None  # relative to the teis dir
+  # DONE, FAILED (permanent), RETRY (transient) or UNAVAILABLE (no server up)
+  status: str
+  error: str | None = None
+  seconds: float = 0.0
+  server: str | None = None
+  cached: bool = False  # an up to date tei was on disk already
+
+  def record(self, writer: AsyncDBWriter, openalex_ids: Iterable[str]) -> None:
+    for openalex_id in openalex_ids:
+      if self.status == "DONE":
+        writer.post(TEI_DONE_QUERY, (self.tei, self.seconds, openalex_id))
+      elif self.status == "UNAVAILABLE":
+        writer.post(TEI_UNAVAILABLE_QUERY, (self.error, openalex_id))
+      else:
+        writer.post(
+          TEI_FAILED_QUERY,
+          {
+            "permanent": self.status == "FAILED",
+            "error": self.error,
+            "seconds": self.seconds,
+            "retry_at": time.time() + LEASE_SECONDS,
+            "id": openalex_id,
+          },
+        )
+
+
+class AdaptiveLimiter:
+  """
+  AIMD concurrency limit for a grobid server. The limit grows by one after a
+  limit's worth of requests came back without the latency rising, it halves on a
+  503 or timeout and shrinks by one when a request took much longer than usual.
+  """
+
+  def __init__(self, initial: int = 4, minimum: int = 1, maximum: int = 32):
+    self.limit = min(initial, maximum)
+    self.minimum = minimum
+    self.maximum = maximum
+    self.inflight = 0
+    self.latency: float | None = None  # moving average of successful requests
+    self.streak = 0
+
+  @property
+  def has_room(self) -> bool:
+    return self.inflight < self.limit
+
+  def acquire(self) -> None:
+    self.inflight += 1
+
+  def release(self, latency: float | None = None, overloaded: bool = False) -> None:
+    self.inflight -= 1
+    if overloaded:
+      self.limit = max(self.minimum, self.limit // 2)
+      self.streak = 0
+    elif latency is not None:
+      if self.latency is not None and latency > 2 * self.latency:
+        self.limit = max(self.minimum, self.limit - 1)
+        self.streak = 0
+      else:
+        self.streak += 1
+        if self.streak >= self.limit:
+          self.limit = min(self.maximum, self.limit + 1)
+          self.streak = 0
+      self.latency = (
+        latency if self.latency is None else (0.8 * self.latency + 0.2 * latency)
+      )
+
+
+# seconds between /api/isalive probes of every server
+HEALTH_INTERVAL = 10
+# a server that failed this many requests in a row is taken out until it is alive
+MAX_CONSECUTIVE_ERRORS = 3
+
+
+@dataclass
+class GrobidEndpoint:
+  url: str
+  limiter: AdaptiveLimiter
+  healthy: bool = True
+  errors: int = 0  # consecutive connection errors and timeouts
+  done: int = 0
+
+  def __str__(self) -> str:
+    state = "up" if self.healthy else "down"
+    return f"{self.url} ({state}, {self.limiter.inflight}/{self.limiter.limit}, {self.done} done)"
+
+
+def configured_servers(config: dict) -> list[str]:
+  servers = config.get("grobid_servers") or [
+    config.get("grobid_server", "http://localhost:8070")
+  ]
+  return [s.rstrip("/") for s in servers]
+
+
+class AsyncGrobidClient:
+  """
+  Streams pdfs to processFulltextDocument on one or more grobid servers. Every
+  pdf goes to the healthy server with the fewest requests outstanding, each
+  server has its own adaptive limit. Servers that fail their health check or a
+  few requests in a row get no new work until /api/isalive answers again,
+  requests already sent to them drain. Each tei is written to its shard in the
+  teis dir as soon as it arrives, failures come back as results with the reason.
+
+    async with AsyncGrobidClient() as client:
+      async for result in client.process_all(pdfs):
+        ...
+  """
+
+  def __init__(
+    self,
+    servers: str | list[str] | None = None,
+    output_path: str = TEI_DIR.root,
+    timeout: float | None = None,
+    retries: int = 3,
+    backoff: float = 2.0,
+    max_concurrency: int = 32,
+    params: dict[str, str] | None = None,
+    force: bool = False,
+  ):
+    config = load_grobid_config()
+    if isinstance(servers, str):
+      servers = [servers]
+    servers = (
+      [s.rstrip("/") for s in servers] if servers else configured_servers(config)
+    )
+    self.endpoints = [
+      GrobidEndpoint(url, AdaptiveLimiter(maximum=max_concurrency)) for url in servers
+    ]
+    self.teis = ShardedDir(output_path)
+    self.timeout = aiohttp.ClientTimeout(total=timeout or config.get("timeout", 160))
+    self.retries = retries
+    self.backoff = backoff
+    self.params = params or GROBID_PARAMS
+    self.force = force  # reprocess pdfs that have an up to date tei
+    self.session: aiohttp.ClientSession | None = None
+    self.cond = asyncio.Condition()
+    self.health_task: asyncio.Task | None = None
+
+  async def __aenter__(self):
+    self.session = aiohttp.ClientSession(timeout=self.timeout)
+    await self.check_health()
+    self.health_task = asyncio.create_task(self._health_loop())
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, _):
+    if self.health_task:
+      self.health_task.cancel()
+      await asyncio.gather(self.health_task, return_exceptions=True)
+      self.health_task = None
+    if self.session:
+      await self.session.close()
+      self.session = None
+
+  async def _is_alive(self, endpoint: GrobidEndpoint) -> bool:
+    try:
+      async with self.session.get(
+        f"{endpoint.url}/api/isalive", timeout=aiohttp.ClientTimeout(total=5)
+      ) as response:
+        return response.status == 200
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+      return False
+
+  async def check_health(self) -> None:
+    alive = await asyncio.gather(*(self._is_alive(e) for e in self.endpoints))
+    async with self.cond:
+      for endpoint, ok in zip(self.endpoints, alive, strict=True):
+        if ok and not endpoint.healthy:
+          print(f"Grobid server {endpoint.url} is back")
+          endpoint.errors = 0
+        elif not ok and endpoint.healthy:
+          print(f"Grobid server {endpoint.url} is down, draining it")
+        endpoint.healthy = ok
+      self.cond.notify_all()
+
+  async def _health_loop(self) -> None:
+    while True:
+      await asyncio.sleep(HEALTH_INTERVAL)
+      await self.check_health()
+
+  async def _acquire(self) -> GrobidEndpoint:
+    """The healthy endpoint with the fewest outstanding requests that has room."""
+    async with self.cond:
+      waited = 0.0
+      while True:
+        ready = [e for e in self.endpoints if e.healthy and e.limiter.has_room]
+        if ready:
+          endpoint = min(
+            ready,
+            key=lambda e: (e.limiter.inflight, e.limiter.inflight / e.limiter.limit),
+          )
+          endpoint.limiter.acquire()
+          return endpoint
+        if not any(e.healthy for e in self.endpoints):
+          if waited >= self.timeout.total:
+            raise RuntimeError("no healthy grobid server")
+          waited += HEALTH_INTERVAL
+        try:
+          await asyncio.wait_for(self.cond.wait(), HEALTH_INTERVAL)
+        except asyncio.TimeoutError:
+          pass
+
+  async def _release(
+    self,
+    endpoint: GrobidEndpoint,
+    latency: float | None,
+    overloaded: bool,
+    failed: bool,
+  ) -> None:
+    async with self.cond:
+      endpoint.limiter.release(latency, overloaded)
+      if failed:
+        endpoint.errors += 1
+        if endpoint.errors >= MAX_CONSECUTIVE_ERRORS and endpoint.healthy:
+          print(
+            f"Grobid server {endpoint.url} failed {endpoint.errors} requests, draining it"
+          )
+          endpoint.healthy = False
+      else:
+        endpoint.errors = 0
+        endpoint.done += not overloaded
+      self.cond.notify_all()
+
+  async def _post(self, endpoint: GrobidEndpoint, pdf: str) -> tuple[int, str]:
+    data = await asyncio.to_thread(Path(pdf).read_bytes)
+    form = aiohttp.FormData()
+    form.add_field(
+      "input", data, filename=os.path.basename(pdf), content_type="application/pdf"
+    )
+    for key, value in self.params.items():
+      form.add_field(key, value)
+    url = f"{endpoint.url}/api/processFulltextDocument"
+    async with self.session.post(url, data=form) as response:
+      return response.status, await response.text()
+
+  def _write_tei(self, pdf: str, tei: str) -> str:
+    relpath = self.teis.relpath(tei_name(pdf))
+    path = os.path.join(self.teis.root, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".part", "w", encoding="utf-8") as f:
+      f.write(tei)
+    os.replace(path + ".part", path)
+    return relpath
+
+  def _existing_tei(self, pdf: str) -> str | None:
+    relpath = self.teis.relpath(tei_name(pdf))
+    if tei_is_fresh(os.path.join(self.teis.root, relpath), pdf):
+      return relpath
+    return None
+
+  async def process(self, pdf: str) -> GrobidResult:
+    start = time.perf_counter()
+    if not os.path.exists(pdf):
+      return GrobidResult(pdf, None, "FAILED", "MISSING", 0.0)
+    if not self.force:
+      tei = await asyncio.to_thread(self._existing_tei, pdf)
+      if tei:
+        return GrobidResult(pdf, tei, "DONE", cached=True)
+    attempt = 0
+    while True:
+      try:
+        endpoint = await self._acquire()
+      except RuntimeError as e:
+        elapsed = time.perf_counter() - start
+        return GrobidResult(pdf, None, "UNAVAILABLE", str(e), elapsed)
+      sent = time.perf_counter()
+      try:
+        status, body = await self._post(endpoint, pdf)
+      except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        status, body = None, f"{type(e).__name__}: {e}"
+      latency = time.perf_counter() - sent
+      overloaded = status is None or status == 503
+      await self._release(
+        endpoint, None if overloaded else latency, overloaded, failed=status is None
+      )
+
+      elapsed = time.perf_counter() - start
+      if status == 200 and body:
+        tei = await asyncio.to_thread(self._write_tei, pdf, body)
+        return GrobidResult(pdf, tei, "DONE", None, elapsed, endpoint.url)
+      if not overloaded:
+        # 204: no text could be extracted, 500: the pdf could not be parsed
+        error = "NO_CONTENT" if status in (200, 204) else f"HTTP {status}: {body[:200]}"
+        return GrobidResult(pdf, None, "FAILED", error, elapsed, endpoint.url)
+      attempt += 1
+      if attempt > self.retries:
+        error = body[:200] if status is None else "HTTP 503"
+        # the servers went down while the pdf was with them, not the pdf's fault
+        status = "RETRY" if any(e.healthy for e in self.endpoints) else "UNAVAILABLE"
+        return GrobidResult(pdf, None, status, error, elapsed, endpoint.url)
+      # another server may take it right away, this one backs off via its limit
+      if not any(
+        e is not endpoint and e.healthy and e.limiter.has_room for e in self.endpoints
+      ):
+        await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+
+  async def process_all(self, pdfs: Iterable[str]) -> AsyncIterator[GrobidResult]:
+    """Yields results in the order they finish."""
+    tasks = [asyncio.ensure_future(self.process(pdf)) for pdf in pdfs]
+    try:
+      for fut in asyncio.as_completed(tasks):
+        yield await fut
+    finally:
+      for task in tasks:
+        task.cancel()
+
+  def summary(self) -> str:
+    return ", ".join(str(e) for e in self.endpoints)
+
 
 class GrobidHandler:
   def __init__(self):
     self.client = GrobidClient(config_path=config_path)
 
   def process_files(
-    self, files: list[str], input_path: str, output_path: str
+    self, files: list[str], input_path: str, output_path: str, force: bool = False
   ) -> dict[str, str]:
     if self.client is None:
       exit
@@ -17,6 +391,18 @@ class GrobidHandler:
     _output_path = Path(output_path)
     _output_path.mkdir(parents=True, exist_ok=True)
 
+    # pdfs whose tei is on disk and newer than the pdf are not sent again
+    teis = ShardedDir(output_path)
+    results: dict[str, str] = {}
+    if not force:
+      for pdf in files:
+        relpath = teis.relpath(tei_name(pdf))
+        if tei_is_fresh(teis.resolve(relpath), pdf):
+          results[pdf] = relpath
+      files = [pdf for pdf in files if pdf not in results]
+      if not files:
+        return results
+
     # print(files[0])
 
     try:
@@ -34,19 +420,23 @@ class GrobidHandler:
         include_raw_citations=False,
         tei_coordinates=False,
         segment_sentences=False,
-        force=True,
+        force=force,
         consolidate_header=True,
       )
 
     except Exception as e:
       print(f"Grobid Exception when processing {input_path}: {e}")
 
-    results: dict[str, str] = {}
+    # grobid writes flat into the output dir, results are moved into the shard
+    # of their name and returned relative to output_path
     for pdf in files:
-      tei_name = Path(pdf).with_suffix(".grobid.tei.xml").name
-      tei_path = _output_path / tei_name
+      name = tei_name(pdf)
+      tei_path = _output_path / name
       if tei_path.exists() and tei_path.stat().st_size > 0:
-        results[pdf] = tei_name
+        results[pdf] = teis.place(str(tei_path))
+        json_path = _output_path / name.replace(".grobid.tei.xml", ".json")
+        if json_path.exists():
+          teis.place(str(json_path))
       else:
         print(f"Grobid did not produce output for: {pdf}")
     return results
@@ -0,0 +1,110 @@
+import argparse
+import asyncio
+import html
+
+from aiohttp import web
+
+TEI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<TEI xmlns="http://www.tei-c.org/ns/1.0">
+  <teiHeader>
+    <fileDesc>
+      <titleStmt><title level="a" type="main">{title}</title></titleStmt>
+    </fileDesc>
+  </teiHeader>
+  <text>
+    <body>
+      <div><head>Method</head><p>Participants completed the questionnaire online.</p></div>
+    </body>
+    <back>
+      <div type="availability">
+        <div><head>Data availability statement</head><p>The data are available at https://osf.io/abcde/ and https://github.com/example/{title}.</p></div>
+      </div>
+    </back>
+  </text>
+</TEI>
+"""
+
+
+class StubGrobid:
+  """
+  Stand-in for a grobid server for local runs of the grobid stage. It answers
+  /api/isalive and returns a canned tei for every pdf after `latency` seconds,
+  with more than `capacity` requests in flight it answers 503 like grobid does.
+  """
+
+  def __init__(self, latency: float = 0.2, capacity: int = 8):
+    self.latency = latency
+    self.capacity = capacity
+    self.inflight = 0
+    self.served = 0
+    self.rejected = 0
+
+  async def isalive(self, request: web.Request) -> web.Response:
+    return web.Response(text="true")
+
+  async def fulltext(self, request: web.Request) -> web.Response:
+    if self.inflight >= self.capacity:
+      self.rejected += 1
+      return web.Response(status=503)
+    self.inflight += 1
+    try:
+      form = await request.post()
+      pdf = form.get("input")
+      if pdf is None or not hasattr(pdf, "file"):
+        return web.Response(status=400, text="[BAD_INPUT_DATA] no input")
+      if not pdf.file.read(5).startswith(b"%PDF"):
+        return web.Response(
+          status=500, text="[BAD_INPUT_DATA] PDF to XML conversion failed"
+        )
+      await asyncio.sleep(self.latency)
+      self.served += 1
+      title = html.escape(pdf.filename.removesuffix(".pdf"))
+      return web.Response(
+        text=TEI_TEMPLATE.format(title=title), content_type="application/xml"
+      )
+    finally:
+      self.inflight -= 1
+
+  def app(self) -> web.Application:
+    app = web.Application(client_max_size=100 * 1024 * 1024)
+    app.router.add_get("/api/isalive", self.isalive)
+    app.router.add_post("/api/processFulltextDocument", self.fulltext)
+    return app
+
+
+async def start_stubs(
+  port: int = 8070, instances: int = 1, latency: float = 0.2, capacity: int = 8
+) -> list[tuple[web.AppRunner, StubGrobid]]:
+  """Starts `instances` stub servers on consecutive ports of localhost."""
+  stubs = []
+  for i in range(instances):
+    stub = StubGrobid(latency, capacity)
+    runner = web.AppRunner(stub.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port + i).start()
+    stubs.append((runner, stub))
+  return stubs
+
+
+async def _serve(args: argparse.Namespace) -> None:
+  stubs = await start_stubs(args.port, args.instances, args.latency, args.capacity)
+  ports = ", ".join(str(args.port + i) for i in range(len(stubs)))
+  print(f"Stub grobid listening on port(s) {ports}")
+  try:
+    await asyncio.Event().wait()
+  finally:
+    for runner, _ in stubs:
+      await runner.cleanup()
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Serve canned teis like grobid.")
+  parser.add_argument("--port", type=int, default=8070)
+  parser.add_argument("--instances", type=int, default=1)
+  parser.add_argument("--latency", type=float, default=0.2)
+  parser.add_argument("--capacity", type=int, default=8)
+  asyncio.run(_serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,263 @@
+import re
+import statistics
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+from urllib.parse import urlparse
+
+from database import connect
+
+TIERS = ("http", "browser")
+
+# expected seconds per attempt before a host has been measured
+DEFAULT_LATENCY = {"http": 3.0, "browser": 20.0}
+
+# a strategy that was blocked this often without a single success is skipped,
+# except for every RETRY_HOPELESS_EVERY-th plan of the host, the host may change
+GIVE_UP_AFTER = 3
+RETRY_HOPELESS_EVERY = 50
+
+# why a strategy failed. Only BLOCKED says something about the strategy on the
+# host and counts against it, the others are about the url or the network
+BLOCKED = "blocked"  # html, a challenge page or no pdf where one was expected
+MISSING = "missing"  # 404 or 410, the link is dead
+ERROR = "error"  # timeouts, connection and server errors
+
+LATENCY_SAMPLES = 32
+# seconds between writes of the learned strategies, a crash loses at most these
+FLUSH_INTERVAL = 60
+
+
+def rewrite_tandfonline(url: str) -> str | None:
+  if "www.tandfonline.com" in url and "/epdf/" in url:
+    return url.replace("/epdf/", "/pdf/")
+  return None
+
+
+WAXMANN_PATTERN = re.compile(r"index\.php\?eID=download&id_artikel=(ART\d+)&uid=(\w+)")
+
+
+def rewrite_waxmann(url: str) -> str | None:
+  match = WAXMANN_PATTERN.search(url)
+  if not match:
+    return None
+  art_id, uid = match.groups()
+  return (
+    f"https://www.waxmann.com/shop/download?"
+    f"tx_p2waxmann_download[action]=download&"
+    f"tx_p2waxmann_download[controller]=Zeitschrift&"
+    f"tx_p2waxmann_download[id_artikel]={art_id}&"
+    f"tx_p2waxmann_download[uid]={uid}"
+  )
+
+
+# publisher specific url rewrites, a rewrite returns None if it does not apply
+URL_REWRITES: dict[str, Callable[[str], str | None]] = {
+  "tandfonline_pdf": rewrite_tandfonline,
+  "waxmann_download": rewrite_waxmann,
+}
+
+
+def host_of(url: str) -> str:
+  return (urlparse(url).hostname or "").lower()
+
+
+@dataclass
+class StrategyStats:
+  successes: int = 0
+  failures: int = 0
+  latencies: list[float] = field(default_factory=list)
+  dirty: bool = False
+
+  @property
+  def attempts(self) -> int:
+    return self.successes + self.failures
+
+  @property
+  def success_rate(self) -> float:
+    # laplace prior, an untried strategy counts as 50%
+    return (self.successes + 1) / (self.attempts + 2)
+
+  @property
+  def hopeless(self) -> bool:
+    return self.successes == 0 and self.failures >= GIVE_UP_AFTER
+
+  def median_latency(self, tier: str) -> float:
+    if not self.latencies:
+      return DEFAULT_LATENCY[tier]
+    return statistics.median(self.latencies)
+
+  def record(self, ok: bool, latency: float) -> None:
+    if ok:
+      self.successes += 1
+      self.latencies = (self.latencies + [latency])[-LATENCY_SAMPLES:]
+    else:
+      self.failures += 1
+    self.dirty = True
+
+
+@dataclass
+class Strategy:
+  tier: str
+  rewrite: str  # "" if the url is used as is
+  url: str
+
+
+class HostProfileStore:
+  """
+  Learned download behaviour per host, kept in the host_strategies table. For
+  every (host, tier, rewrite, exit node) it counts successes and failures and
+  keeps recent latencies of successful downloads, so that the downloader can try
+  the cheapest strategy that works first and skip the ones that never do.
+  """
+
+  def __init__(self, path: str | None = None):
+    self.path = path
+    self.lock = threading.Lock()
+    self.stats: dict[tuple[str, str, str, str], StrategyStats] = {}
+    self.flushed_at = time.monotonic()
+    # plans that skipped a hopeless (host, tier, rewrite), in memory only
+    self.skipped: dict[tuple[str, str, str], int] = {}
+    self.load()
+
+  def load(self) -> None:
+    with connect(self.path) as conn:
+      rows = conn.execute(
+        """
+          SELECT host, tier, rewrite, exit_node, successes, failures, latencies
+          FROM host_strategies
+        """
+      ).fetchall()
+    with self.lock:
+      for host, tier, rewrite, exit_node, ok, failed, latencies in rows:
+        samples = [float(x) for x in latencies.split(",") if x] if latencies else []
+        self.stats[(host, tier, rewrite, exit_node)] = StrategyStats(
+          ok, failed, samples
+        )
+
+  @property
+  def flush_due(self) -> bool:
+    return time.monotonic() - self.flushed_at > FLUSH_INTERVAL
+
+  def flush(self) -> None:
+    with self.lock:
+      self.flushed_at = time.monotonic()
+      dirty = [(k, v) for k, v in self.stats.items() if v.dirty]
+      for _, v in dirty:
+        v.dirty = False
+    if not dirty:
+      return
+    with connect(self.path) as conn:
+      conn.executemany(
+        """
+          INSERT INTO host_strategies (
+            host, tier, rewrite, exit_node, successes, failures, latencies
+          ) VALUES (?, ?, ?, ?, ?, ?, ?)
+          ON CONFLICT(host, tier, rewrite, exit_node) DO UPDATE SET
+            successes = excluded.successes,
+            failures = excluded.failures,
+            latencies = excluded.latencies,
+            updated_at = CURRENT_TIMESTAMP
+        """,
+        [
+          (*key, v.successes, v.failures, ",".join(f"{x:.2f}" for x in v.latencies))
+          for key, v in dirty
+        ],
+      )
+
+  def record(
+    self,
+    host: str,
+    tier: str,
+    rewrite: str,
+    exit_node: str,
+    ok: bool,
+    latency: float,
+    failure: str = BLOCKED,
+  ) -> None:
+    """Counts an attempt, failures other than BLOCKED are not held against it."""
+    if not ok and failure != BLOCKED:
+      return
+    with self.lock:
+      key = (host, tier, rewrite, exit_node or "")
+      self.stats.setdefault(key, StrategyStats()).record(ok, latency)
+
+  def _aggregate(self, host: str, tier: str, rewrite: str) -> StrategyStats:
+    """Stats of a strategy summed over all exit nodes."""
+    total = StrategyStats()
+    with self.lock:
+      for (h, t, r, _), v in self.stats.items():
+        if (h, t, r) == (host, tier, rewrite):
+          total.successes += v.successes
+          total.failures += v.failures
+          total.latencies += v.latencies
+    return total
+
+  def plan(self, url: str) -> list[Strategy]:
+    """
+    Candidate strategies for `url`, cheapest expected cost first. The cost of a
+    strategy is its median latency divided by its success rate. Strategies that
+    never worked on this host are dropped, if nothing else is left the least
+    tried one is kept so that a host can recover. A dropped strategy is tried
+    again, last, every RETRY_HOPELESS_EVERY plans.
+    """
+    host = host_of(url)
+    variants = [("", url)]
+    for name, rewrite in URL_REWRITES.items():
+      target = rewrite(url)
+      if target and target != url:
+        variants.append((name, target))
+
+    scored = []
+    for rewrite, target in variants:
+      for tier in TIERS:
+        s = self._aggregate(host, tier, rewrite)
+        cost = s.median_latency(tier) / s.success_rate
+        scored.append((s.hopeless, cost, s.attempts, Strategy(tier, rewrite, target)))
+
+    alive = sorted((x for x in scored if not x[0]), key=lambda x: x[1])
+    if not alive:
+      return [min(scored, key=lambda x: x[2])[3]]
+    retried = []
+    with self.lock:
+      for hopeless, _, _, strategy in scored:
+        if not hopeless:
+          continue
+        key = (host, strategy.tier, strategy.rewrite)
+        self.skipped[key] = self.skipped.get(key, 0) + 1
+        if self.skipped[key] >= RETRY_HOPELESS_EVERY:
+          self.skipped[key] = 0
+          retried.append(strategy)
+    return [x[3] for x in alive] + retried
+
+  def working_exits(self, host: str) -> list[str]:
+    """Exit nodes on which downloads from `host` succeeded, best first."""
+    per_exit: dict[str, StrategyStats] = {}
+    with self.lock:
+      for (h, _, _, exit_node), v in self.stats.items():
+        if h == host and exit_node:
+          agg = per_exit.setdefault(exit_node, StrategyStats())
+          agg.successes += v.successes
+          agg.failures += v.failures
+    working = [e for e, v in per_exit.items() if v.successes]
+    return sorted(working, key=lambda e: per_exit[e].success_rate, reverse=True)
+
+  def exit_is_hopeless(self, host: str, exit_node: str) -> bool:
+    total = StrategyStats()
+    with self.lock:
+      for (h, _, _, e), v in self.stats.items():
+        if h == host and e == exit_node:
+          total.successes += v.successes
+          total.failures += v.failures
+    return total.hopeless
+
+  def summary(self) -> dict[str, dict[str, str]]:
+    out: dict[str, dict[str, str]] = {}
+    with self.lock:
+      keys = {(h, t, r) for h, t, r, _ in self.stats}
+    for host, tier, rewrite in sorted(keys):
+      s = self._aggregate(host, tier, rewrite)
+      name = f"{tier}+{rewrite}" if rewrite else tier
+      out.setdefault(host, {})[name] = f"{s.successes}/{s.attempts}"
+    return out
@@ -0,0 +1,176 @@
+import re
+from dataclasses import dataclass, field
+
+# grobid breaks urls at line ends into "https://osf. io/ ab12c", a single
+# whitespace is accepted where such breaks happen and removed afterwards
+_BREAK = r"\s?"
+# path characters, no whitespace and no closing punctuation
+_SEGMENT = r"[\w.~%+-]+"
+
+
+@dataclass(frozen=True)
+class RepositoryHost:
+  """
+  A repository whose links are extracted. `hint` is the lowercase text every
+  link starts with after scheme and www, `pattern` matches the link from there.
+  With `subdomains` the link may start earlier, e.g. springernature.figshare.com.
+  """
+
+  name: str
+  hint: str
+  pattern: str
+  subdomains: bool = False
+  regex: re.Pattern = field(init=False, repr=False, compare=False)
+
+  def __post_init__(self):
+    object.__setattr__(self, "regex", re.compile(self.pattern, re.IGNORECASE))
+
+
+# repositories and registries of data, code and preregistrations. Article dois
+# are not included, every reference has one
+REPOSITORY_HOSTS = [
+  RepositoryHost(
+    "github",
+    "github",
+    # a repository or just its owner. grobid breaks these after the host only,
+    # a space after "owner/" is the end of the link, not a break
+    rf"github\.{_BREAK}com/{_BREAK}(?:[\w.-]+/[\w.-]+(?:/{_SEGMENT})*|[\w-]+)",
+  ),
+  RepositoryHost(
+    "gitlab",
+    "gitlab",
+    # a repository or just its owner. grobid breaks these after the host only,
+    # a space after "owner/" is the end of the link, not a break
+    rf"gitlab\.{_BREAK}com/{_BREAK}(?:[\w.-]+/[\w.-]+(?:/{_SEGMENT})*|[\w-]+)",
+  ),
+  RepositoryHost(
+    "osf",
+    "osf",
+    rf"osf\.{_BREAK}io/{_BREAK}(?:preprints/[a-z]+/)?[a-z0-9]{{5}}(?![a-z0-9])"
+    rf"(?:/(?:files|wiki)(?:/{_SEGMENT})*)?/?"
+    rf"(?:{_BREAK}\?{_BREAK}view_only={_BREAK}[0-9a-f]{{32}})?",
+  ),
+  RepositoryHost("psyarxiv", "psyarxiv", r"psyarxiv\.com/[a-z0-9]{5}(?![a-z0-9])"),
+  RepositoryHost(
+    "zenodo", "zenodo", r"zenodo\.org/(?:records?|record/files|doi)/[\w./-]+"
+  ),
+  RepositoryHost("figshare", "figshare", r"figshare\.com/[\w./-]+", subdomains=True),
+  RepositoryHost(
+    "dryad", "datadryad", r"datadryad\.org/stash/dataset/doi:10\.5061/dryad\.[\w.]+"
+  ),
+  RepositoryHost(
+    "dataverse",
+    "dataverse",
+    r"dataverse\.[\w.]+/dataset\.xhtml\?persistentId=doi:10\.\d{4,9}/[\w./-]+",
+  ),
+  RepositoryHost(
+    "icpsr", "icpsr", r"icpsr\.(?:org|umich\.edu)/[\w./-]+", subdomains=True
+  ),
+  RepositoryHost("aspredicted", "aspredicted", r"aspredicted\.org/[\w./-]+"),
+  RepositoryHost("psycharchives", "psycharchives", r"psycharchives\.org/[\w./:-]+"),
+  RepositoryHost("researchbox", "researchbox", r"researchbox\.org/\d+"),
+  RepositoryHost("bitbucket", "bitbucket", r"bitbucket\.org/[\w.-]+/[\w.-]+"),
+  RepositoryHost(
+    "huggingface", "huggingface", r"huggingface\.co/(?:datasets/)?[\w.-]+/[\w.-]+"
+  ),
+  RepositoryHost("kaggle", "kaggle", r"kaggle\.com/datasets/[\w.-]+/[\w.-]+"),
+  RepositoryHost(
+    "mendeley", "data.mendeley", r"data\.mendeley\.com/datasets/\w+(?:/\d+)?"
+  ),
+  # dois of zenodo, dryad, figshare, dataverse, osf, psyarxiv, icpsr,
+  # psycharchives, pangaea, ... with or without resolver in front
+  RepositoryHost(
+    "doi",
+    "10.",
+    r"10\.(?:5281|5061|6084|7910|17605|31234|3886|23668|17632|1594|5683)"
+    r"/[\w.;:()/-]+",
+  ),
+]
+
+_WHITESPACE = re.compile(r"\s+")
+_SCHEME_PREFIX = re.compile(r"^(?:https?://)?(?:www\.)?", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class RepositoryLink:
+  host: str  # name of the RepositoryHost
+  url: str  # normalized
+
+
+def normalize_link(host: str, raw: str) -> str:
+  """Canonical https url of a match, whitespace from line breaks removed."""
+  link = _WHITESPACE.sub("", raw).rstrip(".:-")
+  link = _SCHEME_PREFIX.sub("", link)
+  if host == "doi":
+    # a closing parenthesis belongs to the sentence unless the doi opened it
+    while link.endswith(")") and link.count("(") < link.count(")"):
+      link = link[:-1]
+    return "https://doi.org/" + link.rstrip(".,;:").lower()
+  link, _, query = link.partition("?")
+  domain, _, path = link.partition("/")
+  path = path.rstrip("/")
+  if host in ("github", "gitlab", "bitbucket"):
+    owner, _, rest = path.partition("/")
+    repo, _, rest = rest.partition("/")
+    repo = repo.removesuffix(".git")
+    path = "/".join(p for p in (owner.lower(), repo.lower(), rest) if p)
+  elif host in ("osf", "psyarxiv"):
+    path = path.lower()
+  url = f"https://{domain.lower()}/{path}"
+  return f"{url}?{query}" if query else url
+
+
+def _subdomain_start(text: str, start: int) -> int:
+  """Start of the host name that ends in text[start:], without www."""
+  i = start
+  while i > 0 and (text[i - 1].isalnum() or text[i - 1] in ".-"):
+    i -= 1
+  if text[i : i + 4].lower() == "www.":
+    i += 4
+  return i
+
+
+def _hits(lowered: str) -> list[tuple[int, RepositoryHost]]:
+  hits = []
+  for host in REPOSITORY_HOSTS:
+    i = lowered.find(host.hint)
+    while i != -1:
+      hits.append((i, host))
+      i = lowered.find(host.hint, i + 1)
+  hits.sort(key=lambda hit: hit[0])
+  return hits
+
+
+def extract_repository_links(text: str | None) -> list[RepositoryLink]:
+  """
+  Links to data and code repositories in `text`, normalized and deduplicated in
+  order of appearance. The host names are found with str.find and each host's
+  precompiled pattern is only matched, anchored, at those positions, so the
+  time is linear in the length of the text. No pattern can backtrack across
+  whitespace or swallow the text after a link.
+  """
+  if not text:
+    return []
+  links: dict[str, RepositoryLink] = {}
+  end = 0
+  for start, host in _hits(text.lower()):
+    if start < end:
+      continue
+    match = host.regex.match(text, start)
+    if match is None:
+      continue
+    end = match.end()
+    if host.subdomains:
+      start = _subdomain_start(text, start)
+    url = normalize_link(host.name, text[start:end])
+    links.setdefault(url, RepositoryLink(host.name, url))
+  return list(links.values())
+
+
+def extract_links(text: str | None, hosts: tuple[str, ...] | None = None) -> list[str]:
+  """Urls of extract_repository_links, optionally only those of `hosts`."""
+  return [
+    link.url
+    for link in extract_repository_links(text)
+    if hosts is None or link.host in hosts
+  ]
@@ -1,5 +1,15 @@
-import requests
+import asyncio
+import hashlib
 import json
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Iterable
+
+import aiohttp
+
+from database import connect, migrate
 
 API_PORT = "11434"
 
@@ -7,83 +17,353 @@ ollama_url = f"http://127.0.0.1:{API_PORT}/api/generate"
 
 models = ["llama3:8b", "llama3.2:1b"]
 
+# requests ollama works on at once, the server's OLLAMA_NUM_PARALLEL
+PARALLEL_SLOTS = int(os.environ.get("OLLAMA_NUM_PARALLEL", 4))
+# statements classified in one request
+BATCH_SIZE = 8
+# how long ollama keeps the model loaded after a request, -1 for ever. It is a
+# top level field of the request, inside options it is ignored
+KEEP_ALIVE = -1
+# long statements are cut, a DAS is rarely longer
+MAX_STATEMENT_CHARS = 2000
+# tokens of output per statement in a batch, {"id": 12, "code": "A"}, plus slack
+TOKENS_PER_STATEMENT = 16
 
-def is_article_data_based(msg: str, model_name: str = "llama3:8b"):
-  url = ollama_url
-
-  system_prompt = (
-    "You are an expert academic text analyzer. Your taks is to decide based on either an abstract or an excerpt of a paper"
-    "whether the journal is not data based (a review article or a general method) or if it is data based."
-    "Your response must be one of the following letters:"
-    "\n 'R': for review article"
-    "\n 'M': for method"
-    "\n 'D': for data"
-  )
 
-  payload = {
-    "model": model_name,
-    "prompt": f"--- STATEMENT ---\n{msg}\n\nCLASSIFICATION CODE:",
-    "system": system_prompt,
-    "stream": False,
-    "options": {
-      "num_thread": 16,
-      "temperature": 0.0,
-      "keep_alive": -1,
-      "num_predict": 20,
-    },
-  }
+@dataclass(frozen=True)
+class ClassificationTask:
+  system_prompt: str
+  codes: tuple[str, ...]
 
-  try:
-    response = requests.post(url, json=payload)
-    response.raise_for_status()
-    return response.text
-  except Exception as e:
-    print(f"Exception when deciding: {e}")
 
+DAS_TASK = ClassificationTask(
+  "You are an expert academic text analyzer. Your task is to classify the intent of the provided Data Availability Statement (DAS)."
+  "You are a mandatory classification bot. Analyze the Data Availability Statement (DAS) and "
+  "classify it into one of three codes: A (Available), R (Restricted/Request), or N (Not Applicable/No Data). "
+  "\nA: Data is openly available and includes a link, repository name or accession code."
+  "\nR: Data is available upon reasonable request, restricted, or subject to proprietary access."
+  "\nN: Data is not applicable or was not generated for this study (e.g., a review paper).",
+  ("A", "R", "N"),
+)
 
-def get_das_classification(msg: str, model_name: str = "llama3:8b"):
-  url = ollama_url
-
-  system_prompt = (
-    "You are an expert academic text analyzer. Your task is to classify the intent of the provided Data Availability Statement (DAS)."
-    "You are a mandatory classification bot. Analyze the Data Availability Statement (DAS) and "
-    "classify it into one of three codes: A (Available), R (Restricted/Request), or N (Not Applicable/No Data). "
-    'Your response MUST be a single JSON object adhering to this schema: {"code": "[A or R or N]"}.'
-    "\nA: Data is openly available and includes a link, repository name or accession code."
-    "\nR: Data is available upon reasonable request, restricted, or subject to proprietary access."
-    "\nN: Data is not applicable or was not generated for this study (e.g., a review paper)."
-  )
+ARTICLE_TASK = ClassificationTask(
+  "You are an expert academic text analyzer. Your taks is to decide based on either an abstract or an excerpt of a paper"
+  "whether the journal is not data based (a review article or a general method) or if it is data based."
+  "Your response must be one of the following letters:"
+  "\n 'R': for review article"
+  "\n 'M': for method"
+  "\n 'D': for data",
+  ("R", "M", "D"),
+)
+
+BATCH_INSTRUCTIONS = (
+  "\n\nYou are given several statements, numbered [1], [2], ... Classify each of "
+  'them on its own and answer with a single JSON object {"results": [{"id": 1, '
+  '"code": "..."}, ...]} with exactly one entry per statement.'
+)
+
+
+# the cache keeps at most this many answers, the least recently used go first
+CACHE_MAX_ENTRIES = 500_000
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_statement(text: str) -> str:
+  """The statement as it is sent, whitespace collapsed and cut to length."""
+  return _WHITESPACE.sub(" ", text).strip()[:MAX_STATEMENT_CHARS]
+
+
+def _sha256(text: str) -> str:
+  return hashlib.sha256(text.encode()).hexdigest()
+
+
+class LLMCache:
+  """
+  Answers of the model in the llm_cache table of index.db. An answer is keyed by
+  the model, a hash of the task's system prompt and codes and a hash of the
+  normalized statement, so changing the prompt or the model starts afresh. Only
+  valid codes are stored. Beyond `max_entries` the least recently used answers
+  are evicted.
+  """
+
+  def __init__(self, path: str | None = None, max_entries: int = CACHE_MAX_ENTRIES):
+    self.path = path
+    self.max_entries = max_entries
+    # upper bound of the rows in llm_cache, upserts of known answers count too.
+    # The table is only counted when it passes max_entries
+    self.entries: int | None = None
+    migrate(path)
+
+  @staticmethod
+  def task_hash(task: ClassificationTask) -> str:
+    return _sha256(task.system_prompt + "\0" + ",".join(task.codes))
+
+  def get_many(
+    self, model: str, task: ClassificationTask, texts: Iterable[str]
+  ) -> dict[str, str]:
+    """Cached codes of the (normalized) texts that have one."""
+    by_hash = {_sha256(t): t for t in texts}
+    prompt_hash = self.task_hash(task)
+    hits: dict[str, str] = {}
+    hashes = list(by_hash)
+    with connect(self.path) as conn:
+      for i in range(0, len(hashes), 500):
+        chunk = hashes[i : i + 500]
+        rows = conn.execute(
+          f"""
+            SELECT input_hash, code FROM llm_cache
+            WHERE model = ? AND prompt_hash = ?
+              AND input_hash IN ({",".join("?" * len(chunk))})
+          """,
+          [model, prompt_hash, *chunk],
+        ).fetchall()
+        hits.update((by_hash[h], code) for h, code in rows)
+      if hits:
+        conn.executemany(
+          """
+            UPDATE llm_cache SET used_at = ?
+            WHERE model = ? AND prompt_hash = ? AND input_hash = ?
+          """,
+          [(time.time(), model, prompt_hash, _sha256(t)) for t in hits],
+        )
+    return hits
 
-  payload = {
-    "model": model_name,
-    "prompt": f"--- STATEMENT ---\n{msg}\n\nCLASSIFICATION CODE:",
-    "system": system_prompt,
-    "stream": False,
-    "format": "json",
-    "options": {
-      "num_thread": 16,
-      "temperature": 0.0,
-      "keep_alive": -1,
-      "num_predict": 20,
+  def put_many(
+    self, model: str, task: ClassificationTask, codes: dict[str, str]
+  ) -> None:
+    prompt_hash, now = self.task_hash(task), time.time()
+    rows = [
+      (model, prompt_hash, _sha256(text), code, now)
+      for text, code in codes.items()
+      if code in task.codes
+    ]
+    if not rows:
+      return
+    with connect(self.path) as conn:
+      conn.executemany(
+        """
+          INSERT INTO llm_cache (model, prompt_hash, input_hash, code, used_at)
+          VALUES (?, ?, ?, ?, ?)
+          ON CONFLICT (model, prompt_hash, input_hash) DO UPDATE SET
+            code = excluded.code, used_at = excluded.used_at
+        """,
+        rows,
+      )
+      self._evict(conn, len(rows))
+
+  def _evict(self, conn, added: int) -> None:
+    if self.entries is not None:
+      self.entries += added
+      if self.entries <= self.max_entries:
+        return
+    count = conn.execute("SELECT count(*) FROM llm_cache").fetchone()[0]
+    self.entries = count
+    if count <= self.max_entries:
+      return
+    # a tenth below the limit, so that eviction does not run on every insert
+    excess = count - int(self.max_entries * 0.9)
+    conn.execute(
+      """
+        DELETE FROM llm_cache WHERE (model, prompt_hash, input_hash) IN (
+          SELECT model, prompt_hash, input_hash FROM llm_cache
+          ORDER BY used_at LIMIT ?
+        )
+      """,
+      (excess,),
+    )
+    self.entries = count - excess
+
+
+def _batch_schema(task: ClassificationTask) -> dict:
+  """JSON schema for ollama's structured output, the answer has to match it."""
+  return {
+    "type": "object",
+    "properties": {
+      "results": {
+        "type": "array",
+        "items": {
+          "type": "object",
+          "properties": {
+            "id": {"type": "integer"},
+            "code": {"type": "string", "enum": list(task.codes)},
+          },
+          "required": ["id", "code"],
+        },
+      }
     },
+    "required": ["results"],
   }
 
-  try:
-    response = requests.post(url, json=payload)
-    response.raise_for_status()
 
-    full_response = response.json().get("response", "").strip()
+class AsyncLLMClient:
+  """
+  Classifies statements with an ollama model. Statements are sent in batches of
+  `batch_size` per request with a JSON schema for the answer, at most
+  `concurrency` requests are in flight on one pooled session, which should match
+  the parallel slots of the server. Statements a batch answer misses are
+  classified on their own, failures come back as "ERROR". With a `cache` only
+  statements it has no answer for reach the model.
+
+    async with AsyncLLMClient() as llm:
+      codes = await llm.classify(statements, DAS_TASK)
+  """
+
+  def __init__(
+    self,
+    url: str = ollama_url,
+    model: str = models[0],
+    concurrency: int = PARALLEL_SLOTS,
+    batch_size: int = BATCH_SIZE,
+    keep_alive: int | str = KEEP_ALIVE,
+    timeout: float = 300,
+    retries: int = 2,
+    options: dict | None = None,
+    cache: LLMCache | None = None,
+  ):
+    self.url = url
+    self.model = model
+    self.concurrency = concurrency
+    self.batch_size = batch_size
+    self.keep_alive = keep_alive
+    self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=10)
+    self.retries = retries
+    # num_thread is left to ollama, it knows the machine
+    self.options = {"temperature": 0.0, **(options or {})}
+    self.semaphore = asyncio.Semaphore(concurrency)
+    self.cache = cache
+    self.session: aiohttp.ClientSession | None = None
+
+  async def __aenter__(self):
+    self.session = aiohttp.ClientSession(
+      timeout=self.timeout, connector=aiohttp.TCPConnector(limit=self.concurrency)
+    )
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, _):
+    if self.session:
+      await self.session.close()
+      self.session = None
+
+  async def generate(
+    self,
+    prompt: str,
+    system: str,
+    format: str | dict | None = None,
+    num_predict: int = 20,
+  ) -> str:
+    """The model's answer to one prompt, retried on connection errors and 5xx."""
+    payload = {
+      "model": self.model,
+      "prompt": prompt,
+      "system": system,
+      "stream": False,
+      "keep_alive": self.keep_alive,
+      "options": {**self.options, "num_predict": num_predict},
+    }
+    if format is not None:
+      payload["format"] = format
+    for attempt in range(self.retries + 1):
+      try:
+        async with self.semaphore:
+          async with self.session.post(self.url, json=payload) as response:
+            if response.status < 500:
+              response.raise_for_status()
+              return (await response.json()).get("response", "").strip()
+            error = f"HTTP {response.status}"
+      except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+        error = f"{type(e).__name__}: {e}"
+      if attempt < self.retries:
+        await asyncio.sleep(2**attempt)
+    raise RuntimeError(f"ollama failed after {self.retries + 1} attempts: {error}")
+
+  async def _classify_one(self, text: str, task: ClassificationTask) -> str:
+    schema = {
+      "type": "object",
+      "properties": {"code": {"type": "string", "enum": list(task.codes)}},
+      "required": ["code"],
+    }
+    system = task.system_prompt + (
+      f'\nYour response MUST be a single JSON object adhering to this schema: {{"code": "[{" or ".join(task.codes)}]"}}.'
+    )
+    try:
+      answer = await self.generate(
+        f"--- STATEMENT ---\n{text}\n\nCLASSIFICATION CODE:",
+        system,
+        schema,
+      )
+    except (RuntimeError, aiohttp.ClientError) as e:
+      print(f"Error communicating with Ollama: {e}")
+      return "ERROR"
     try:
-      json_data = json.loads(full_response)
+      code = str(json.loads(answer).get("code", "ERROR")).strip().upper()
+    except (json.JSONDecodeError, AttributeError):
+      return f"PARSE_ERROR: {answer}"
+    return code if code in task.codes else f"PARSE_ERROR: {answer}"
+
+  async def _classify_batch(
+    self, texts: list[str], task: ClassificationTask
+  ) -> list[str]:
+    if len(texts) == 1:
+      return [await self._classify_one(texts[0], task)]
+    prompt = "\n\n".join(f"[{i}] {text}" for i, text in enumerate(texts, 1))
+    codes: dict[int, str] = {}
+    try:
+      answer = await self.generate(
+        prompt,
+        task.system_prompt + BATCH_INSTRUCTIONS,
+        _batch_schema(task),
+        num_predict=16 + TOKENS_PER_STATEMENT * len(texts),
+      )
+      for item in json.loads(answer).get("results", []):
+        code = str(item.get("code", "")).strip().upper()
+        if code in task.codes:
+          codes.setdefault(int(item["id"]), code)
+    except (RuntimeError, aiohttp.ClientError) as e:
+      print(f"Error communicating with Ollama: {e}")
+      return ["ERROR"] * len(texts)
+    except (json.JSONDecodeError, AttributeError, KeyError, TypeError, ValueError):
+      pass
+    # whatever the batch answer did not cover is asked for on its own
+    missing = [i for i in range(1, len(texts) + 1) if i not in codes]
+    singles = await asyncio.gather(
+      *(self._classify_one(texts[i - 1], task) for i in missing)
+    )
+    codes.update(zip(missing, singles, strict=True))
+    return [codes[i] for i in range(1, len(texts) + 1)]
+
+  async def classify(
+    self, texts: Iterable[str], task: ClassificationTask = DAS_TASK
+  ) -> list[str]:
+    """One code of `task` per text, in order. Repeated texts are asked once."""
+    texts = [normalize_statement(t) for t in texts]
+    codes: dict[str, str] = {}
+    if self.cache:
+      codes = await asyncio.to_thread(self.cache.get_many, self.model, task, texts)
+    todo = [t for t in dict.fromkeys(texts) if t not in codes]
+    batches = [
+      todo[i : i + self.batch_size] for i in range(0, len(todo), self.batch_size)
+    ]
+    results = await asyncio.gather(*(self._classify_batch(b, task) for b in batches))
+    new = dict(zip(todo, (code for batch in results for code in batch), strict=True))
+    if self.cache and new:
+      await asyncio.to_thread(self.cache.put_many, self.model, task, new)
+    codes.update(new)
+    return [codes[t] for t in texts]
+
+
+async def _classify_single(msg: str, task: ClassificationTask, model_name: str) -> str:
+  async with AsyncLLMClient(
+    model=model_name, concurrency=1, cache=LLMCache()
+  ) as client:
+    return (await client.classify([msg], task))[0]
 
-      classification = json_data.get("code", "ERROR").strip().upper()
-    except json.JSONDecodeError:
-      classification = f"PARSE_ERROR: {full_response}"
 
-    return classification
-  except requests.exceptions.RequestException as e:
-    print(f"Error communicating with Ollama: {e}")
-    return "ERROR"
+def is_article_data_based(msg: str, model_name: str = "llama3:8b"):
+  return asyncio.run(_classify_single(msg, ARTICLE_TASK, model_name))
+
+
+def get_das_classification(msg: str, model_name: str = "llama3:8b"):
+  return asyncio.run(_classify_single(msg, DAS_TASK, model_name))
 
 
 if __name__ == "__main__":
@@ -94,12 +374,14 @@ if __name__ == "__main__":
   ]
 
   print(
-    f"--- Classifying Statements using {models[1]} (Threads: {32}, Keep-Alive: {-1}) ---"
+    f"--- Classifying Statements using {models[1]} "
+    f"(Slots: {PARALLEL_SLOTS}, Batch: {BATCH_SIZE}, Keep-Alive: {KEEP_ALIVE}) ---"
   )
 
-  for i, statement in enumerate(statements_to_check):
-    print(f"\n--- Statement {i + 1} ---")
-    print(f'Input: "{statement}"')
+  async def main():
+    async with AsyncLLMClient(model=models[1], cache=LLMCache()) as client:
+      return await client.classify(statements_to_check)
 
-    result = get_das_classification(statement)
+  for statement, result in zip(statements_to_check, asyncio.run(main()), strict=True):
+    print(f'\nInput: "{statement}"')
     print(result)
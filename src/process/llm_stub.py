@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import json
+import re
+
+from aiohttp import web
+
+STATEMENT = re.compile(r"^\[(\d+)\] (.*?)(?=^\[\d+\] |\Z)", re.MULTILINE | re.DOTALL)
+
+
+def _code(text: str, codes: list[str]) -> str:
+  text = text.lower()
+  if codes == ["R", "M", "D"]:
+    if "review" in text:
+      return "R"
+    return "M" if "method" in text else "D"
+  if any(k in text for k in ("http", "github", "osf", "repository", "zenodo")):
+    return "A"
+  if any(k in text for k in ("request", "restricted", "proprietary")):
+    return "R"
+  return "N"
+
+
+class StubOllama:
+  """
+  Stand-in for ollama's /api/generate for local runs and tests of the llm
+  client. It answers like a model with structured output, from keywords of the
+  statements, works on `parallel` requests at once like OLLAMA_NUM_PARALLEL and
+  queues the rest. With `drop_every` every n-th statement of a batch is left out
+  of the answer.
+  """
+
+  def __init__(self, latency: float = 0.2, parallel: int = 4, drop_every: int = 0):
+    self.latency = latency
+    self.slots = asyncio.Semaphore(parallel)
+    self.drop_every = drop_every
+    self.requests = 0
+    self.statements = 0
+    self.inflight = 0
+    self.peak = 0
+    self.keep_alive_in_options = 0
+
+  async def generate(self, request: web.Request) -> web.Response:
+    payload = await request.json()
+    self.requests += 1
+    if "keep_alive" in payload.get("options", {}):
+      self.keep_alive_in_options += 1
+    schema = payload.get("format")
+    async with self.slots:
+      self.inflight += 1
+      self.peak = max(self.peak, self.inflight)
+      try:
+        await asyncio.sleep(self.latency)
+        prompt = payload["prompt"]
+        if isinstance(schema, dict) and "results" in schema.get("properties", {}):
+          codes = schema["properties"]["results"]["items"]["properties"]["code"]["enum"]
+          results = [
+            {"id": int(i), "code": _code(text, codes)}
+            for i, text in STATEMENT.findall(prompt)
+            if not self.drop_every or int(i) % self.drop_every
+          ]
+          self.statements += len(results)
+          answer = {"results": results}
+        else:
+          codes = ["A", "R", "N"]
+          if isinstance(schema, dict):
+            codes = schema["properties"]["code"]["enum"]
+          self.statements += 1
+          answer = {"code": _code(prompt, codes)}
+      finally:
+        self.inflight -= 1
+    return web.json_response(
+      {"model": payload.get("model"), "response": json.dumps(answer), "done": True}
+    )
+
+  def app(self) -> web.Application:
+    app = web.Application()
+    app.router.add_post("/api/generate", self.generate)
+    return app
+
+
+async def start_stub(
+  port: int = 11434, latency: float = 0.2, parallel: int = 4, drop_every: int = 0
+) -> tuple[web.AppRunner, StubOllama]:
+  stub = StubOllama(latency, parallel, drop_every)
+  runner = web.AppRunner(stub.app(), access_log=None)
+  await runner.setup()
+  await web.TCPSite(runner, "127.0.0.1", port).start()
+  return runner, stub
+
+
+async def _serve(args: argparse.Namespace) -> None:
+  runner, _ = await start_stub(args.port, args.latency, args.parallel, args.drop_every)
+  print(f"Stub ollama listening on port {args.port}")
+  try:
+    await asyncio.Event().wait()
+  finally:
+    await runner.cleanup()
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Answer /api/generate like ollama.")
+  parser.add_argument("--port", type=int, default=11434)
+  parser.add_argument("--latency", type=float, default=0.2)
+  parser.add_argument("--parallel", type=int, default=4)
+  parser.add_argument("--drop-every", type=int, default=0)
+  asyncio.run(_serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+  main()
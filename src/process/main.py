@@ -1,23 +1,247 @@
+"""
+Analysis service. Parsing and scoring run in a process pool, the handlers only
+wait for it, and results are cached by the sha256 of the tei.
+
+  cd src && python -m process.main --workers 4
+
+GET /process?path=... analyses one tei, its "result" is the FrontiersMatch label
+of the statement as it always was. POST /process/batch takes
+{"paths": [...], "openalex_ids": [...]} and streams one json line per document
+as soon as it is done.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Any, AsyncIterator, Dict, List, Optional
+
 import uvicorn
 from fastapi import FastAPI, HTTPException
-from process.analysis import FrontiersHandler
-from typing import Optional, Dict, Any
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
 
-app = FastAPI()
+from database import connect, migrate
+from process.analysis import ANALYSER_VERSION, analyse_tei
+from store import TEI_DIR
 
+# processes of the pool of each uvicorn worker
+POOL_WORKERS = int(os.environ.get("ANALYSIS_POOL_WORKERS", os.cpu_count() or 1))
+# results kept by each uvicorn worker, the least recently used go first
+CACHE_SIZE = int(os.environ.get("ANALYSIS_CACHE_SIZE", 50_000))
+# documents of a batch analysed at once, more would only queue in the pool
+BATCH_CONCURRENCY = 4 * POOL_WORKERS
+MAX_BATCH = 10_000
 
-@app.get("/process")
-def process_data(path: str) -> Dict[str, Any]:
+
+class ResultCache:
+  """LRU cache of analyse_tei results keyed by file hash and journal."""
+
+  def __init__(self, max_entries: int = CACHE_SIZE):
+    self.max_entries = max_entries
+    self.entries: OrderedDict[tuple, dict] = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key: tuple) -> dict | None:
+    result = self.entries.get(key)
+    if result is None:
+      self.misses += 1
+      return None
+    self.entries.move_to_end(key)
+    self.hits += 1
+    return result
+
+  def put(self, key: tuple, result: dict) -> None:
+    self.entries[key] = result
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.max_entries:
+      self.entries.popitem(last=False)
+
+
+def _file_hash(path: str) -> str:
+  with open(path, "rb") as f:
+    return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+pool: ProcessPoolExecutor | None = None
+cache = ResultCache()
+# futures of the files being analysed, by cache key
+inflight: dict[tuple, asyncio.Future] = {}
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+  global pool
+  await asyncio.to_thread(migrate)
+  pool = ProcessPoolExecutor(max_workers=POOL_WORKERS)
   try:
-    fh = FrontiersHandler(path)
-    das = fh.extract_das()
-    res: Optional[int] = fh.analyze_das(das)
+    yield
+  finally:
+    pool.shutdown(cancel_futures=True)
+    pool = None
+
 
-    return {"result": res, "status": "success"}
+app = FastAPI(lifespan=lifespan)
 
+
+def _finish(key: tuple, future: asyncio.Future) -> None:
+  # a callback, so the result is cached even if every request gave up waiting
+  inflight.pop(key, None)
+  if not future.cancelled() and future.exception() is None:
+    cache.put(key, future.result())
+
+
+def _analyse(path: str, journal_id: str | None) -> dict:
+  # lxml's errors cannot be pickled back from the pool
+  try:
+    return analyse_tei(path, journal_id)
   except Exception as e:
-    raise HTTPException(status_code=500, detail=str(e))
+    return {"error": f"{type(e).__name__}: {e}"}
+
+
+async def analyse(path: str, journal_id: str | None = None) -> Dict[str, Any]:
+  """
+  analyse_tei of a tei in the pool, or the cached result of the same file. A
+  file that is already being analysed for another request is waited for. A
+  tei that cannot be parsed gives {"error": ...}.
+  """
+  digest = await asyncio.to_thread(_file_hash, path)
+  key = (digest, journal_id, ANALYSER_VERSION)
+  result = cache.get(key)
+  if result is not None:
+    return {**result, "cached": True}
+  if key in inflight:
+    return {**(await asyncio.shield(inflight[key])), "cached": True}
+  loop = asyncio.get_running_loop()
+  future = loop.run_in_executor(pool, _analyse, path, journal_id)
+  inflight[key] = future
+  future.add_done_callback(partial(_finish, key))
+  return {**(await asyncio.shield(future)), "cached": False}
+
+
+def _lookup_works(openalex_ids: list[str]) -> dict[str, tuple]:
+  """journal_id, tei status and stored tei path of works in index.db."""
+  works = {}
+  with connect() as conn:
+    for i in range(0, len(openalex_ids), 500):
+      chunk = openalex_ids[i : i + 500]
+      works.update(
+        (row[0], row[1:])
+        for row in conn.execute(
+          f"""
+            SELECT openalex_id, journal_id, tei_process_status, tei_local_path
+            FROM works WHERE openalex_id IN ({",".join("?" * len(chunk))})
+          """,
+          chunk,
+        )
+      )
+  return works
+
+
+@app.get("/process")
+async def process_data(path: str, journal_id: Optional[str] = None) -> Dict[str, Any]:
+  if not os.path.isfile(path):
+    raise HTTPException(status_code=404, detail=f"No such file: {path}")
+  try:
+    result = await analyse(path, journal_id)
+  except OSError as e:
+    raise HTTPException(status_code=500, detail=f"{type(e).__name__}: {e}")
+  if "error" in result:
+    raise HTTPException(status_code=500, detail=result["error"])
+  # result is the FrontiersMatch label clients like experiment/test/rtest.R read,
+  # the decision with the journal's templates is in das_score and das_code
+  return {"result": result["frontiers_score"], "status": "success", **result}
+
+
+class BatchRequest(BaseModel):
+  paths: List[str] = []
+  openalex_ids: List[str] = []
+  journal_id: Optional[str] = None  # for paths, works have their own
+
+
+async def _batch_item(
+  semaphore: asyncio.Semaphore, item: dict, path: str | None, journal_id: str | None
+) -> dict:
+  if path is None:
+    return {**item, "status": "error", "error": "no processed tei"}
+  async with semaphore:
+    try:
+      result = await analyse(path, journal_id)
+    except OSError as e:
+      return {**item, "status": "error", "error": f"{type(e).__name__}: {e}"}
+  return {**item, "status": "error" if "error" in result else "success", **result}
+
+
+async def _stream(request: BatchRequest) -> AsyncIterator[str]:
+  semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+  tasks = [
+    asyncio.create_task(_batch_item(semaphore, {"path": p}, p, request.journal_id))
+    for p in request.paths
+  ]
+  if request.openalex_ids:
+    works = await asyncio.to_thread(_lookup_works, request.openalex_ids)
+    for openalex_id in request.openalex_ids:
+      journal_id, status, stored = works.get(openalex_id, (None, None, None))
+      path = TEI_DIR.resolve(stored) if status == "DONE" and stored else None
+      item = {"openalex_id": openalex_id}
+      tasks.append(asyncio.create_task(_batch_item(semaphore, item, path, journal_id)))
+  try:
+    for next_done in asyncio.as_completed(tasks):
+      yield json.dumps(await next_done) + "\n"
+  finally:
+    # the client went away
+    for task in tasks:
+      task.cancel()
+
+
+@app.post("/process/batch")
+async def process_batch(request: BatchRequest) -> StreamingResponse:
+  if len(request.paths) + len(request.openalex_ids) > MAX_BATCH:
+    raise HTTPException(
+      status_code=413, detail=f"At most {MAX_BATCH} documents per batch"
+    )
+  return StreamingResponse(_stream(request), media_type="application/x-ndjson")
+
+
+@app.get("/health")
+async def health() -> Dict[str, Any]:
+  return {
+    "status": "ok",
+    "analyser_version": ANALYSER_VERSION,
+    "cache_entries": len(cache.entries),
+    "cache_hits": cache.hits,
+    "cache_misses": cache.misses,
+  }
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Serve the tei analysis over http.")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8000)
+  parser.add_argument("--workers", type=int, default=2, help="uvicorn processes")
+  parser.add_argument(
+    "--pool-workers", type=int, help="analysis processes per uvicorn worker"
+  )
+  parser.add_argument("--cache-size", type=int, default=CACHE_SIZE)
+  args = parser.parse_args()
+  # the uvicorn workers import this module anew and read their settings here
+  pool_workers = args.pool_workers or max(1, (os.cpu_count() or 1) // args.workers)
+  os.environ["ANALYSIS_POOL_WORKERS"] = str(pool_workers)
+  os.environ["ANALYSIS_CACHE_SIZE"] = str(args.cache_size)
+  uvicorn.run(
+    "process.main:app",
+    host=args.host,
+    port=args.port,
+    workers=args.workers,
+    access_log=False,
+  )
 
 
 if __name__ == "__main__":
-  uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
+  main()
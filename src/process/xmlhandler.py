@@ -1,6 +1,206 @@
-from lxml import etree
-import grobid_tei_xml as gtx
 import json
+import os
+from dataclasses import asdict, dataclass, fields
+from functools import lru_cache
+
+from lxml import etree
+
+from database import TEI_CACHE_DIR
+from store import ShardedDir
+
+TEI_NS = "{http://www.tei-c.org/ns/1.0}"
+
+# bump when TEIDocument or the parser changes, older cache entries are reparsed
+CACHE_VERSION = 2
+
+_TAGS = [
+  f"{TEI_NS}{tag}"
+  for tag in ("title", "idno", "abstract", "div", "note", "ref", "ptr", "listBibl")
+]
+
+
+@dataclass(frozen=True)
+class TEIDocument:
+  """
+  Everything the analyses read from a grobid tei, parsed in one pass. Frozen,
+  load_tei hands the same instance to every caller.
+  """
+
+  title: str | None = None
+  doi: str | None = None
+  abstract: str | None = None
+  das: str | None = None  # text of <div type="availability">
+  sections: tuple[tuple[str | None, str], ...] = ()  # (head, text)
+  # divs of <back> other than availability and references, (type, text):
+  # acknowledgement, annex, funding, supplementary material, ...
+  back: tuple[tuple[str | None, str], ...] = ()
+  footnotes: tuple[str, ...] = ()
+  # targets of ref and ptr outside the bibliography
+  links: tuple[str, ...] = ()
+  references: str | None = None  # text of the bibliography
+  reference_links: tuple[str, ...] = ()  # targets inside it
+
+  @classmethod
+  def from_json(cls, values: dict) -> "TEIDocument":
+    """The inverse of asdict after a json round trip, lists back to tuples."""
+    for f in fields(cls):
+      if isinstance(values.get(f.name), list):
+        values[f.name] = tuple(
+          tuple(x) if isinstance(x, list) else x for x in values[f.name]
+        )
+    return cls(**values)
+
+  @property
+  def fulltext(self) -> str:
+    """All text of the tei, back matter and bibliography included."""
+    parts = [self.title, self.abstract]
+    for head, text in self.sections:
+      parts += [head, text]
+    parts += [self.das, *(text for _, text in self.back), *self.footnotes]
+    parts += [*self.links, self.references, *self.reference_links]
+    return "\n\n".join(p for p in parts if p)
+
+
+def _text(elem: etree._Element) -> str:
+  return " ".join(elem.itertext()).strip()
+
+
+def _inside(elem: etree._Element, tag: str) -> bool:
+  parent = elem.getparent()
+  while parent is not None:
+    if parent.tag == tag:
+      return True
+    parent = parent.getparent()
+  return False
+
+
+def _drop(elem: etree._Element) -> None:
+  """Frees a handled element and the siblings handled before it."""
+  elem.clear()
+  parent = elem.getparent()
+  if parent is not None:
+    while elem.getprevious() is not None:
+      del parent[0]
+
+
+def parse_tei(path: str) -> TEIDocument:
+  """
+  Streams a tei with iterparse and collects header, data availability statement,
+  body sections, back matter, footnotes, bibliography and links at once. Handled subtrees are freed on the
+  way, so long articles with large bibliographies stay small in memory.
+  """
+  title = doi = abstract = das = references = None
+  sections, back, footnotes = [], [], []
+  links: dict[str, None] = {}
+  reference_links: dict[str, None] = {}
+  for _, elem in etree.iterparse(path, events=("end",), tag=_TAGS):
+    tag = elem.tag[len(TEI_NS) :]
+    parent = elem.getparent()
+    parent_tag = parent.tag if parent is not None else None
+    if tag == "title":
+      if (
+        title is None
+        and parent_tag == f"{TEI_NS}titleStmt"
+        and elem.get("level", "a") == "a"
+      ):
+        title = _text(elem) or None
+    elif tag == "idno":
+      if (
+        doi is None
+        and elem.get("type") == "DOI"
+        and _inside(elem, f"{TEI_NS}teiHeader")
+      ):
+        doi = _text(elem) or None
+    elif tag == "abstract":
+      abstract = _text(elem) or None
+      _drop(elem)
+    elif tag in ("ref", "ptr"):
+      target = elem.get("target", "")
+      if target.startswith(("http://", "https://")):
+        if _inside(elem, f"{TEI_NS}listBibl"):
+          reference_links[target] = None
+        else:
+          links[target] = None
+    elif tag == "note":
+      if elem.get("place") == "foot":
+        footnotes.append(_text(elem))
+    elif tag == "listBibl":
+      if not _inside(elem, f"{TEI_NS}listBibl"):
+        references = _text(elem) or None
+        _drop(elem)
+    elif tag == "div":
+      if elem.get("type") == "availability":
+        if das is None:
+          das = _text(elem)
+        _drop(elem)
+      elif parent_tag == f"{TEI_NS}body":
+        head = elem.find(f"{TEI_NS}head")
+        text = " ".join(_text(child) for child in elem if child is not head)
+        sections.append((_text(head) if head is not None else None, text.strip()))
+        _drop(elem)
+      elif parent_tag == f"{TEI_NS}back" and elem.get("type") != "references":
+        back.append((elem.get("type"), _text(elem)))
+        _drop(elem)
+  return TEIDocument(
+    title=title,
+    doi=doi,
+    abstract=abstract,
+    das=das,
+    sections=tuple(sections),
+    back=tuple(back),
+    footnotes=tuple(footnotes),
+    links=tuple(links),
+    references=references,
+    reference_links=tuple(reference_links),
+  )
+
+
+TEI_CACHE = ShardedDir(TEI_CACHE_DIR)
+
+
+def _cache_path(path: str, cache: ShardedDir) -> str:
+  return cache.path(os.path.basename(path).removesuffix(".xml") + ".json")
+
+
+@lru_cache(maxsize=256)
+def _load(path: str, mtime_ns: int, size: int, cache_root: str) -> TEIDocument:
+  cache_path = _cache_path(path, ShardedDir(cache_root))
+  try:
+    with open(cache_path, encoding="utf-8") as f:
+      entry = json.load(f)
+    if (entry["version"], entry["mtime_ns"], entry["size"]) == (
+      CACHE_VERSION,
+      mtime_ns,
+      size,
+    ):
+      return TEIDocument.from_json(entry["doc"])
+  except (OSError, ValueError, KeyError, TypeError):
+    pass
+
+  doc = parse_tei(path)
+  os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+  entry = {
+    "version": CACHE_VERSION,
+    "mtime_ns": mtime_ns,
+    "size": size,
+    "doc": asdict(doc),
+  }
+  tmp_path = f"{cache_path}.{os.getpid()}.part"
+  with open(tmp_path, "w", encoding="utf-8") as f:
+    json.dump(entry, f, ensure_ascii=False)
+  os.replace(tmp_path, cache_path)
+  return doc
+
+
+def load_tei(path: str, cache: ShardedDir = TEI_CACHE) -> TEIDocument:
+  """
+  The parsed tei at `path`, from the on-disk cache if the tei did not change since
+  it was parsed. Entries are keyed by the tei's mtime and size, a tei rewritten by
+  grobid is parsed again.
+  """
+  st = os.stat(path)
+  return _load(os.path.abspath(path), st.st_mtime_ns, st.st_size, cache.root)
+
 
 class XMLHandler:
   def extract_abstract(self):
@@ -8,22 +208,11 @@ class XMLHandler:
 
   @classmethod
   def extract_fulltext(self, xmlpath) -> str:
-    with open(xmlpath, "r") as xmlfile:
-      doc = gtx.parse_document_xml(xmlfile.read())
-      return json.dumps(doc.to_dict())
+    return load_tei(xmlpath).fulltext
 
   def extract_data_availibility_statement(self, xmlpath) -> str | None:
     try:
-      tree = etree.parse(xmlpath)
-      root = tree.getroot()
-      ns = {"tei": "http://www.tei-c.org/ns/1.0"}
-
-      availability_div = root.find(".//tei:div[@type='availability']", namespaces=ns)
-
-      if availability_div is not None:
-        return " ".join(availability_div.itertext()).strip()
-      else:
-        return None
+      return load_tei(xmlpath).das
     except Exception as e:
       print(f"Error extracting data: {e}")
       return None
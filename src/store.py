@@ -0,0 +1,440 @@
+import argparse
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
+
+from database import (
+  DOWNLOAD_DIR_PDFS,
+  DOWNLOAD_DIR_TEIS,
+  connect,
+  migrate,
+  share_duplicate_teis,
+)
+
+HASH_CHUNK = 1024 * 1024
+
+# files are spread over two levels of 256 directories by the first four hex
+# characters of their (hash) name, a few hundred files per leaf at a million files
+FANOUT_LEVELS = 2
+FANOUT_WIDTH = 2
+
+TEI_SUFFIX = ".grobid.tei.xml"
+
+
+def sha256_file(path: str) -> str:
+  h = hashlib.sha256()
+  with open(path, "rb") as f:
+    while chunk := f.read(HASH_CHUNK):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def shard(name: str) -> str:
+  """Relative path of `name` in a fan-out directory, e.g. ab/cd/abcd....pdf"""
+  parts = [
+    name[i * FANOUT_WIDTH : (i + 1) * FANOUT_WIDTH] for i in range(FANOUT_LEVELS)
+  ]
+  return os.path.join(*parts, name)
+
+
+def is_sharded(relpath: str) -> bool:
+  return relpath == shard(os.path.basename(relpath))
+
+
+def _adopt(src: str, dst: str) -> None:
+  """Makes `src` available at `dst` without removing it, crash safe for migrations."""
+  if os.path.exists(dst):
+    return
+  os.makedirs(os.path.dirname(dst), exist_ok=True)
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copy2(src, dst + ".part")
+    os.replace(dst + ".part", dst)
+
+
+class ShardedDir:
+  """A directory whose files live in hash prefix fan-out subdirectories."""
+
+  def __init__(self, root: str):
+    self.root = root
+
+  def relpath(self, name: str) -> str:
+    return shard(name)
+
+  def path(self, name: str) -> str:
+    return os.path.join(self.root, shard(name))
+
+  def resolve(self, stored: str) -> str:
+    """
+    Absolute path of a path stored in index.db. Absolute paths are taken as
+    they are, everything else is relative to the root, flat names of the old
+    layout included.
+    """
+    if os.path.isabs(stored):
+      return stored
+    return os.path.join(self.root, stored)
+
+  def place(self, src: str, name: str | None = None) -> str:
+    """Moves `src` into its shard, returns the path relative to the root."""
+    relpath = shard(name or os.path.basename(src))
+    dst = os.path.join(self.root, relpath)
+    if os.path.abspath(src) != os.path.abspath(dst):
+      os.makedirs(os.path.dirname(dst), exist_ok=True)
+      os.replace(src, dst)
+    return relpath
+
+
+PDF_DIR = ShardedDir(DOWNLOAD_DIR_PDFS)
+TEI_DIR = ShardedDir(DOWNLOAD_DIR_TEIS)
+
+
+def tei_name(pdf_path: str) -> str:
+  """Name of the tei grobid writes for a pdf."""
+  return os.path.basename(pdf_path).removesuffix(".pdf") + TEI_SUFFIX
+
+
+def tei_is_fresh(tei_path: str, pdf_path: str) -> bool:
+  """A tei is up to date if it is not empty and not older than its pdf."""
+  try:
+    tei = os.stat(tei_path)
+    return tei.st_size > 0 and tei.st_mtime >= os.stat(pdf_path).st_mtime
+  except OSError:
+    return False
+
+
+class PDFStore:
+  """
+  Content addressed pdf store. A pdf lives at root/ab/cd/<sha256>.pdf, named by
+  the hash of its bytes, so an article reached through several urls is stored
+  (and sent to grobid) once. url_contents maps every url to the content it
+  served, a url that is already in the store is not downloaded again.
+  """
+
+  def __init__(self, root: str = DOWNLOAD_DIR_PDFS, db_path: str | None = None):
+    self.dir = ShardedDir(root)
+    self.db_path = db_path
+
+  @property
+  def root(self) -> str:
+    return self.dir.root
+
+  def path_for(self, sha256: str) -> str:
+    return self.dir.path(f"{sha256}.pdf")
+
+  @staticmethod
+  def sha256_of(path: str) -> str:
+    return os.path.basename(path).removesuffix(".pdf")
+
+  def lookup(self, url: str) -> str | None:
+    """Path of the pdf `url` served before, None if unknown or the file is gone."""
+    with connect(self.db_path) as conn:
+      row = conn.execute(
+        "SELECT sha256 FROM url_contents WHERE url = ?", (url,)
+      ).fetchone()
+    if not row:
+      return None
+    path = self.path_for(row[0])
+    return path if os.path.exists(path) else None
+
+  def put(self, tmppath: str, urls: Iterable[str], sha256: str | None = None) -> str:
+    """
+    Moves a finished download into the store and maps `urls` to it. If the
+    content is stored already the download is dropped.
+    """
+    sha256 = sha256 or sha256_file(tmppath)
+    size = os.path.getsize(tmppath)
+    path = self.path_for(sha256)
+    if os.path.exists(path):
+      os.remove(tmppath)
+    else:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      os.replace(tmppath, path)
+    self.link(urls, path, size)
+    return path
+
+  def link(self, urls: Iterable[str], path: str, size: int | None = None) -> None:
+    sha256 = self.sha256_of(path)
+    with connect(self.db_path) as conn:
+      conn.executemany(
+        """
+          INSERT INTO url_contents (url, sha256, size) VALUES (?, ?, ?)
+          ON CONFLICT(url) DO UPDATE SET sha256 = excluded.sha256,
+            size = coalesce(excluded.size, size)
+        """,
+        [(url, sha256, size) for url in dict.fromkeys(urls)],
+      )
+
+
+def work_files(
+  conn: sqlite3.Connection, journal_id: str | None = None, which: str = "tei"
+) -> Iterator[tuple[str, str]]:
+  """
+  (openalex_id, absolute path) of the pdfs or teis of finished works, read from
+  index.db instead of listing the directories.
+  """
+  column, status, files = {
+    "pdf": ("pdf_local_path", "pdf_download_status", PDF_DIR),
+    "tei": ("tei_local_path", "tei_process_status", TEI_DIR),
+  }[which]
+  query = f"SELECT openalex_id, {column} FROM works WHERE {status} = 'DONE'"
+  query += f" AND {column} IS NOT NULL"
+  params: tuple = ()
+  if journal_id:
+    query += " AND journal_id = ?"
+    params = (journal_id.upper(),)
+  for openalex_id, stored in conn.execute(query, params):
+    yield openalex_id, files.resolve(stored)
+
+
+def _legacy_urls(conn: sqlite3.Connection, pdf_path: str) -> list[str]:
+  """Urls of the works of a pdf from the old layout, which was named sha256(url)."""
+  stem = PDFStore.sha256_of(pdf_path)
+  urls = conn.execute(
+    """
+      SELECT u.url FROM works AS w JOIN work_urls AS u USING (openalex_id)
+      WHERE w.pdf_local_path = ?
+    """,
+    (pdf_path,),
+  ).fetchall()
+  return [url for (url,) in urls if hashlib.sha256(url.encode()).hexdigest() == stem]
+
+
+def _remove_leftovers(store: PDFStore, teis: ShardedDir, dry_run: bool) -> int:
+  """
+  Removes flat pdfs of the old layout that no work points to any more and whose
+  content is in the store and url_contents, with their flat teis. These are left
+  when a migration stops between committing a batch and removing its files.
+  """
+  removed = 0
+  if not os.path.isdir(store.root):
+    return removed
+  with os.scandir(store.root) as entries:
+    flat = [e.path for e in entries if e.is_file() and e.name.endswith(".pdf")]
+  with connect(store.db_path) as conn:
+    for old_pdf in flat:
+      name = os.path.basename(old_pdf)
+      if conn.execute(
+        "SELECT 1 FROM works WHERE pdf_local_path IN (?, ?) LIMIT 1",
+        (name, old_pdf),
+      ).fetchone():
+        continue
+      sha256 = sha256_file(old_pdf)
+      new_pdf = store.path_for(sha256)
+      if (
+        not os.path.exists(new_pdf)
+        or not conn.execute(
+          "SELECT 1 FROM url_contents WHERE sha256 = ? LIMIT 1", (sha256,)
+        ).fetchone()
+      ):
+        continue
+      removed += 1
+      if dry_run:
+        continue
+      os.remove(old_pdf)
+      old_tei = os.path.join(teis.root, tei_name(old_pdf))
+      if os.path.exists(old_tei) and os.path.exists(teis.path(tei_name(new_pdf))):
+        os.remove(old_tei)
+  return removed
+
+
+def migrate_layout(
+  store: PDFStore | None = None,
+  teis: ShardedDir = TEI_DIR,
+  batch_size: int = 500,
+  dry_run: bool = False,
+) -> dict[str, int]:
+  """
+  Moves the flat pdfs/ and teis/ directories into the sharded, content addressed
+  layout and rewrites pdf_local_path and tei_local_path. Files are linked into
+  their new place first and the old ones removed after the batch is committed,
+  an interrupted run can simply be started again and removes what the last one
+  left, see _remove_leftovers.
+  """
+  store = store or PDFStore()
+  migrate(store.db_path)
+  counts = {"pdfs": 0, "teis": 0, "duplicates": 0, "missing": 0, "leftovers": 0}
+  with connect(store.db_path) as conn:
+    rows = conn.execute(
+      """
+        SELECT pdf_local_path, MAX(tei_local_path) FROM works
+        WHERE pdf_local_path IS NOT NULL
+        GROUP BY pdf_local_path
+      """
+    ).fetchall()
+  todo = [
+    (pdf, tei)
+    for pdf, tei in rows
+    if not is_sharded(os.path.relpath(store.dir.resolve(pdf), store.root))
+  ]
+  for start in range(0, len(todo), batch_size):
+    stale: list[str] = []
+    with connect(store.db_path) as conn:
+      for pdf, tei in todo[start : start + batch_size]:
+        old_pdf = store.dir.resolve(pdf)
+        if not os.path.exists(old_pdf):
+          counts["missing"] += 1
+          continue
+        new_pdf = store.path_for(sha256_file(old_pdf))
+        counts["duplicates"] += os.path.exists(new_pdf)
+        counts["pdfs"] += 1
+        if dry_run:
+          continue
+        _adopt(old_pdf, new_pdf)
+        size = os.path.getsize(new_pdf)
+        conn.executemany(
+          "INSERT OR IGNORE INTO url_contents (url, sha256, size) VALUES (?, ?, ?)",
+          [(url, PDFStore.sha256_of(new_pdf), size) for url in _legacy_urls(conn, pdf)],
+        )
+        conn.execute(
+          "UPDATE works SET pdf_local_path = ? WHERE pdf_local_path = ?",
+          (new_pdf, pdf),
+        )
+
+        old_tei = teis.resolve(tei) if tei else None
+        if old_tei and os.path.exists(old_tei):
+          new_tei = teis.relpath(tei_name(new_pdf))
+          _adopt(old_tei, os.path.join(teis.root, new_tei))
+          conn.execute(
+            "UPDATE works SET tei_local_path = ? WHERE pdf_local_path = ?",
+            (new_tei, new_pdf),
+          )
+          counts["teis"] += 1
+          if os.path.abspath(old_tei) != os.path.abspath(teis.resolve(new_tei)):
+            stale.append(old_tei)
+        # after its tei, a leftover pdf leads _remove_leftovers to the tei
+        stale.append(old_pdf)
+    # only after the new paths are committed
+    for path in stale:
+      if os.path.exists(path):
+        os.remove(path)
+    print(f"Migrated {counts['pdfs']}/{len(todo)} pdfs and {counts['teis']} teis")
+  counts["leftovers"] = _remove_leftovers(store, teis, dry_run)
+  if not dry_run:
+    # works whose pdfs turned out to be duplicates get the tei of their twin
+    with connect(store.db_path) as conn:
+      share_duplicate_teis(conn)
+  return counts
+
+
+RECONCILE_QUERY = """
+  SELECT openalex_id, pdf_local_path, tei_process_status, tei_local_path
+  FROM works
+  WHERE pdf_download_status = 'DONE' AND pdf_local_path IS NOT NULL
+    AND openalex_id > :last
+    AND (:journal_id IS NULL OR journal_id = :journal_id)
+    AND (lease_expires IS NULL OR lease_expires < :now)
+  ORDER BY openalex_id
+  LIMIT :limit
+"""
+
+
+def _tei_state(
+  row: tuple[str, str, str, str | None], teis: ShardedDir
+) -> tuple[str, str | None]:
+  """What the disk says about a work: (DONE, tei relpath) or (PENDING, None)."""
+  _, pdf, _, stored = row
+  pdf = PDF_DIR.resolve(pdf)
+  for tei in (stored, teis.relpath(tei_name(pdf))):
+    if tei and tei_is_fresh(teis.resolve(tei), pdf):
+      return "DONE", tei
+  return "PENDING", None
+
+
+def reconcile_teis(
+  journal_id: str | None = None,
+  teis: ShardedDir = TEI_DIR,
+  batch_size: int = 500,
+  dry_run: bool = False,
+  db_path: str | None = None,
+) -> dict[str, int]:
+  """
+  Brings tei_process_status in line with the teis dir. Works whose tei exists
+  and is newer than their pdf are DONE, also when a crashed batch never
+  recorded it, DONE works whose tei is missing or older than the pdf go back
+  to PENDING. Works leased to a running worker are left alone.
+  """
+  migrate(db_path)
+  counts = {"checked": 0, "backfilled": 0, "reset": 0}
+  last = ""
+  with ThreadPoolExecutor(max_workers=16) as pool:
+    while True:
+      with connect(db_path) as conn:
+        rows = conn.execute(
+          RECONCILE_QUERY,
+          {
+            "last": last,
+            "journal_id": journal_id.upper() if journal_id else None,
+            "now": time.time(),
+            "limit": batch_size,
+          },
+        ).fetchall()
+      if not rows:
+        return counts
+      last = rows[-1][0]
+      states = pool.map(lambda row: _tei_state(row, teis), rows)
+      done, reset = [], []
+      for (openalex_id, _, status, stored), (state, tei) in zip(
+        rows, states, strict=True
+      ):
+        if state == "DONE" and (status != "DONE" or tei != stored):
+          done.append((tei, openalex_id))
+        elif state == "PENDING" and status == "DONE":
+          reset.append((openalex_id,))
+      if not dry_run:
+        with connect(db_path) as conn:
+          conn.executemany(
+            """
+              UPDATE works SET tei_process_status = 'DONE', tei_local_path = ?,
+                tei_error = NULL
+              WHERE openalex_id = ?
+            """,
+            done,
+          )
+          conn.executemany(
+            """
+              UPDATE works SET tei_process_status = 'PENDING',
+                tei_local_path = NULL, tei_attempts = 0
+              WHERE openalex_id = ?
+            """,
+            reset,
+          )
+      counts["checked"] += len(rows)
+      counts["backfilled"] += len(done)
+      counts["reset"] += len(reset)
+      print(f"Reconciled {counts['checked']} works: {counts}")
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(
+    description="Move flat pdfs/ and teis/ directories into the sharded layout."
+  )
+  parser.add_argument("--batch-size", type=int, default=500)
+  parser.add_argument("--dry-run", action="store_true")
+  parser.add_argument(
+    "--reconcile-teis",
+    action="store_true",
+    help="sync tei_process_status with the teis dir instead of migrating",
+  )
+  parser.add_argument("--journal", help="reconcile only this openalex source id")
+  args = parser.parse_args()
+  if args.reconcile_teis:
+    counts = reconcile_teis(
+      args.journal, batch_size=args.batch_size, dry_run=args.dry_run
+    )
+    print(f"Done: {counts}")
+    return
+  counts = migrate_layout(batch_size=args.batch_size, dry_run=args.dry_run)
+  print(
+    f"{counts['pdfs']} pdfs ({counts['duplicates']} duplicates), "
+    f"{counts['teis']} teis, {counts['missing']} missing files, "
+    f"{counts['leftovers']} leftovers of an earlier run"
+  )
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,160 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from pypdf import PdfReader
+
+from database import connect, migrate
+from store import PDF_DIR
+
+# the pdf header may be preceded by junk, readers accept it within the first 1024 bytes
+PDF_SNIFF_BYTES = 1024
+# %%EOF has to be near the end, some writers append a few bytes of garbage
+TRAILER_BYTES = 1024
+# nothing smaller than this is an article
+MIN_PDF_BYTES = 4 * 1024
+
+HTML_MARKERS = (b"<!doctype html", b"<html", b"<head", b"<body")
+
+# reasons recorded in works.pdf_invalid_reason
+MISSING = "MISSING"
+TOO_SMALL = "TOO_SMALL"
+HTML = "HTML"
+NOT_PDF = "NOT_PDF"
+TRUNCATED = "TRUNCATED"
+INVALID = "INVALID"  # the full parse failed
+
+
+def looks_like_pdf(head: bytes) -> bool:
+  return b"%PDF-" in head[:PDF_SNIFF_BYTES]
+
+
+def sniff(path: str) -> str | None:
+  """Cheap checks on size, header and trailer. None if the file looks fine."""
+  try:
+    size = os.path.getsize(path)
+  except OSError:
+    return MISSING
+  with open(path, "rb") as f:
+    head = f.read(PDF_SNIFF_BYTES)
+    f.seek(max(0, size - TRAILER_BYTES))
+    tail = f.read(TRAILER_BYTES)
+  if not looks_like_pdf(head):
+    lowered = head.lower()
+    return HTML if any(m in lowered for m in HTML_MARKERS) else NOT_PDF
+  if size < MIN_PDF_BYTES:
+    return TOO_SMALL
+  if b"%%EOF" not in tail:
+    return TRUNCATED
+  return None
+
+
+def parse(path: str) -> str | None:
+  """Full parse with pypdf, a pdf without readable pages is invalid."""
+  try:
+    reader = PdfReader(path, strict=False)
+    if len(reader.pages) == 0:
+      return INVALID
+  except Exception:
+    return INVALID
+  return None
+
+
+def validate(path: str, full: bool = False) -> str | None:
+  reason = sniff(path)
+  if reason is None and full:
+    reason = parse(path)
+  return reason
+
+
+def _check(job: tuple[str, bool]) -> str | None:
+  return validate(*job)
+
+
+CHECK_QUERY = """
+  SELECT DISTINCT pdf_local_path FROM works
+  WHERE pdf_download_status = 'DONE'
+    AND pdf_local_path > ?
+    AND (pdf_check IS NULL OR pdf_check < ?)
+  ORDER BY pdf_local_path
+  LIMIT ?
+"""
+
+# works.pdf_check, a full check implies the sniff
+SNIFFED = 1
+PARSED = 2
+
+
+def validate_store(
+  full: bool = False,
+  workers: int | None = None,
+  chunk_size: int = 500,
+  prune: bool = True,
+  db_path: str | None = None,
+) -> dict[str, int]:
+  """
+  Checks every downloaded pdf in a process pool and marks the works of bad ones
+  INVALID with the reason. Each chunk is committed together with pdf_check, so
+  an interrupted run continues where it stopped and pdfs are checked once per
+  level. With `prune` the bad files are removed from the store.
+  """
+  migrate(db_path)
+  level = PARSED if full else SNIFFED
+  counts: dict[str, int] = {"checked": 0}
+  last = ""
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    while True:
+      with connect(db_path) as conn:
+        paths = [p for (p,) in conn.execute(CHECK_QUERY, (last, level, chunk_size))]
+      if not paths:
+        return counts
+      last = paths[-1]
+      jobs = [(PDF_DIR.resolve(p), full) for p in paths]
+      reasons = list(pool.map(_check, jobs, chunksize=16))
+      bad = [(r, p) for p, r in zip(paths, reasons, strict=True) if r]
+      with connect(db_path) as conn:
+        conn.executemany(
+          "UPDATE works SET pdf_check = ? WHERE pdf_local_path = ?",
+          [(level, p) for p in paths],
+        )
+        conn.executemany(
+          """
+            UPDATE works
+            SET pdf_download_status = 'INVALID', pdf_invalid_reason = ?
+            WHERE pdf_local_path = ?
+          """,
+          bad,
+        )
+        if prune:
+          conn.executemany(
+            "DELETE FROM url_contents WHERE sha256 = ?",
+            [(os.path.basename(p).removesuffix(".pdf"),) for _, p in bad],
+          )
+      if prune:
+        for reason, path in bad:
+          path = PDF_DIR.resolve(path)
+          if reason != MISSING and os.path.exists(path):
+            os.remove(path)
+      counts["checked"] += len(paths)
+      for reason, _ in bad:
+        counts[reason] = counts.get(reason, 0) + 1
+      print(f"Validated {counts['checked']} pdfs: {counts}")
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(
+    description="Validate all downloaded pdfs and mark bad ones INVALID."
+  )
+  parser.add_argument("--full", action="store_true", help="parse every pdf")
+  parser.add_argument("--workers", type=int, help="processes, default all cores")
+  parser.add_argument("--chunk-size", type=int, default=500)
+  parser.add_argument("--keep-files", action="store_true")
+  args = parser.parse_args()
+  counts = validate_store(
+    args.full, args.workers, args.chunk_size, prune=not args.keep_files
+  )
+  print(f"Done: {counts}")
+
+
+if __name__ == "__main__":
+  main()
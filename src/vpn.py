@@ -8,15 +8,19 @@ SERVER_POOL = [("us", "nyc"), ("de", "fra"), ("se", "sto"), ("nl", "ams"), ("de"
 # TODO: add more vpn options like nord
 
 
-def rotate_vpn_server() -> None:
+def rotate_vpn_server(
+  location: tuple[str, str] | None = None,
+) -> tuple[str, str] | None:
   """
   Rotates Mullvad VPN
 
-  Moves the vpn node to one of the locations given in SERVER_POOL.
+  Moves the vpn node to `location` or to one of the locations given in SERVER_POOL.
   - SERVER_POOL = [("us", "nyc"), ("de", "fra"), ("se", "sto"), ("nl", "ams"), ...]
+
+  Returns the (country, city) that was connected to, None if the rotation failed.
   """
   try:
-    country, city = random.choice(SERVER_POOL)
+    country, city = location or random.choice(SERVER_POOL)
     print(f"--- Attempting rotation to new server: {country} {city} ---")
     subprocess.run(["mullvad", "disconnect"], capture_output=True, text=True)
 
@@ -42,9 +46,11 @@ def rotate_vpn_server() -> None:
     ).stdout
     print(status_check)
     print("-" * 50)
+    return (country, city)
   except subprocess.CalledProcessError as e:
     print("\n Subprocess ERROR during rotation")
     print(f"Command failed: {e.cmd}")
     print(f"Return code: {e.returncode}")
     print(f"Error output (stderr):\n{e.stderr.strip()}")
-    print("-" * 50)
\ No newline at end of file
+    print("-" * 50)
+    return None